@@ -0,0 +1,103 @@
+# Repository capacity tracking
+#
+# The repository size is estimated from each backup's data added and each
+# prune's freed bytes, and only reconciled with a full (slow) restic stats
+# now and then. With the free space of the repository filesystem, recent
+# growth gives a forecast of the days left until it's full, and whether
+# the next backup fits.
+
+import fcntl
+import os
+import statefile
+import time
+
+MAX_SAMPLES = 1000  # Growth samples kept (one per backup/prune)
+
+
+def load(state_path: str) -> dict:
+    """
+    Load the capacity state, ex :
+    {'repo_size': 52428800000, 'reconciled': 1725600000.0, 'growth': 1048576,
+     'samples': [[1725600000.0, 1048576, 912680550400], ...]}
+    where growth is the bytes added minus freed since the tracking started,
+    and samples [time, growth, free bytes or None] after each update.
+    """
+    return statefile.load(state_path, {'repo_size': None, 'reconciled': 0, 'growth': 0, 'samples': []})
+
+
+def save(state_path: str,
+         state: dict):
+    statefile.save(state_path, state)
+
+
+def free_space(path: str) -> int:
+    """
+    Free bytes (for unprivileged users) on the filesystem holding path,
+    None if it's not a local path.
+    """
+    try:
+        st = os.statvfs(path)
+    except OSError:
+        return None
+
+    return st.f_bavail * st.f_frsize
+
+
+def update(state_path: str,
+           delta: int = 0,
+           free: int = None,
+           repo_size: int = None) -> dict:
+    """
+    Add a size change (bytes added, or freed if negative) to the state,
+    or reset the size with a reconciled repo_size, and record a sample.
+    Concurrent jobs update the state one at a time (flock).
+    Returns the updated state.
+    """
+    os.makedirs(os.path.dirname(state_path), exist_ok=True)
+
+    with open(f"{state_path}.lock", 'w') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+
+        state = load(state_path)
+        now = time.time()
+
+        if repo_size is not None:
+            state['repo_size'] = repo_size
+            state['reconciled'] = now
+        elif state['repo_size'] is not None:
+            state['repo_size'] = max(state['repo_size'] + delta, 0)
+
+        state['growth'] += delta
+        state['samples'].append([now, state['growth'], free])
+        state['samples'] = state['samples'][-MAX_SAMPLES:]
+
+        save(state_path, state)
+
+    return state
+
+
+def growth_rate(state: dict,
+                window: float) -> float:
+    """
+    Repository growth in bytes per day over the last window seconds,
+    None if the samples span less than a day.
+    """
+    since = time.time() - window
+    samples = [s for s in state['samples'] if s[0] >= since]
+
+    if len(samples) < 2 or samples[-1][0] - samples[0][0] < 86400:
+        return None
+
+    return (samples[-1][1] - samples[0][1]) / (samples[-1][0] - samples[0][0]) * 86400
+
+
+def forecast(headroom: int,
+             rate: float) -> float:
+    """
+    Days until the headroom is used up at rate bytes per day,
+    None if the repository isn't growing.
+    """
+    if rate is None or rate <= 0:
+        return None
+
+    return max(headroom, 0) / rate
@@ -0,0 +1,90 @@
+# Check data subset planner
+#
+# Rotates restic check --read-data-subset=n/t over the repository so every
+# pack is read once per cycle of t checks, and (time budget mode) sizes t
+# from the read throughput measured by the previous checks.
+
+import math
+import os
+import statefile
+
+MAX_PARTS = 256     # restic --read-data-subset=n/t only accepts t <= 256
+
+
+def load(state_path: str) -> dict:
+    """
+    Load the rotation state, ex : {'part': 3, 'parts': 30, 'read_rate': 52428800.0}
+    """
+    return statefile.load(state_path, {'part': 1, 'parts': 0, 'read_rate': 0})
+
+
+def save(state_path: str,
+         state: dict):
+    statefile.save(state_path, state)
+
+
+def data_size(repository: str) -> int:
+    """
+    Size in bytes of the pack files of a local repository (data/ dir).
+    """
+    size = 0
+
+    for root, dirs, files in os.walk(f"{repository}/data"):
+        for name in files:
+            try:
+                size += os.stat(f"{root}/{name}").st_size
+            except OSError:
+                pass
+
+    return size
+
+
+def plan(state: dict,
+         parts: int = 0,
+         budget: float = 0,
+         size: int = 0) -> tuple:
+    """
+    Return the (part, parts) of the repository data to read this time.
+
+    In rotate mode, parts is given. In time budget mode, parts is the
+    number of parts of the repository data size which can be read in the
+    budget (seconds), at the last measured read rate, at most MAX_PARTS :
+    a part of a large repository may then take longer than the budget.
+    When parts changes, the current position is rescaled to stay at the
+    same point of the cycle.
+    """
+    if budget:
+        if not state['read_rate']:
+            # Nothing measured yet : start with a small part
+            parts = max(state['parts'], 100)
+        else:
+            parts = math.ceil(size / (state['read_rate'] * budget))
+
+    parts = min(max(parts, 1), MAX_PARTS)
+
+    part = state['part']
+    if state['parts'] and parts != state['parts']:
+        part = (part - 1) * parts // state['parts'] + 1
+
+    return min(max(part, 1), parts), parts
+
+
+def advance(state: dict,
+            part: int,
+            parts: int,
+            read_bytes: int = 0,
+            duration: float = 0) -> dict:
+    """
+    Move to the next part after a successful check, and update the read
+    rate (moving average) with the bytes read during duration seconds.
+    """
+    state = dict(state)
+    state['part'] = part % parts + 1
+    state['parts'] = parts
+
+    if read_bytes and duration:
+        rate = read_bytes / duration
+        old = state.get('read_rate') or rate
+        state['read_rate'] = (old + rate) / 2
+
+    return state
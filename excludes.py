@@ -0,0 +1,293 @@
+# Exclude rules engine
+#
+# Compiles the exclude settings (literal paths, restic glob patterns,
+# regexes, per-source rules) once, validates them, renders the restic
+# exclude file (only rewritten when its content changes), and previews
+# how many files and bytes each rule removes from the backup sources.
+
+import hashlib
+import os
+import re
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+CACHEDIR_TAG = "CACHEDIR.TAG"
+CACHEDIR_SIGNATURE = b"Signature: 8a477f597d28d172789f06886806bc55"
+
+
+def glob_to_regex(pattern: str) -> str:
+    """
+    Translate a restic exclude pattern to a regex matching full paths.
+    "*" and "?" don't match "/", "**" matches any number of directories.
+    A pattern not starting with "/" matches at any depth.
+
+    Example :
+    glob_to_regex("*.tmp") -> '^(?:.*/)?[^/]*\\.tmp$'
+    """
+    anchored = pattern.startswith("/")
+    pattern = pattern.strip("/")
+    regex = ""
+    i = 0
+
+    while i < len(pattern):
+        c = pattern[i]
+
+        if pattern.startswith("**/", i):
+            regex += "(?:.*/)?"
+            i += 3
+            continue
+        if pattern.startswith("**", i):
+            regex += ".*"
+            i += 2
+            continue
+
+        if c == "*":
+            regex += "[^/]*"
+        elif c == "?":
+            regex += "[^/]"
+        elif c == "[":
+            end = pattern.find("]", i + 1)
+            if end < 0:
+                raise ValueError(f"Unclosed [ in exclude pattern : {pattern}")
+            cls = pattern[i + 1:end]
+            if cls.startswith(("!", "^")):
+                cls = "^" + cls[1:]
+            regex += f"[{cls}]"
+            i = end
+        else:
+            regex += re.escape(c)
+        i += 1
+
+    return f"^/{regex}$" if anchored else f"^(?:.*/)?{regex}$"
+
+
+def compile_rules(ignore: list,
+                  rules: list,
+                  sources: list) -> list:
+    """
+    Compile the exclude settings : literal paths (DATA_TO_IGNORE) and
+    rules (EXCLUDES) dicts with a 'pattern' (restic glob) or a 'regex',
+    and an optional 'source' the rule applies to (the pattern being
+    relative to it). Raises ValueError on invalid rules.
+
+    Returns a list of dicts :
+    [{'name': 'regex .*/node_modules', 'regex': re.Pattern,
+      'source': '/data', 'restic': None}, ...]
+    where 'restic' is the exclude file line, None for regexes
+    (restic has none : matching paths are listed instead).
+    """
+    compiled = []
+    sources = [src.rstrip("/") or "/" for src in sources]
+
+    for path in ignore:
+        path = path.rstrip("/") or "/"
+        compiled.append({'name': f"path {path}",
+                         'regex': re.compile(f"^{re.escape(path)}$"),
+                         'source': None,
+                         'restic': path})
+
+    for rule in rules:
+        source = rule.get('source')
+
+        if source is not None:
+            source = source.rstrip("/") or "/"
+            if source not in sources:
+                raise ValueError(f"Exclude rule {rule} : {source} is not a backup source")
+
+        if 'pattern' in rule:
+            pattern = rule['pattern']
+            if source:
+                pattern = f"{source.rstrip('/')}/{pattern.lstrip('/')}"
+            compiled.append({'name': f"pattern {pattern}",
+                             'regex': re.compile(glob_to_regex(pattern)),
+                             'source': source,
+                             'restic': pattern.rstrip("/")})
+
+        elif 'regex' in rule:
+            try:
+                regex = re.compile(rule['regex'])
+            except re.error as e:
+                raise ValueError(f"Exclude rule {rule} : invalid regex ({e})")
+            compiled.append({'name': f"regex {rule['regex']}",
+                             'regex': regex,
+                             'source': source,
+                             'restic': None})
+
+        else:
+            raise ValueError(f"Exclude rule {rule} : needs a 'pattern' or a 'regex'")
+
+    return compiled
+
+
+def match(rules: list,
+          path: str) -> dict:
+    """
+    Return the first rule excluding path, None if it's kept.
+    """
+    for rule in rules:
+        # A "/" source prefixes every path
+        if rule['source'] and not path.startswith(rule['source'].rstrip("/") + "/"):
+            continue
+
+        if rule['restic'] is None:
+            if rule['regex'].search(path):
+                return rule
+        elif rule['regex'].match(path):
+            return rule
+
+    return None
+
+
+def is_cache_dir(path: str) -> bool:
+    try:
+        with open(f"{path}/{CACHEDIR_TAG}", 'rb') as file:
+            return file.read(len(CACHEDIR_SIGNATURE)) == CACHEDIR_SIGNATURE
+    except OSError:
+        return False
+
+
+def walk(sources: list,
+         visit,
+         workers: int = 4):
+    """
+    Walk the sources with parallel os.scandir() calls. visit(path, entry,
+    context) is called for every entry, and returns the context to pass
+    when scanning it if it's a directory to walk, or False to skip it.
+    """
+    def scan(path, context):
+        subdirs = []
+        try:
+            with os.scandir(path) as it:
+                for entry in it:
+                    sub_context = visit(path, entry, context)
+                    if sub_context is not False \
+                    and entry.is_dir(follow_symlinks=False):
+                        subdirs.append((entry.path, sub_context))
+        except OSError:
+            pass
+        return subdirs
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        pending = {pool.submit(scan, src, None) for src in sources}
+
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for fut in done:
+                for sub in fut.result():
+                    pending.add(pool.submit(scan, *sub))
+
+
+def expand_regex(rules: list,
+                 sources: list,
+                 workers: int = 4) -> list:
+    """
+    List the paths matched by the regex rules (restic has no regex
+    excludes), without walking into the excluded directories.
+    """
+    if all(rule['restic'] is not None for rule in rules):
+        return []
+
+    matched = []
+
+    def visit(parent, entry, context):
+        rule = match(rules, entry.path)
+        if rule is None:
+            return None
+        if rule['restic'] is None:
+            matched.append(entry.path)
+        return False
+
+    walk(sources, visit, workers)
+
+    return sorted(matched)
+
+
+def render(rules: list,
+           regex_paths: list) -> str:
+    """
+    Render the restic exclude file content.
+    """
+    lines = [rule['restic'] for rule in rules if rule['restic'] is not None]
+
+    # Literal paths : escape restic pattern characters
+    lines += [re.sub(r'([*?\[\]\\])', r'\\\1', path) for path in regex_paths]
+
+    return "\n".join(lines) + "\n"
+
+
+def write_if_changed(path: str,
+                     content: str) -> bool:
+    """
+    Write the exclude file only if its content hash changed, so the
+    repository drive isn't written to on every run. Returns True if written.
+    """
+    digest = hashlib.sha256(content.encode()).hexdigest()
+
+    try:
+        with open(path, 'rb') as file:
+            if hashlib.sha256(file.read()).hexdigest() == digest:
+                return False
+    except FileNotFoundError:
+        pass
+
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as file:
+        file.write(content)
+    os.replace(tmp_path, path)
+
+    return True
+
+
+def preview(rules: list,
+            sources: list,
+            larger_than: int = 0,
+            caches: bool = False,
+            workers: int = 4) -> dict:
+    """
+    Walk the sources and count the files and bytes each rule removes.
+
+    Returns a dict {rule name: [files, bytes]}, with the kept files
+    and bytes under the None key. Every rule is listed, even when it
+    matches nothing. The contents of an excluded directory are counted
+    for the rule excluding it.
+    """
+    counts = {rule['name']: [0, 0] for rule in rules}
+    if larger_than:
+        counts[f"larger than {larger_than} bytes"] = [0, 0]
+    if caches:
+        counts["cache directories"] = [0, 0]
+    counts[None] = [0, 0]
+
+    lock = threading.Lock()
+
+    def add(name, size):
+        with lock:
+            counts[name][0] += 1
+            counts[name][1] += size
+
+    def visit(parent, entry, context):
+        is_dir = entry.is_dir(follow_symlinks=False)
+
+        if context is None:
+            rule = match(rules, entry.path)
+            if rule:
+                context = rule['name']
+            elif caches and is_dir and is_cache_dir(entry.path):
+                context = "cache directories"
+
+        if not is_dir:
+            try:
+                size = entry.stat(follow_symlinks=False).st_size
+            except OSError:
+                size = 0
+
+            if context is None and larger_than and size > larger_than:
+                add(f"larger than {larger_than} bytes", size)
+            else:
+                add(context, size)
+
+        return context
+
+    walk(sources, visit, workers)
+
+    return counts
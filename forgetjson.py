@@ -0,0 +1,91 @@
+# Streaming parser for restic forget --json output
+#
+# restic forget prints one single JSON array of snapshot groups, each
+# listing every kept and removed snapshot with its full paths. Instead of
+# loading the whole output then the whole object tree, the groups are
+# decoded one at a time from a growing buffer and reduced to their counts,
+# so memory is bounded by the biggest group, not the whole output.
+
+import json
+from collections import deque
+
+CHUNK_SIZE = 1024 * 1024
+
+_decoder = json.JSONDecoder()
+
+
+def parse(stream,
+          chunk_size: int = CHUNK_SIZE) -> dict:
+    """
+    Parse a restic forget --json output from a text stream.
+
+    Returns a dict :
+    {'keep': 12, 'remove': 3, 'removed_ids': ['4f5e...', ...],
+     'groups': [{'host': 'host', 'paths': ['/data'], 'tags': ['tag'],
+                 'keep': 6, 'remove': 1}, ...],
+     'text': deque([... last lines after the JSON array (prune output) ...])}
+    """
+    res = {'keep': 0,
+           'remove': 0,
+           'removed_ids': [],
+           'groups': [],
+           'text': deque(maxlen=50)}
+
+    buf = ""
+    pos = 0
+    eof = False
+    in_array = False
+    # Don't retry decoding an incomplete group before the buffer doubled
+    retry_size = 0
+
+    while True:
+        # Skip separators between groups
+        while pos < len(buf) and buf[pos] in " \t\r\n,[":
+            if buf[pos] == "[":
+                in_array = True
+            pos += 1
+
+        if pos < len(buf) and (buf[pos] == "]" or not in_array):
+            rest = buf[pos + 1:] if buf[pos] == "]" else buf[pos:]
+            text = rest + stream.read()
+            res['text'].extend(line for line in text.splitlines() if line.strip())
+            return res
+
+        if pos < len(buf) and len(buf) - pos >= retry_size:
+            try:
+                group, end = _decoder.raw_decode(buf, pos)
+            except json.JSONDecodeError:
+                if eof:
+                    raise
+                retry_size = 2 * (len(buf) - pos)
+            else:
+                add_group(res, group)
+                buf = buf[end:]
+                pos = 0
+                retry_size = 0
+                continue
+
+        if eof:
+            return res
+
+        chunk = stream.read(chunk_size)
+        if not chunk:
+            eof = True
+            retry_size = 0
+        buf = buf[pos:] + chunk
+        pos = 0
+
+
+def add_group(res: dict,
+              group: dict):
+    keep = len(group.get('keep') or [])
+    remove = len(group.get('remove') or [])
+
+    res['keep'] += keep
+    res['remove'] += remove
+    res['removed_ids'] += [snap['id'] for snap in group.get('remove') or [] if 'id' in snap]
+    res['groups'].append({'host': group.get('host'),
+                          'paths': group.get('paths') or [],
+                          'tags': group.get('tags') or [],
+                          'keep': keep,
+                          'remove': remove})
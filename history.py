@@ -0,0 +1,150 @@
+# Local run history database
+#
+# Every backup/check/forget run is stored in a SQLite database, with
+# the parsed restic summary, so throughput trends can be computed and
+# runs far outside the recent baseline flagged (dying disk, exclude
+# mistake...).
+
+import json
+import os
+import sqlite3
+import time
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (
+    id INTEGER PRIMARY KEY,
+    started REAL NOT NULL,
+    job TEXT NOT NULL,
+    returncode INTEGER NOT NULL,
+    duration REAL NOT NULL,
+    bytes_processed INTEGER,
+    files_processed INTEGER,
+    data_added INTEGER,
+    summary TEXT
+);
+CREATE INDEX IF NOT EXISTS runs_job_started ON runs (job, started);
+"""
+
+
+def connect(db_path: str) -> sqlite3.Connection:
+    os.makedirs(os.path.dirname(db_path), exist_ok=True)
+    con = sqlite3.connect(db_path, timeout=30)
+    con.row_factory = sqlite3.Row
+    con.executescript(SCHEMA)
+    return con
+
+
+def add(db_path: str,
+        job: str,
+        returncode: int,
+        duration: float,
+        summary: dict = None):
+    """
+    Store a run. summary is the restic summary (or merged summaries),
+    its total_bytes_processed, total_files_processed and data_added
+    values are also stored in their own columns for trend queries.
+
+    Example :
+    add("/var/lib/resticbak/history.db", "check", 0, 42.1)
+    """
+    summary = summary or {}
+
+    try:
+        with connect(db_path) as con:
+            con.execute("INSERT INTO runs (started, job, returncode, duration, "
+                        "bytes_processed, files_processed, data_added, summary) "
+                        "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                        (time.time() - duration, job, returncode, duration,
+                         summary.get('total_bytes_processed'),
+                         summary.get('total_files_processed'),
+                         summary.get('data_added'),
+                         json.dumps(summary)))
+        con.close()
+
+    # History must never make a backup job fail
+    except (OSError, sqlite3.Error) as e:
+        print(f"Failed to store run history in {db_path} : {e}")
+
+
+def runs(db_path: str,
+         job: str = None,
+         limit: int = 20) -> list:
+    """
+    Return the last runs (newest first), optionally for one job only.
+    """
+    con = connect(db_path)
+    query = "SELECT * FROM runs"
+    params = ()
+
+    if job:
+        query += " WHERE job = ?"
+        params = (job,)
+
+    rows = con.execute(f"{query} ORDER BY started DESC LIMIT ?",
+                       params + (limit,)).fetchall()
+    con.close()
+
+    return [dict(row) for row in rows]
+
+
+def rates(run: dict) -> tuple:
+    """
+    Return the (bytes/s, files/s) throughput of a backup run,
+    (None, None) if it has no summary (failed or skipped run).
+    """
+    if run['returncode'] != 0 or run['bytes_processed'] is None or not run['duration']:
+        return None, None
+
+    return run['bytes_processed'] / run['duration'], \
+           run['files_processed'] / run['duration']
+
+
+def outlier(value: float,
+            baseline: list,
+            threshold: float) -> bool:
+    """
+    True if value is more than threshold robust deviations (median
+    absolute deviation, floored to 10% of the median) away from the
+    baseline median.
+    """
+    import statistics
+
+    if value is None or len(baseline) < 5:
+        return False
+
+    med = statistics.median(baseline)
+    mad = statistics.median(abs(v - med) for v in baseline) * 1.4826
+    scale = max(mad, abs(med) * 0.1, 1)
+
+    return abs(value - med) / scale > threshold
+
+
+def anomalies(db_path: str,
+              window: int,
+              threshold: float,
+              limit: int = 20) -> dict:
+    """
+    Check the last backup runs against the previous successful ones.
+
+    Returns a dict {run id: ["throughput", "data_added"...]} for the runs
+    whose throughput or data added falls outside the rolling baseline
+    of the window previous runs.
+    """
+    backups = [run for run in runs(db_path, "backup", limit + window)
+               if rates(run)[0] is not None]
+    flags = {}
+
+    for i, run in enumerate(backups[:limit]):
+        previous = backups[i + 1:i + 1 + window]
+        reasons = []
+
+        if outlier(rates(run)[0], [rates(r)[0] for r in previous], threshold):
+            reasons.append("throughput")
+
+        if outlier(run['data_added'], [r['data_added'] for r in previous], threshold):
+            reasons.append("data_added")
+
+        if reasons:
+            flags[run['id']] = reasons
+
+    return flags
@@ -0,0 +1,104 @@
+# Host-local job lock
+#
+# Jobs take a flock() lock on one lock file per repository before running
+# restic, shared for jobs which can run together (backups), exclusive for
+# the others (check, forget, prune). A job started while an incompatible
+# one runs waits for it, up to a maximum time, instead of failing on the
+# restic repository lock. An exclusive job waiting holds a second "wait"
+# lock file which the shared jobs go through first, so a stream of
+# overlapping backups can't starve it.
+
+import fcntl
+import os
+import time
+import zlib
+from contextlib import contextmanager
+
+POLL_INTERVAL = 1
+
+
+def lock_path(lock_dir: str,
+              repository: str) -> str:
+    """
+    Lock file path for a repository, ex : /run/lock/resticbak-3f2a9c1b.lock
+    """
+    digest = zlib.crc32(os.path.abspath(repository).encode())
+    return f"{lock_dir}/resticbak-{digest:08x}.lock"
+
+
+def open_lock(path: str) -> int:
+    """
+    Open the lock file read only (enough for flock), creating it readable
+    by everyone : other users' jobs must be able to open it too, whatever
+    the umask of the one creating it. An existing file is opened without
+    O_CREAT, refused on another user's file in a sticky directory like
+    /run/lock (fs.protected_regular).
+    """
+    while True:
+        try:
+            return os.open(path, os.O_RDONLY)
+        except FileNotFoundError:
+            pass
+
+        try:
+            fd = os.open(path, os.O_RDONLY | os.O_CREAT | os.O_EXCL, 0o644)
+        except FileExistsError:
+            # Created by another job meanwhile
+            continue
+
+        os.fchmod(fd, 0o644)
+        return fd
+
+
+def acquire(fd: int,
+            mode: int,
+            start: float,
+            max_wait: float):
+    """
+    flock() fd, polling until max_wait seconds after start
+    (TimeoutError then).
+    """
+    while True:
+        try:
+            fcntl.flock(fd, mode | fcntl.LOCK_NB)
+            return
+        except BlockingIOError:
+            if time.monotonic() - start > max_wait:
+                raise TimeoutError(f"Repository lock not acquired after {max_wait:.0f}s")
+            time.sleep(POLL_INTERVAL)
+
+
+@contextmanager
+def hold(path: str,
+         exclusive: bool,
+         max_wait: float):
+    """
+    Hold the lock for the with block, waiting at most max_wait seconds
+    for it (TimeoutError otherwise). Yields the seconds waited.
+
+    Example :
+    with hold("/run/lock/resticbak-3f2a9c1b.lock", True, 3600) as waited:
+        ...
+    """
+    mode = fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH
+    start = time.monotonic()
+
+    fd = open_lock(path)
+    try:
+        wait_fd = open_lock(f"{path}.wait")
+    except BaseException:
+        os.close(fd)
+        raise
+
+    try:
+        # Exclusive jobs hold the wait lock until they get the job lock,
+        # shared jobs only pass through it : none starts meanwhile
+        acquire(wait_fd, mode, start, max_wait)
+        acquire(fd, mode, start, max_wait)
+        fcntl.flock(wait_fd, fcntl.LOCK_UN)
+
+        yield time.monotonic() - start
+
+    finally:
+        os.close(wait_fd)
+        os.close(fd)
@@ -0,0 +1,95 @@
+# Prometheus node_exporter textfile collector export
+#
+# Each job (backup, check, forget) writes its own resticbak_<job>.prom
+# file, atomically (temp file + rename) so node_exporter never reads
+# a partially written file.
+
+import os
+import re
+import tempfile
+import time
+
+PREFIX = "resticbak"
+
+HELP = {
+    'job_exit_status': "Return code of the last run",
+    'job_duration_seconds': "Wall clock duration of the last run",
+    'job_last_run_timestamp_seconds': "Unix time of the last run",
+    'job_last_success_timestamp_seconds': "Unix time of the last successful run",
+    'job_errors': "Per-path errors reported by restic during the last run",
+}
+
+
+def write(directory: str,
+          job: str,
+          returncode: int,
+          duration: float,
+          values: dict = None,
+          help: dict = None):
+    """
+    Write the metrics of a job run to <directory>/resticbak_<job>.prom.
+
+    values are extra gauges, named without prefix, ex :
+    {'backup_data_added_bytes': 1234}, with an optional help dict
+    {'backup_data_added_bytes': "Bytes added to the repository"}.
+    None values (like the last success timestamp when the run failed)
+    are carried over from the previous file.
+
+    Example :
+    write("/var/lib/node_exporter/textfile_collector", "check", 0, 42.1)
+    """
+    if not directory:
+        return
+
+    path = f"{directory}/{PREFIX}_{job}.prom"
+    now = time.time()
+
+    gauges = {'job_exit_status': returncode,
+              'job_duration_seconds': duration,
+              'job_last_run_timestamp_seconds': now,
+              'job_last_success_timestamp_seconds': now if returncode == 0 else None}
+    gauges.update(values or {})
+    helps = dict(HELP, **(help or {}))
+
+    lines = []
+    for name, value in gauges.items():
+        if value is None:
+            value = read_value(path, f"{PREFIX}_{name}")
+        if value is None:
+            continue
+        lines.append(f"# HELP {PREFIX}_{name} {helps.get(name, name)}")
+        lines.append(f"# TYPE {PREFIX}_{name} gauge")
+        lines.append(f'{PREFIX}_{name}{{job="{job}"}} {value}')
+
+    try:
+        os.makedirs(directory, exist_ok=True)
+
+        # Unique temp file : jobs write metrics from several threads
+        fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=f".{PREFIX}_{job}.", suffix=".tmp")
+        os.fchmod(fd, 0o644)
+
+        with open(fd, 'w', encoding='utf-8') as file:
+            file.write("\n".join(lines) + "\n")
+
+        os.replace(tmp_path, path)
+
+    # Metrics must never make a backup job fail
+    except OSError as e:
+        print(f"Failed to write metrics file {path} : {e}")
+
+
+def read_value(path: str,
+               name: str) -> float:
+    """
+    Read a gauge value from an existing .prom file, None if not found.
+    """
+    try:
+        with open(path, encoding='utf-8') as file:
+            for line in file:
+                m = re.match(rf'{name}{{[^}}]*}} (\S+)$', line)
+                if m:
+                    return float(m.group(1))
+    except (OSError, ValueError):
+        pass
+
+    return None
@@ -0,0 +1,197 @@
+# Spooled Signal notifications
+#
+# Messages are first written to an on-disk outbox, then delivered by a
+# background thread with a pooled HTTP session, strict timeouts and
+# exponential backoff retries. Messages which can't be delivered stay in
+# the outbox and are flushed by the next run, so a hung or stopped
+# signal-cli daemon neither blocks a job nor loses its alerts.
+
+import atexit
+import fcntl
+import json
+import os
+import threading
+import time
+
+TIMEOUT = (3, 10)   # Connect, read timeouts (seconds)
+RETRIES = 4         # Delivery attempts per message and per run
+BACKOFF = 2         # First retry delay (seconds), doubled each attempt
+MAX_AGE = 7 * 86400 # Undelivered messages older than this are dropped
+
+_thread = None
+_running = False    # The sender hasn't decided to stop yet
+_wakeup = False     # Messages enqueued since its last outbox scan
+_lock = threading.Lock()
+
+
+def enqueue(outbox_dir: str,
+            url: str,
+            receiver: str,
+            msg: str) -> str:
+    """
+    Atomically write a message to the outbox. Returns the message file path.
+    """
+    os.makedirs(outbox_dir, exist_ok=True)
+
+    name = f"{time.time_ns()}-{os.getpid()}.json"
+    tmp_path = f"{outbox_dir}/.{name}.tmp"
+
+    with open(tmp_path, 'w', encoding='utf-8') as file:
+        json.dump({'url': url,
+                   'receiver': receiver,
+                   'msg': msg,
+                   'created': time.time()}, file)
+
+    os.replace(tmp_path, f"{outbox_dir}/{name}")
+
+    return f"{outbox_dir}/{name}"
+
+
+def start(outbox_dir: str,
+          exit_wait: float):
+    """
+    Start the background sender if it's not running, and make the
+    interpreter wait at most exit_wait seconds for it at exit.
+    """
+    global _thread, _running, _wakeup
+
+    with _lock:
+        # A running sender scans the outbox again before stopping
+        _wakeup = True
+        if _running:
+            return
+
+        _running = True
+        _thread = threading.Thread(target=flush,
+                                   args=(outbox_dir,),
+                                   daemon=True)
+        _thread.start()
+
+    atexit.unregister(wait)
+    atexit.register(wait, exit_wait)
+
+
+def wait(timeout: float):
+    """
+    Wait at most timeout seconds for the background sender to finish.
+    """
+    if _thread and _thread.is_alive():
+        _thread.join(timeout)
+
+        if _thread.is_alive():
+            print("Notifications not delivered yet, they will be sent on next run")
+
+
+def flush(outbox_dir: str):
+    """
+    Deliver the outbox messages, oldest first, until it's empty or a
+    message failed all its attempts (daemon unreachable : the remaining
+    ones are kept for the next run). Only one process at a time flushes
+    a given outbox (flock).
+    """
+    global _running, _wakeup
+
+    import requests
+
+    try:
+        os.makedirs(outbox_dir, exist_ok=True)
+
+        with open(f"{outbox_dir}/.lock", 'w') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+
+            with requests.Session() as session:
+                while True:
+                    with _lock:
+                        _wakeup = False
+
+                    pending = sorted(name for name in os.listdir(outbox_dir)
+                                     if name.endswith(".json"))
+
+                    # Stop, unless a message was enqueued since the scan
+                    # (start() sees _running and doesn't start a sender)
+                    if not pending:
+                        with _lock:
+                            if not _wakeup:
+                                _running = False
+                                return
+                        continue
+
+                    for name in pending:
+                        if not deliver(session, f"{outbox_dir}/{name}"):
+                            with _lock:
+                                _running = False
+                            return
+    except BaseException:
+        with _lock:
+            _running = False
+        raise
+
+
+def deliver(session,
+            path: str) -> bool:
+    """
+    Send one outbox message, with retries. The message file is removed
+    once sent, or when the failure is permanent (rejected by the daemon,
+    too old). Returns False if it must be retried on a next run.
+    """
+    import requests
+
+    try:
+        with open(path, encoding='utf-8') as file:
+            message = json.load(file)
+    except FileNotFoundError:
+        return True
+    except ValueError:
+        os.remove(path)
+        return True
+
+    if time.time() - message['created'] > MAX_AGE:
+        print(f"Dropping undelivered notification from {time.ctime(message['created'])}")
+        os.remove(path)
+        return True
+
+    payload = {
+        'jsonrpc': '2.0',
+        'method': 'send',
+        'params': {
+            'recipient': [message['receiver']],
+            'message': f"Resticbak notifier\n{message['msg']}"
+        },
+        'id': 1
+    }
+
+    delay = BACKOFF
+
+    for attempt in range(RETRIES):
+        if attempt:
+            time.sleep(delay)
+            delay *= 2
+
+        try:
+            response = session.post(message['url'],
+                                    json=payload,
+                                    timeout=TIMEOUT)
+        except (requests.ConnectionError, requests.Timeout):
+            print("Connection error, check if Signal daemon is running.")
+            continue
+
+        if response.status_code >= 500:
+            print(f"Failed to send notification (code {response.status_code})")
+            continue
+
+        try:
+            rpc_error = 'error' in response.json()
+        except ValueError:
+            rpc_error = True
+
+        if response.status_code == 200 and not rpc_error:
+            print("Notification sent")
+        else:
+            # Permanent failure (bad request, unknown recipient...)
+            print(f"Notification rejected (code {response.status_code})")
+            print('Response:', response.text)
+
+        os.remove(path)
+        return True
+
+    return False
@@ -0,0 +1,204 @@
+# Local repository pack verifier
+#
+# restic names each pack file of data/ after the SHA-256 of its contents,
+# so bit rot in a local repository is found by hashing the packs, without
+# restic loading its index. Packs are hashed by a process pool (memory
+# mapped, large block reads), and the verified ones are recorded in a
+# SQLite database (with their size and mtime) : each run hashes the new
+# and unverified packs first, then rotates through the oldest verified
+# ones until its time budget is used.
+
+import concurrent.futures
+import hashlib
+import mmap
+import os
+import sqlite3
+import time
+
+BLOCK_SIZE = 16 * 1024 ** 2  # Bytes hashed per update
+COMMIT_EVERY = 200           # Results stored per transaction
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS packs (
+    name TEXT PRIMARY KEY,
+    size INTEGER NOT NULL,
+    mtime REAL NOT NULL,
+    verified REAL,
+    ok INTEGER
+) WITHOUT ROWID;
+"""
+
+
+def connect(db_path: str) -> sqlite3.Connection:
+    os.makedirs(os.path.dirname(db_path), exist_ok=True)
+    con = sqlite3.connect(db_path, timeout=30)
+    con.row_factory = sqlite3.Row
+    con.executescript(SCHEMA)
+    return con
+
+
+def list_packs(repository: str) -> dict:
+    """
+    Pack files of a local repository, ex :
+    {'4f5e...': ('/srv/restic/data/4f/4f5e...', 16777216, 1725600000.0)}
+    """
+    packs = {}
+
+    try:
+        dirs = list(os.scandir(f"{repository}/data"))
+    except FileNotFoundError:
+        return packs
+
+    for subdir in dirs:
+        if not subdir.is_dir():
+            continue
+        for entry in os.scandir(subdir.path):
+            # Skip temporary files, only packs are named after their hash
+            if len(entry.name) != 64 or not entry.is_file():
+                continue
+            st = entry.stat()
+            packs[entry.name] = (entry.path, st.st_size, st.st_mtime)
+
+    return packs
+
+
+def hash_pack(path: str) -> str:
+    """
+    SHA-256 (hex) of a file, memory mapped and hashed in BLOCK_SIZE blocks.
+    Runs in the pool worker processes.
+    """
+    digest = hashlib.sha256()
+
+    with open(path, 'rb') as file:
+        if os.fstat(file.fileno()).st_size == 0:
+            return digest.hexdigest()
+
+        with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            if hasattr(mmap, 'MADV_SEQUENTIAL'):
+                data.madvise(mmap.MADV_SEQUENTIAL)
+            view = memoryview(data)
+            try:
+                for offset in range(0, len(data), BLOCK_SIZE):
+                    digest.update(view[offset:offset + BLOCK_SIZE])
+            finally:
+                view.release()
+
+    return digest.hexdigest()
+
+
+def plan(con: sqlite3.Connection,
+         packs: dict) -> tuple:
+    """
+    Order the packs to hash : new, changed (size or mtime) and corrupt
+    ones first, then the verified ones, least recently verified first.
+    Records of the packs gone from the repository are dropped.
+    Returns (names, count of the unverified ones).
+    """
+    records = {row['name']: row for row in con.execute("SELECT * FROM packs")}
+
+    gone = [(name,) for name in records if name not in packs]
+    with con:
+        con.executemany("DELETE FROM packs WHERE name = ?", gone)
+
+    unverified = []
+    verified = []
+
+    for name, (path, size, mtime) in packs.items():
+        row = records.get(name)
+        if row and row['ok'] and row['size'] == size and row['mtime'] == mtime:
+            verified.append((row['verified'], name))
+        else:
+            unverified.append(name)
+
+    return unverified + [name for _, name in sorted(verified)], len(unverified)
+
+
+def verify(db_path: str,
+           repository: str,
+           budget: float = 0,
+           workers: int = 0,
+           on_result=None) -> dict:
+    """
+    Hash the packs of a local repository in workers processes (0 : one
+    per CPU), in plan() order. No pack is started once budget seconds
+    are spent (0 : no limit). on_result is called with (name, size, ok)
+    after each pack.
+
+    Returns a report, ex :
+    {'packs': 5120, 'checked': 830, 'bytes': 13925089280, 'duration': 3598.2,
+     'corrupt': ['4f5e...'], 'missing': [], 'errors': {}, 'unverified': 0,
+     'oldest': 1725600000.0}
+    where unverified is the packs left to hash first next time (new,
+    changed or corrupt), and oldest the oldest verification time of the
+    others.
+
+    Example :
+    verify("/var/lib/resticbak/packs.db", "/srv/restic", budget=3600)
+    """
+    start = time.monotonic()
+    packs = list_packs(repository)
+    con = connect(db_path)
+    order, _ = plan(con, packs)
+
+    report = {'packs': len(packs), 'checked': 0, 'bytes': 0,
+              'corrupt': [], 'missing': [], 'errors': {}}
+    pending = iter(order)
+    running = {}
+    workers = workers or os.cpu_count()
+
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as pool:
+
+        def submit() -> bool:
+            if budget and time.monotonic() - start >= budget:
+                return False
+            name = next(pending, None)
+            if name is None:
+                return False
+            running[pool.submit(hash_pack, packs[name][0])] = name
+            return True
+
+        # One pack hashed and one queued per worker, no more
+        for _ in range(2 * workers):
+            if not submit():
+                break
+
+        while running:
+            finished, _ = concurrent.futures.wait(running,
+                                                  return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in finished:
+                name = running.pop(future)
+                path, size, mtime = packs[name]
+                submit()
+
+                try:
+                    ok = future.result() == name
+                except FileNotFoundError:
+                    # Removed by a prune meanwhile
+                    report['missing'].append(name)
+                    con.execute("DELETE FROM packs WHERE name = ?", (name,))
+                    del packs[name]
+                    continue
+                except OSError as e:
+                    report['errors'][name] = str(e)
+                    continue
+
+                con.execute("INSERT OR REPLACE INTO packs VALUES (?, ?, ?, ?, ?)",
+                            (name, size, mtime, time.time(), int(ok)))
+                report['checked'] += 1
+                report['bytes'] += size
+                if not ok:
+                    report['corrupt'].append(name)
+                if on_result:
+                    on_result(name, size, ok)
+
+                if report['checked'] % COMMIT_EVERY == 0:
+                    con.commit()
+
+    con.commit()
+    _, report['unverified'] = plan(con, packs)
+    row = con.execute("SELECT MIN(verified) AS oldest FROM packs WHERE ok = 1").fetchone()
+    report['oldest'] = row['oldest']
+    report['duration'] = time.monotonic() - start
+    con.close()
+
+    return report
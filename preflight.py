@@ -0,0 +1,140 @@
+# Repository commands preflight
+#
+# Finds the restic binary and its version (cached with a TTL), and removes
+# only the stale locks of a local repository : locks not refreshed for a
+# long time, or held by a dead process of this host. Live locks from other
+# running jobs are left alone, and the repository isn't opened at all
+# when it has no lock.
+
+import json
+import os
+import runner
+import shutil
+import socket
+import statefile
+import subprocess
+import time
+
+# restic refreshes its locks every 5 minutes, and considers them
+# stale after 30 minutes
+LOCK_MAX_AGE = 30 * 60
+
+
+def restic_info(cache_path: str,
+                ttl: float) -> dict:
+    """
+    Return {'path': '/usr/bin/restic', 'version': 'restic 0.17.0 ...'},
+    from the cache if younger than ttl seconds and the binary didn't change.
+    None if restic is not found.
+    """
+    path = shutil.which("restic")
+
+    if not path:
+        return None
+
+    mtime = os.stat(path).st_mtime
+
+    cache = statefile.load(cache_path, {})
+
+    try:
+        if cache['path'] == path and cache['mtime'] == mtime \
+        and time.time() - cache['checked'] < ttl:
+            return cache
+    except (KeyError, TypeError):
+        pass
+
+    p = subprocess.run([path, "version"],
+                       stdout=subprocess.PIPE,
+                       stderr=subprocess.DEVNULL,
+                       text=True)
+
+    cache = {'path': path,
+             'mtime': mtime,
+             'version': p.stdout.strip(),
+             'checked': time.time()}
+
+    statefile.save(cache_path, cache)
+
+    return cache
+
+
+def read_lock(lock_id: str) -> dict:
+    """
+    Decrypt a lock with restic, ex : {'time': '2024-09-06T10:00:00.123456789+02:00',
+    'exclusive': False, 'hostname': 'host', 'pid': 1234, ...}
+    None if it can't be read (already removed...).
+    """
+    p = subprocess.run(["restic", "cat", "lock", lock_id, "--no-lock", "--json"],
+                       stdout=subprocess.PIPE,
+                       stderr=subprocess.DEVNULL,
+                       text=True)
+
+    if p.returncode != 0:
+        return None
+
+    try:
+        return json.loads(p.stdout)
+    except ValueError:
+        return None
+
+
+def pid_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+
+    return True
+
+
+def stale_locks(repository: str,
+                max_age: float = LOCK_MAX_AGE) -> list:
+    """
+    Return the IDs of the stale locks of a local repository.
+
+    The lock files modification time is checked first : locks older than
+    max_age are stale. Younger ones are decrypted (restic cat lock) to
+    check if they belong to a dead process of this host.
+    """
+    locks_dir = f"{repository}/locks"
+    stale = []
+    now = time.time()
+    hostname = socket.gethostname()
+
+    try:
+        lock_ids = os.listdir(locks_dir)
+    except FileNotFoundError:
+        return stale
+
+    for lock_id in lock_ids:
+        try:
+            age = now - os.stat(f"{locks_dir}/{lock_id}").st_mtime
+        except FileNotFoundError:
+            continue
+
+        if age > max_age:
+            stale.append(lock_id)
+            continue
+
+        lock = read_lock(lock_id)
+
+        if lock is None:
+            continue
+
+        if now - runner.parse_time(lock['time']) > max_age \
+        or (lock['hostname'] == hostname and not pid_alive(lock['pid'])):
+            stale.append(lock_id)
+
+    return stale
+
+
+def remove_locks(repository: str,
+                 lock_ids: list):
+    for lock_id in lock_ids:
+        try:
+            os.remove(f"{repository}/locks/{lock_id}")
+            print(f"Removed stale lock {lock_id[:8]}")
+        except FileNotFoundError:
+            pass
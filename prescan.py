@@ -0,0 +1,124 @@
+# Backup sources pre-scan
+#
+# Walks the backup sources with parallel os.scandir() calls and computes
+# a fingerprint of their metadata (size, mtime, ctime, inode) so a backup
+# can be skipped when nothing changed since the last successful snapshot,
+# without paying for restic startup, repository lock and index loading.
+
+import hashlib
+import os
+import statefile
+import time
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+
+def scan(sources: list,
+         excludes: list = None,
+         workers: int = 4) -> dict:
+    """
+    Fingerprint each source directory tree.
+
+    Every directory is hashed on its own (sorted entries metadata),
+    in a thread pool, and the per-directory digests of a source are
+    then combined, so memory stays proportional to the number of
+    directories, not files. Paths starting with one of the excludes
+    are skipped.
+
+    Returns a dict {source: hex digest}.
+
+    Example :
+    scan(["/media/usbdrive/work/"], ["/media/usbdrive/work/tmp/"])
+    """
+    excludes = tuple(excludes or ())
+    fingerprint = {}
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        for src in sources:
+            dir_digests = []
+            pending = {pool.submit(scan_dir, src, excludes)}
+
+            while pending:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+
+                for fut in done:
+                    path, digest, subdirs = fut.result()
+                    dir_digests.append((path, digest))
+
+                    for sub in subdirs:
+                        pending.add(pool.submit(scan_dir, sub, excludes))
+
+            h = hashlib.sha256()
+            for path, digest in sorted(dir_digests):
+                h.update(f"{path}\0{digest}\n".encode(errors='surrogateescape'))
+
+            fingerprint[src] = h.hexdigest()
+
+    return fingerprint
+
+
+def scan_dir(path: str,
+             excludes: tuple) -> tuple:
+    """
+    Hash the metadata of one directory entries.
+    Returns a tuple (path, hex digest, list of subdirectories to scan).
+    """
+    entries = []
+    subdirs = []
+
+    try:
+        with os.scandir(path) as it:
+            for entry in it:
+                if excludes and entry.path.startswith(excludes):
+                    continue
+
+                try:
+                    st = entry.stat(follow_symlinks=False)
+                except OSError:
+                    continue
+
+                entries.append(f"{entry.name}\0{st.st_mode}\0{st.st_size}\0" \
+                               f"{st.st_mtime_ns}\0{st.st_ctime_ns}\0{st.st_ino}")
+
+                if entry.is_dir(follow_symlinks=False):
+                    subdirs.append(entry.path)
+
+    # Unreadable directory : restic will report it, just make it visible
+    except OSError as e:
+        entries.append(f"error\0{e.errno}")
+
+    h = hashlib.sha256()
+    for line in sorted(entries):
+        h.update(line.encode(errors='surrogateescape'))
+        h.update(b"\n")
+
+    return path, h.hexdigest(), subdirs
+
+
+def load(index_path: str) -> dict:
+    """
+    Load the index saved by the last successful backup,
+    ex : {'sources': {src: digest}, 'last_snapshot': 1725600000.0}
+    """
+    return statefile.load(index_path, {'sources': {}, 'last_snapshot': 0})
+
+
+def save(index_path: str,
+         fingerprint: dict):
+    """
+    Atomically save the fingerprint taken before a successful backup.
+    """
+    statefile.save(index_path, {'sources': fingerprint,
+                                'last_snapshot': time.time()})
+
+
+def unchanged(index: dict,
+              fingerprint: dict,
+              max_interval: float) -> bool:
+    """
+    True if the sources are the same as in the index, and the last
+    real snapshot is younger than max_interval seconds.
+    """
+    if time.time() - index.get('last_snapshot', 0) > max_interval:
+        return False
+
+    return index.get('sources') == fingerprint
@@ -0,0 +1,184 @@
+# Live progress of restic jobs
+#
+# Turns restic JSON "status" messages into a rate-limited progress line
+# (moving average throughput, ETA, current file), printed to the journal
+# and sent to systemd as the unit STATUS= (sd_notify), so a long job can
+# be followed with systemctl status. When the unit has a watchdog
+# (WatchdogSec), it's only pet while the running jobs make progress :
+# a job stalled for too long is killed by systemd.
+
+import os
+import threading
+import time
+
+STATUS_INTERVAL = 2     # Min seconds between two sd_notify STATUS= updates
+SMOOTHING = 0.3         # Weight of the last interval in the moving average
+
+_active = {}
+_lock = threading.Lock()
+
+
+def sd_notify(state: str) -> bool:
+    """
+    Send a state to systemd (ex : "STATUS=...", "WATCHDOG=1"), if the
+    process runs as a unit with notifications allowed. Returns True if sent.
+    """
+    address = os.environ.get("NOTIFY_SOCKET")
+    if not address:
+        return False
+
+    import socket
+
+    # Abstract namespace socket
+    if address.startswith("@"):
+        address = "\0" + address[1:]
+
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM) as sock:
+            sock.connect(address)
+            sock.sendall(state.encode())
+    except OSError:
+        return False
+
+    return True
+
+
+def start(label: str,
+          fmt_bytes,
+          interval: float = 30) -> dict:
+    """
+    Start tracking a restic process. fmt_bytes formats a bytes count,
+    interval is the min seconds between two printed progress lines.
+
+    Example :
+    track = start("backup /data", human_bytes)
+    runner.run(args, on_message=lambda msg: update(track, msg))
+    stop(track)
+    """
+    now = time.monotonic()
+    track = {'label': label,
+             'fmt_bytes': fmt_bytes,
+             'interval': interval,
+             'last_print': now,
+             'last_status': 0,
+             'last_progress': now,
+             'sample': None,
+             'rate': None,
+             'done': (0, 0),
+             'line': f"{label} : starting"}
+
+    with _lock:
+        _active[id(track)] = track
+
+    return track
+
+
+def update(track: dict,
+           msg: dict):
+    """
+    Feed a restic JSON message (runner.run on_message callback).
+    """
+    if msg.get('message_type') != "status":
+        return
+
+    now = time.monotonic()
+    done = msg.get('bytes_done', msg.get('bytes_restored', 0))
+    files = msg.get('files_done', msg.get('files_restored', 0))
+
+    if (done, files) != track['done']:
+        track['done'] = (done, files)
+        track['last_progress'] = now
+
+    if now - track['last_status'] < STATUS_INTERVAL:
+        return
+    track['last_status'] = now
+
+    # Moving average throughput, over the intervals between updates
+    # (the first one only sets the baseline, restic starts with a burst)
+    if track['sample'] is not None:
+        last_time, last_done = track['sample']
+        rate = (done - last_done) / (now - last_time)
+        track['rate'] = rate if track['rate'] is None \
+                        else SMOOTHING * rate + (1 - SMOOTHING) * track['rate']
+    track['sample'] = (now, done)
+
+    fmt = track['fmt_bytes']
+    total = msg.get('total_bytes')
+    line = f"{track['label']} : "
+
+    if total:
+        line += f"{100 * msg.get('percent_done', done / total):.1f}% {fmt(done)}/{fmt(total)}"
+    else:
+        line += fmt(done)
+
+    if track['rate'] is not None:
+        line += f", {fmt(track['rate'])}/s"
+        if total and track['rate'] > 0:
+            eta = (total - done) / track['rate']
+            line += f", ETA {time.strftime('%H:%M:%S', time.gmtime(eta))}"
+
+    if msg.get('current_files'):
+        line += f", {msg['current_files'][0]}"
+
+    track['line'] = line
+    sd_notify(f"STATUS={status()}")
+
+    if now - track['last_print'] >= track['interval']:
+        track['last_print'] = now
+        print(line, flush=True)
+
+
+def stop(track: dict):
+    with _lock:
+        _active.pop(id(track), None)
+
+    sd_notify(f"STATUS={status() or 'idle'}")
+
+
+def status() -> str:
+    """
+    Progress lines of every running process, for STATUS=.
+    """
+    with _lock:
+        return " | ".join(track['line'] for track in _active.values())
+
+
+def stalled(timeout: float) -> list:
+    """
+    Labels of the running processes without progress for timeout seconds.
+    """
+    now = time.monotonic()
+
+    with _lock:
+        return [track['label'] for track in _active.values()
+                if now - track['last_progress'] > timeout]
+
+
+def watchdog(stall_timeout: float) -> bool:
+    """
+    Pet the systemd watchdog (WatchdogSec of the unit) from a background
+    thread, as long as no running process is stalled for stall_timeout
+    seconds. Returns False if the unit has no watchdog.
+    """
+    usec = os.environ.get("WATCHDOG_USEC")
+    pid = os.environ.get("WATCHDOG_PID")
+
+    if not usec or (pid and int(pid) != os.getpid()):
+        return False
+
+    period = int(usec) / 1e6 / 2
+
+    def pet():
+        while True:
+            labels = stalled(stall_timeout)
+            if labels:
+                print(f"Watchdog : no progress for {stall_timeout / 60:.0f} minutes " \
+                      f"({', '.join(labels)}), letting systemd stop the job", flush=True)
+                sd_notify(f"STATUS=Stalled : {', '.join(labels)}")
+                return
+            sd_notify("WATCHDOG=1")
+            time.sleep(period)
+
+    threading.Thread(target=pet, daemon=True).start()
+
+    return True
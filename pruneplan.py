@@ -0,0 +1,123 @@
+# Prune planner
+#
+# Estimates what a restic prune would repack and free (from a dry run),
+# and decides whether it's worth running now, given a space threshold,
+# a wall-clock budget sized from the repack throughput of the previous
+# prunes, and a maximum interval between two prunes.
+
+import re
+import statefile
+import time
+
+# Repack throughput assumed until a prune has measured it (bytes/s),
+# kept low so the first prune, often the largest, stays in the time limit
+DEFAULT_REPACK_RATE = 10 * 1024 ** 2
+
+UNITS = {'B': 1, 'KiB': 1024, 'MiB': 1024 ** 2, 'GiB': 1024 ** 3, 'TiB': 1024 ** 4,
+         'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3, 'T': 1024 ** 4}
+
+# restic prune statistics lines, ex : "to repack:   69 blobs / 1.078 MiB"
+STATS = {'repack': r'^to repack:.*/\s*([\d.]+) (\w+)',
+         'removed': r'^this removes:.*/\s*([\d.]+) (\w+)',
+         'prune': r'^total prune:.*/\s*([\d.]+) (\w+)',
+         'remaining': r'^remaining:.*/\s*([\d.]+) (\w+)',
+         'unused_after': r'^unused size after prune:\s*([\d.]+) (\w+)'}
+
+
+def to_bytes(size: str) -> int:
+    """
+    Parse a size, ex : "1.5 GiB", "10G", "512" -> bytes.
+    """
+    m = re.match(r'^\s*([\d.]+)\s*([A-Za-z]*)\s*$', size)
+    if not m:
+        raise ValueError(f"Invalid size : {size}")
+
+    return int(float(m.group(1)) * UNITS.get(m.group(2) or 'B', 1))
+
+
+def parse(lines) -> dict:
+    """
+    Extract the statistics of a restic prune (dry run) text output.
+    Returns a dict of bytes counts, ex : {'repack': 1130364, 'prune': 1124073, ...}
+    """
+    stats = dict.fromkeys(STATS, 0)
+
+    for line in lines:
+        for key, pattern in STATS.items():
+            m = re.match(pattern, line.strip())
+            if m:
+                stats[key] = to_bytes(f"{m.group(1)} {m.group(2)}")
+
+    return stats
+
+
+def load(state_path: str) -> dict:
+    """
+    Load the prune state, ex : {'repack_rate': 52428800.0, 'last_prune': 1725600000.0}
+    """
+    return statefile.load(state_path, {'repack_rate': 0, 'last_prune': 0})
+
+
+def save(state_path: str,
+         state: dict):
+    statefile.save(state_path, state)
+
+
+def repack_budget(max_repack_size: str,
+                  repack_rate: float,
+                  time_limit: float) -> str:
+    """
+    Return the --max-repack-size value : the configured one, lowered to
+    what can be repacked in time_limit seconds at the measured rate
+    (DEFAULT_REPACK_RATE if none is measured yet).
+    Empty string if there is no limit at all.
+    """
+    budget = to_bytes(max_repack_size) if max_repack_size else None
+
+    if time_limit:
+        timed = int((repack_rate or DEFAULT_REPACK_RATE) * time_limit)
+        budget = min(budget, timed) if budget else timed
+
+    if budget is None:
+        return ""
+
+    return f"{max(1, budget // 1024 ** 2)}M"
+
+
+def decide(stats: dict,
+           state: dict,
+           min_free: int,
+           max_interval: float) -> tuple:
+    """
+    Return (run : bool, reason : str). A prune freeing less than min_free
+    bytes is postponed, unless the last prune is older than max_interval
+    seconds.
+    """
+    if stats['prune'] == 0 and stats['repack'] == 0:
+        return False, "Prune skipped : nothing to prune"
+
+    if stats['prune'] >= min_free:
+        return True, "Prune worth running"
+
+    if time.time() - state.get('last_prune', 0) > max_interval:
+        return True, "Prune forced : max interval since last prune reached"
+
+    return False, "Prune postponed : not enough space to free"
+
+
+def advance(state: dict,
+            stats: dict,
+            duration: float) -> dict:
+    """
+    Update the state after a prune : last prune time, and repack rate
+    (moving average) measured on this prune.
+    """
+    state = dict(state)
+    state['last_prune'] = time.time()
+
+    if stats['repack'] and duration:
+        rate = stats['repack'] / duration
+        old = state.get('repack_rate') or rate
+        state['repack_rate'] = (old + rate) / 2
+
+    return state
@@ -0,0 +1,112 @@
+# Job resource control
+#
+# A job's resource settings are systemd directives (CPU and IO priority,
+# CPU and memory limits) rendered in its unit, and the matching restic
+# setup : the Go runtime of restic doesn't see the cgroup limits, so its
+# thread count (GOMAXPROCS) and heap target (GOMEMLIMIT) are sized from
+# them, and bandwidth limits become restic flags.
+
+import math
+import os
+
+DIRECTIVES = ('Nice', 'IOSchedulingClass', 'CPUQuota', 'IOWeight', 'MemoryHigh', 'CPUAffinity')
+
+# Not systemd directives : restic flags, in KiB/s
+RESTIC_FLAGS = {'limit_upload': "--limit-upload",
+                'limit_download': "--limit-download"}
+
+UNITS = {'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3, 'T': 1024 ** 4}
+
+
+def validate(config: dict):
+    """
+    Raise ValueError on unknown or invalid resource settings.
+    """
+    for key, value in config.items():
+        if key not in DIRECTIVES and key not in RESTIC_FLAGS:
+            raise ValueError(f"Unknown resource setting {key}")
+
+    if config.get('CPUAffinity'):
+        cpu_count(config['CPUAffinity'])
+    if config.get('MemoryHigh'):
+        memory_bytes(config['MemoryHigh'])
+
+
+def directives(config: dict) -> dict:
+    """
+    systemd [Service] directives of a job, empty values left out,
+    ex : {'Nice': 10, 'CPUQuota': ""} -> {'Nice': "10"}
+    """
+    return {key: str(value) for key, value in config.items()
+            if key in DIRECTIVES and value not in ("", None)}
+
+
+def cpu_count(affinity: str) -> int:
+    """
+    Count the CPUs of a CPUAffinity value, ex : "0-3 8,9" -> 6
+    """
+    cpus = set()
+
+    for part in affinity.replace(",", " ").split():
+        if "-" in part:
+            start, end = (int(v) for v in part.split("-"))
+            cpus.update(range(start, end + 1))
+        else:
+            cpus.add(int(part))
+
+    return len(cpus)
+
+
+def memory_bytes(value: str) -> int:
+    """
+    Parse a MemoryHigh value, ex : "2G", "50%" (of the physical memory),
+    None for "infinity".
+    """
+    value = str(value).strip()
+
+    if value == "infinity":
+        return None
+    if value.endswith("%"):
+        total = os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')
+        return int(total * float(value[:-1]) / 100)
+    if value[-1:].upper() in UNITS:
+        return int(float(value[:-1]) * UNITS[value[-1].upper()])
+
+    return int(value)
+
+
+def restic_env(config: dict) -> dict:
+    """
+    Go runtime environment of restic matching the limits,
+    ex : {'CPUQuota': "150%", 'MemoryHigh': "2G"} ->
+    {'GOMAXPROCS': "2", 'GOMEMLIMIT': "2147483648"}
+    """
+    env = {}
+    procs = []
+
+    if config.get('CPUQuota'):
+        procs.append(math.ceil(float(str(config['CPUQuota']).rstrip("%")) / 100))
+    if config.get('CPUAffinity'):
+        procs.append(cpu_count(config['CPUAffinity']))
+    if procs:
+        env['GOMAXPROCS'] = str(max(min(procs), 1))
+
+    if config.get('MemoryHigh'):
+        limit = memory_bytes(config['MemoryHigh'])
+        if limit:
+            env['GOMEMLIMIT'] = str(limit)
+
+    return env
+
+
+def restic_args(config: dict) -> list:
+    """
+    restic flags of a job, ex : {'limit_upload': 2048} -> ["--limit-upload", "2048"]
+    """
+    args = []
+
+    for key, flag in RESTIC_FLAGS.items():
+        if config.get(key):
+            args += [flag, str(config[key])]
+
+    return args
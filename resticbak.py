@@ -5,13 +5,16 @@
 # This script automates restic local backups.
 # Linux OS only. Auto installation (service) designed for systemd (init must be done manually).
 
-import json
+import joblock
+import metrics
+import notifier
 import os
-import requests
+import progress
+import runner
 import settings
 import subprocess
-import set_systemd
 import sys
+import time
 
 os.environ['RESTIC_REPOSITORY'] = settings.RESTIC_REPOSITORY
 os.environ['RESTIC_PASSWORD'] = settings.REPO_PASSWORD
@@ -20,10 +23,106 @@ os.environ['RESTIC_PASSWORD'] = settings.REPO_PASSWORD
 if os.getuid() == 0:
     os.environ['RESTIC_CACHE_DIR'] = "/var/cache/restic"
 
+# State files (indexes, caches...) directory, in /var/lib if called by root
+if settings.STATE_DIR:
+    STATE_DIR = settings.STATE_DIR
+elif os.getuid() == 0:
+    STATE_DIR = "/var/lib/resticbak"
+else:
+    STATE_DIR = os.path.expanduser("~/.local/state/resticbak")
+
 EXCLUDE_FILE = f'{settings.RESTIC_REPOSITORY}/.resticignore'
+HISTORY_DB = f'{STATE_DIR}/history.db'
+TUNE_FILE = f'{STATE_DIR}/tune.json'
+OUTBOX_DIR = f'{STATE_DIR}/outbox'
+PREFLIGHT_FILE = f'{STATE_DIR}/preflight.json'
+PRUNE_FILE = f'{STATE_DIR}/prune.json'
+DAEMON_FILE = f'{STATE_DIR}/daemon.json'
+INDEX_DB = f'{STATE_DIR}/index.db'
+CAPACITY_FILE = f'{STATE_DIR}/capacity.json'
+PACKS_DB = f'{STATE_DIR}/packs.db'
+
+# Repository commands, and whether they need the repository alone
+JOB_LOCKS = {'backup': False, 'check': True, 'forget': True, 'prune': True,
+             'index': False, 'restore': False, 'verify-packs': False, 'tune': True}
+
+COMMANDS = ("backup", "check", "forget", "prune", "verify-packs", "restore", "excludes",
+            "history", "capacity", "index", "search", "tune", "daemon", "install", "uninstall")
 
 
 def backup():
+    """
+    Back the files (settings.DATA_TO_BAK) up, and the command sources
+    (settings.STDIN_SOURCES) next to them if any.
+    """
+    from concurrent.futures import ThreadPoolExecutor
+
+    streams = settings.STDIN_SOURCES
+
+    capacity_guard()
+
+    for source in streams:
+        if not source.get('name') or not source.get('command'):
+            print(f"Command source {source} needs a 'name' and a 'command'. Check your settings.")
+            sys.exit(1)
+
+    # The dumps run while the files are backed up. Once both are done
+    # (even if the files backup exits), the snapshots they created are
+    # recorded, copied and indexed at once.
+    results = []
+    with ThreadPoolExecutor(max_workers=1) as pool:
+        future = pool.submit(backup_streams, streams) if streams else None
+        try:
+            results = backup_files()
+        finally:
+            summaries = [res['summary'] for res in results if res['summary']]
+            failed = any(res['returncode'] != 0 for res in results)
+
+            if future:
+                streams_failed, streams_summaries, partial = future.result()
+                summaries += streams_summaries
+                failed = failed or streams_failed
+                if partial:
+                    forget_partial(partial)
+
+            backup_finish(summaries)
+
+    if failed:
+        sys.exit(1)
+
+
+def backup_finish(summaries: list):
+    """
+    Record the data added by all the backup processes of a run (capacity
+    forecast, warned about), then copy and index the snapshots created.
+    """
+    if not summaries:
+        return
+
+    warning = capacity_record(sum(sumj['data_added'] for sumj in summaries))
+
+    if warning:
+        print(warning)
+        if settings.NOTIFY:
+            notify(settings.SIGNAL_API_URL,
+                   settings.SIGNAL_RECEIVER,
+                   warning)
+
+    after_backup([sumj['snapshot_id'] for sumj in summaries])
+
+
+def backup_files() -> list:
+    """
+    Back the files up, in one restic process or one per group of sources
+    (settings.BACKUP_PARALLEL), and report it.
+
+    Returns the backup_sources() results (empty if skipped), exits on
+    settings errors.
+    """
+    import excludes
+    import history
+    import prescan
+
     dirs_to_bak = settings.DATA_TO_BAK
     dirs_to_ignore = settings.DATA_TO_IGNORE
 
@@ -34,71 +133,1018 @@ def backup():
             sys.exit(1)
     
     if len(dirs_to_bak) < 1:
-        quit()
+        return []
+
+    if settings.BACKUP_PARALLEL:
+        groups = backup_groups(dirs_to_bak)
+
+    # Check the exclude rules before running anything
+    try:
+        rules = excludes.compile_rules(dirs_to_ignore, settings.EXCLUDES, dirs_to_bak)
+    except ValueError as e:
+        print(f"Error : {e}. Check your settings.")
+        sys.exit(1)
+
+    # Set .resticignore file (only written if changed). Restic has no
+    # regex excludes : the paths they match are listed instead.
+    regex_paths = excludes.expand_regex(rules, dirs_to_bak, settings.PRESCAN_WORKERS)
+    dirs_to_ignore = excludes.render(rules, regex_paths)
+    excludes.write_if_changed(EXCLUDE_FILE, dirs_to_ignore)
+
+    # Skip restic if nothing changed since the last snapshot
+    if settings.PRESCAN:
+        index_path = f'{STATE_DIR}/prescan.json'
+        fingerprint = prescan.scan(dirs_to_bak,
+                                   settings.DATA_TO_IGNORE,
+                                   settings.PRESCAN_WORKERS)
+        fingerprint['.resticignore'] = dirs_to_ignore
+        index = prescan.load(index_path)
+
+        if prescan.unchanged(index, fingerprint,
+                             settings.PRESCAN_MAX_INTERVAL * 3600):
+            print("Backup skipped (no-op) : nothing changed since last snapshot")
+            history.add(HISTORY_DB, "backup", 0, 0, {'skipped': True})
+            metrics.write(settings.METRICS_DIR, "backup", 0, 0,
+                          {'backup_skipped': 1,
+                           'backup_last_snapshot_timestamp_seconds': index['last_snapshot']},
+                          BACKUP_METRICS_HELP)
+            if settings.NOTIFY:
+                notify(settings.SIGNAL_API_URL,
+                       settings.SIGNAL_RECEIVER,
+                       "Backup skipped (no-op)\n" \
+                       "Nothing changed since last snapshot " \
+                       f"({time.ctime(index['last_snapshot'])})")
+            return []
+
+    if settings.BACKUP_PARALLEL:
+        results = backup_parallel(groups)
+
+        if settings.PRESCAN and all(res['returncode'] == 0 for res in results):
+            prescan.save(index_path, fingerprint)
+
+        return results
+
+    res = backup_sources(dirs_to_bak)
+    sumj = res['summary']
+    warning = backup_record([res])
+
+    if res['returncode'] == 0:
+        if settings.PRESCAN:
+            prescan.save(index_path, fingerprint)
+
+        if settings.NOTIFY:
+            summary = "Backup successful\n" \
+                     f"- {sumj['files_new']} new files\n" \
+                     f"- {sumj['files_changed']} changed files\n" \
+                     f"- {sumj['files_unmodified']} unmodified files\n" \
+                     f"- {sumj['dirs_new']} new directories\n" \
+                     f"- {sumj['dirs_changed']} changed directories\n" \
+                     f"- {sumj['dirs_unmodified']} unmodified directories\n" \
+                     f"- {sumj['data_blobs']} data blobs\n" \
+                     f"- {sumj['tree_blobs']} tree blobs\n" \
+                     f"- {sumj['data_added']} data added\n" \
+                     f"- {sumj['total_files_processed']} files processed\n" \
+                     f"- {sumj['total_bytes_processed']} bytes processed\n" \
+                     f"- Backup duration : {sumj['total_duration']}s\n" \
+                     f"- Snapshot ID : {sumj['snapshot_id']}"
+            if res['errors_count']:
+                summary += "\n" + runner.errors_report(res)
+            if warning:
+                summary += "\n" + warning
+            notify(settings.SIGNAL_API_URL,
+                   settings.SIGNAL_RECEIVER,
+                   summary)
+    else:
+        if settings.NOTIFY:
+            notify(settings.SIGNAL_API_URL,
+                   settings.SIGNAL_RECEIVER,
+                   f"Backup ERROR\n{runner.errors_report(res)}")
+
+    return [res]
+
+
+def backup_sources(sources: list,
+                   tags: list = None) -> dict:
+    """
+    Run one restic backup process for the given sources.
+
+    Returns the runner.run() result dict (return code, restic "summary"
+    JSON object or None if restic failed before sending it, per-path
+    errors, duration...) with the backed up 'sources' added.
 
-    # Set .resticignore file
-    with open(file=f'{settings.RESTIC_REPOSITORY}/.resticignore',
-              mode='w',
-              encoding='utf-8') as file:
-        dirs_to_ignore = "\r".join(dirs_to_ignore)
-        file.write(dirs_to_ignore)
+    Example :
+    backup_sources(["/media/usbdrive/work/"], ["source:/media/usbdrive/work/"])
+    """
+    import tuner
 
     # Build Restic command for subprocess.run
     subp_args = ["restic", "backup"]
 
-    for ele in dirs_to_bak:
+    for ele in sources:
         subp_args.append(ele)
 
     subp_args.append(f"--exclude-file={EXCLUDE_FILE}")
+
+    if settings.EXCLUDE_LARGER_THAN:
+        subp_args.append(f"--exclude-larger-than={settings.EXCLUDE_LARGER_THAN}")
+    if settings.EXCLUDE_CACHES:
+        subp_args.append("--exclude-caches")
+
     subp_args.append("--json")
     subp_args.append("--tag")
     subp_args.append(settings.SNAPSHOT_TAG)
+
+    for tag in tags or []:
+        subp_args.append("--tag")
+        subp_args.append(tag)
     # subp_args.append("--dry-run")
 
+    # Apply the setup found by "resticbak.py tune" for this host,
+    # within the job resource limits
+    tuned_env = None
+    tuned = tuner.load(TUNE_FILE) if settings.TUNE_APPLY else None
+
+    if tuned:
+        tuned_args, tuned_env = tuner.args_for(tuned)
+        subp_args += tuned_args
+
+    resource_args, env = job_resources("backup", tuned_env)
+    subp_args += resource_args
+
     # Run Restic command
     # ex : restic backup /path/to/data --exclude-file=/path/to/repo/.resticignore --json --tag "Run by resticbackup.py script"
-    ps = subprocess.Popen(subp_args,
-                          text=True,
-                          stdout=subprocess.PIPE,
-                          stderr=subprocess.PIPE)
+    track = progress.start(f"backup {', '.join(sources)}", human_bytes, settings.PROGRESS_INTERVAL)
+    res = runner.run(subp_args, env=env, on_message=lambda msg: progress.update(track, msg))
+    progress.stop(track)
+    res['sources'] = sources
+
+    return res
+
+
+def backup_groups(dirs_to_bak: list) -> list:
+    """
+    Split the sources into the settings.BACKUP_GROUPS groups, each source
+    left out of them getting its own group. Exits if a group member isn't
+    one of the sources, or is in several groups.
 
-    for line in ps.stdout:
-        out_json = json.loads(line)
+    Example :
+    BACKUP_GROUPS = [["/a/", "/b/"]], backup_groups(["/a/", "/b/", "/c/"])
+    -> [["/a/", "/b/"], ["/c/"]]
+    """
+    sources = {os.path.normpath(src): src for src in dirs_to_bak}
+    groups = []
+    grouped = set()
+
+    for group in settings.BACKUP_GROUPS:
+        members = []
+        for src in group:
+            path = os.path.normpath(src)
+            if path not in sources:
+                print(f"Backup group source {src} is not in DATA_TO_BAK. Check your settings.")
+                sys.exit(1)
+            if path in grouped:
+                print(f"Backup group source {src} is in several groups. Check your settings.")
+                sys.exit(1)
+            grouped.add(path)
+            members.append(sources[path])
+        if members:
+            groups.append(members)
+
+    return groups + [[src] for path, src in sources.items() if path not in grouped]
+
+
+def backup_parallel(groups: list) -> list:
+    """
+    Run one restic backup process per group of sources (backup_groups()),
+    at most settings.BACKUP_CONCURRENCY at the same time, each snapshot
+    being tagged with its source(s). The summaries are then merged into
+    one combined report.
+
+    Returns the backup_sources() results, failed ones included.
+    """
+    from concurrent.futures import ThreadPoolExecutor
+
+    # Restic splits --tag values on commas
+    jobs = [(group, [f"source:{src.replace(',', '_')}" for src in group])
+            for group in groups]
 
-        if out_json['message_type'] == "summary":
-            sumj = out_json
+    with ThreadPoolExecutor(max_workers=settings.BACKUP_CONCURRENCY) as pool:
+        results = list(pool.map(lambda job: backup_sources(*job), jobs))
 
-    for error_line in ps.stderr:
-        print(error_line, end='')
+    failed = [res for res in results if res['returncode'] != 0]
+    warning = backup_record(results)
+    report = backup_report(results)
 
-    ps.wait()
+    if warning:
+        report += "\n" + warning
+    print(report)
 
-    if ps.returncode == 0:
+    if not failed:
         if settings.NOTIFY:
-            summary = "Backup successful\n" \
-                     f"- {sumj['files_new']} new files\n" \
-                     f"- {sumj['files_changed']} changed files\n" \
-                     f"- {sumj['files_unmodified']} unmodified files\n" \
-                     f"- {sumj['dirs_new']} new directories\n" \
-                     f"- {sumj['dirs_changed']} changed directories\n" \
-                     f"- {sumj['dirs_unmodified']} unmodified directories\n" \
-                     f"- {sumj['data_blobs']} data blobs\n" \
-                     f"- {sumj['tree_blobs']} tree blobs\n" \
-                     f"- {sumj['data_added']} data added\n" \
-                     f"- {sumj['total_files_processed']} files processed\n" \
-                     f"- {sumj['total_bytes_processed']} bytes processed\n" \
-                     f"- Backup duration : {sumj['total_duration']}s\n" \
-                     f"- Snapshot ID : {sumj['snapshot_id']}"
             notify(settings.SIGNAL_API_URL,
                    settings.SIGNAL_RECEIVER,
-                   summary)
+                   f"Backup successful\n{report}")
     else:
         if settings.NOTIFY:
             notify(settings.SIGNAL_API_URL,
                    settings.SIGNAL_RECEIVER,
-                   "Backup ERROR")
+                   f"Backup ERROR\n{report}")
+
+    return results
+
+
+def backup_stream(source: dict) -> dict:
+    """
+    Back a command output up : its stdout is piped straight into
+    restic backup --stdin, without a temporary dump file. If the command
+    fails, the snapshot of its (partial) output is left to forget once
+    every backup process is done (forget needs the repository alone).
+
+    Returns the runner.run() result dict, with the command 'source', its
+    return code ('command_returncode') and the 'partial_snapshot' ID added.
+
+    Example :
+    backup_stream({'name': "postgres", 'command': ["pg_dumpall"], 'filename': "pg_dumpall.sql"})
+    """
+    filename = source.get('filename') or source['name']
+    subp_args = ["restic", "backup",
+                 "--stdin",
+                 "--stdin-filename", filename,
+                 "--json",
+                 "--tag", settings.SNAPSHOT_TAG,
+                 "--tag", f"stdin:{source['name'].replace(',', '_')}"]
+
+    resource_args, env = job_resources("backup")
+    subp_args += resource_args
+
+    try:
+        dump = subprocess.Popen(source['command'], stdout=subprocess.PIPE)
+    except OSError as e:
+        print(f"Command source {source['name']} failed to start : {e}")
+        return {'returncode': 1, 'summary': None, 'errors_count': 0,
+                'duration': 0, 'source': source, 'command_returncode': None,
+                'partial_snapshot': None}
+
+    track = progress.start(f"backup {source['name']}", human_bytes, settings.PROGRESS_INTERVAL)
+    res = runner.run(subp_args, stdin=dump.stdout, env=env,
+                     on_message=lambda msg: progress.update(track, msg))
+    progress.stop(track)
+
+    # Once restic is gone, the command gets EPIPE instead of blocking
+    dump.stdout.close()
+    res['command_returncode'] = dump.wait()
+    res['source'] = source
+    res['partial_snapshot'] = None
+
+    if res['command_returncode'] != 0:
+        if res['summary']:
+            res['partial_snapshot'] = res['summary']['snapshot_id']
+            res['summary'] = None
+        res['returncode'] = res['returncode'] or 1
+
+    return res
+
+
+def backup_streams(sources: list) -> tuple:
+    """
+    Back the command sources up, settings.STDIN_CONCURRENCY at the same
+    time, and report each one's bytes count, duration and throughput.
+
+    Returns the count of failed sources, the summaries of the snapshots
+    created (recorded, copied and indexed by backup() once the files are
+    backed up too), and the IDs of the partial snapshots of the failed
+    commands, to forget.
+    """
+    from concurrent.futures import ThreadPoolExecutor
+    import history
+
+    with ThreadPoolExecutor(max_workers=settings.STDIN_CONCURRENCY) as pool:
+        results = list(pool.map(backup_stream, sources))
+
+    lines = []
+    for res in results:
+        name = res['source']['name']
+        sumj = res['summary']
+
+        if res['returncode'] != 0 or sumj is None:
+            if res['command_returncode']:
+                status = f"ERROR (command exited with code {res['command_returncode']})"
+                if res['partial_snapshot']:
+                    status += f", partial snapshot {res['partial_snapshot']} to forget"
+            else:
+                status = f"ERROR (code {res['returncode']})"
+            lines.append(f"- {name} : {status}")
+            continue
+
+        size = sumj['total_bytes_processed']
+        rate = size / res['duration'] if res['duration'] else 0
+        lines.append(f"- {name} : {human_bytes(size)} in {res['duration']:.1f}s " \
+                     f"({human_bytes(rate)}/s), " \
+                     f"{human_bytes(sumj['data_added'])} added, " \
+                     f"snapshot {sumj['snapshot_id']}")
+
+    failed = sum(res['returncode'] != 0 or res['summary'] is None for res in results)
+    duration = max(res['duration'] for res in results)
+    report = f"Command sources backup {'ERROR' if failed else 'successful'} " \
+             f"({len(results) - failed}/{len(results)} sources)\n" + "\n".join(lines)
+    print(report)
+
+    summaries = [res['summary'] for res in results if res['summary']]
+    metrics.write(settings.METRICS_DIR, "stream", 1 if failed else 0, duration,
+                  {'stream_failed_sources': failed,
+                   'stream_bytes_processed': sum(sumj['total_bytes_processed'] for sumj in summaries)},
+                  {'stream_failed_sources': "Command sources the last backup failed for",
+                   'stream_bytes_processed': "Bytes read from the command sources by the last backup"})
+    history.add(HISTORY_DB, "stream", 1 if failed else 0, duration,
+                merge_summaries(summaries))
+
+    if settings.NOTIFY:
+        notify(settings.SIGNAL_API_URL,
+               settings.SIGNAL_RECEIVER,
+               report)
+
+    return failed, summaries, [res['partial_snapshot'] for res in results if res['partial_snapshot']]
+
+
+def forget_partial(snapshot_ids: list):
+    """
+    Forget the partial snapshots of the failed command sources, once the
+    backup processes are done. The repository may still be locked by other
+    backups (shared job lock) : restic retries for settings.JOB_LOCK_MAX_WAIT
+    minutes, and a snapshot it couldn't forget is reported.
+    """
+    res = runner.run(["restic", "forget",
+                      f"--retry-lock={settings.JOB_LOCK_MAX_WAIT}m"] + snapshot_ids)
+
+    if res['returncode'] == 0:
+        print(f"Partial snapshots forgotten : {', '.join(snapshot_ids)}")
+        return
+
+    err_str = res['stderr'][-1].strip() if res['stderr'] else ""
+    report = f"Partial snapshots NOT forgotten, forget them manually : " \
+             f"{', '.join(snapshot_ids)}\n{err_str}"
+    print(report)
+
+    if settings.NOTIFY:
+        notify(settings.SIGNAL_API_URL,
+               settings.SIGNAL_RECEIVER,
+               report)
+
+
+BACKUP_METRICS_HELP = {
+    'backup_skipped': "1 if the last backup was skipped by the pre-scan (no changes)",
+    'backup_last_snapshot_timestamp_seconds': "Unix time of the last snapshot created",
+    'backup_bytes_processed': "Bytes read from the sources by the last backup",
+    'backup_files_processed': "Files read from the sources by the last backup",
+    'backup_data_added_bytes': "Bytes added to the repository by the last backup",
+    'backup_files_new': "New files in the last backup",
+    'backup_files_changed': "Changed files in the last backup",
+    'backup_throughput_bytes_per_second': "Bytes processed per second by the last backup",
+}
+
+
+def after_backup(snapshot_ids: list):
+    """
+    Copy the new snapshots to the secondary repositories, and add them
+    to the local content index (settings.INDEX).
+    """
+    replicate(snapshot_ids)
+
+    if settings.INDEX:
+        index_snapshots(snapshot_ids)
+
+
+def replicate(snapshot_ids: list):
+    """
+    Copy the new snapshots to every repository of settings.SECONDARY_REPOSITORIES
+    with restic copy, REPLICATION_CONCURRENCY targets at the same time, each
+    within REPLICATION_TIMEOUT minutes. A failing target doesn't stop the
+    others, and doesn't fail the backup job : it's reported and exported.
+    """
+    from concurrent.futures import ThreadPoolExecutor
+    import history
+
+    targets = settings.SECONDARY_REPOSITORIES
+
+    if not targets or not snapshot_ids:
+        return
+
+    def copy(target):
+        # restic copy reads from the --from-repo, writes to the -r repo
+        env = dict(os.environ,
+                   RESTIC_REPOSITORY=target['repository'],
+                   RESTIC_PASSWORD=target['password'],
+                   RESTIC_FROM_REPOSITORY=settings.RESTIC_REPOSITORY,
+                   RESTIC_FROM_PASSWORD=settings.REPO_PASSWORD)
+        return runner.run(["restic", "copy"] + snapshot_ids,
+                          env=env,
+                          timeout=settings.REPLICATION_TIMEOUT * 60 or None)
+
+    with ThreadPoolExecutor(max_workers=settings.REPLICATION_CONCURRENCY) as pool:
+        results = list(pool.map(copy, targets))
+
+    lines = []
+    for target, res in zip(targets, results):
+        if res['returncode'] == 0:
+            status = "OK"
+        elif res['timed_out']:
+            status = "TIMEOUT"
+        else:
+            err_str = res['stderr'][-1].strip() if res['stderr'] else ""
+            status = f"ERROR (code {res['returncode']}) {err_str}"
+        lines.append(f"- {target['repository']} : {status}, {res['duration']:.1f}s")
+
+    failed = sum(res['returncode'] != 0 for res in results)
+    duration = max(res['duration'] for res in results)
+    report = f"Replication {'ERROR' if failed else 'successful'} " \
+             f"({len(targets) - failed}/{len(targets)} repositories)\n" + "\n".join(lines)
+    print(report)
+
+    metrics.write(settings.METRICS_DIR, "replicate", 1 if failed else 0, duration,
+                  {'replication_failed_targets': failed},
+                  {'replication_failed_targets': "Secondary repositories the last copy failed for"})
+    history.add(HISTORY_DB, "replicate", 1 if failed else 0, duration,
+                {'targets': len(targets), 'failed': failed})
+
+    if settings.NOTIFY:
+        notify(settings.SIGNAL_API_URL,
+               settings.SIGNAL_RECEIVER,
+               report)
+
+
+def backup_record(results: list) -> str:
+    """
+    Record a backup run, from one or several backup_sources() results :
+    textfile collector metrics and run history.
+
+    Returns a warning line if the run throughput or data added falls far
+    outside the recent runs baseline, an empty string otherwise.
+    """
+    import history
+
+    returncode = max((res['returncode'] for res in results), default=0)
+    duration = max((res['duration'] for res in results), default=0)
+    summaries = [res['summary'] for res in results if res['summary']]
+
+    values = {'backup_skipped': 0,
+              'backup_last_snapshot_timestamp_seconds': None,
+              'job_errors': sum(res['errors_count'] for res in results)}
+
+    if returncode == 0:
+        values['backup_last_snapshot_timestamp_seconds'] = time.time()
+
+    if summaries:
+        processed = sum(sumj['total_bytes_processed'] for sumj in summaries)
+        values.update({
+            'backup_bytes_processed': processed,
+            'backup_files_processed': sum(sumj['total_files_processed'] for sumj in summaries),
+            'backup_data_added_bytes': sum(sumj['data_added'] for sumj in summaries),
+            'backup_files_new': sum(sumj['files_new'] for sumj in summaries),
+            'backup_files_changed': sum(sumj['files_changed'] for sumj in summaries),
+            'backup_throughput_bytes_per_second': processed / duration if duration else 0,
+        })
+
+    metrics.write(settings.METRICS_DIR, "backup", returncode, duration,
+                  values, BACKUP_METRICS_HELP)
+
+    history.add(HISTORY_DB, "backup", returncode, duration,
+                merge_summaries(summaries))
+
+    if returncode != 0:
+        return ""
+
+    warnings = []
+
+    flags = history.anomalies(HISTORY_DB,
+                              settings.HISTORY_WINDOW,
+                              settings.HISTORY_THRESHOLD,
+                              limit=1)
+    for reasons in flags.values():
+        warning = f"WARNING : {' and '.join(reasons)} far outside " \
+                  f"the last {settings.HISTORY_WINDOW} backups baseline"
+        print(warning)
+        warnings.append(warning)
+
+    return "\n".join(warnings)
+
+
+def merge_summaries(summaries: list) -> dict:
+    """
+    Merge several restic backup summaries : counters are summed,
+    durations maxed and snapshot IDs listed.
+    """
+    if not summaries:
+        return None
+
+    merged = {}
+    for sumj in summaries:
+        for k, v in sumj.items():
+            if k == 'snapshot_id':
+                merged.setdefault('snapshot_ids', []).append(v)
+            elif k in ('total_duration', 'backup_start', 'backup_end'):
+                merged[k] = max(merged.get(k, v), v)
+            elif isinstance(v, (int, float)):
+                merged[k] = merged.get(k, 0) + v
+            else:
+                merged.setdefault(k, v)
+
+    if len(summaries) == 1:
+        merged['snapshot_id'] = merged.pop('snapshot_ids')[0]
+
+    return merged
+
+
+def backup_report(results: list) -> str:
+    """
+    Merge the summaries of several backup_sources() results
+    into one report, with per-source duration and throughput.
+    """
+    totals = dict.fromkeys(('files_new', 'files_changed', 'files_unmodified',
+                            'dirs_new', 'dirs_changed', 'dirs_unmodified',
+                            'data_added', 'total_files_processed',
+                            'total_bytes_processed'), 0)
+    lines = []
+
+    for res in results:
+        sources = ", ".join(res['sources'])
+        sumj = res['summary']
+
+        if res['returncode'] != 0 or sumj is None:
+            lines.append(f"- {sources} : ERROR (code {res['returncode']})")
+            if res['errors_count']:
+                lines.append(runner.errors_report(res))
+            continue
+
+        for k in totals:
+            totals[k] += sumj[k]
+
+        duration = sumj['total_duration']
+        rate = sumj['total_bytes_processed'] / duration if duration else 0
+        lines.append(f"- {sources} : {duration:.1f}s, " \
+                     f"{human_bytes(rate)}/s, " \
+                     f"{human_bytes(sumj['data_added'])} added, " \
+                     f"snapshot {sumj['snapshot_id']}")
+        if res['errors_count']:
+            lines.append(runner.errors_report(res))
+
+    wall = max((res['duration'] for res in results), default=0)
+    rate = totals['total_bytes_processed'] / wall if wall else 0
+
+    return f"- {totals['files_new']} new files\n" \
+           f"- {totals['files_changed']} changed files\n" \
+           f"- {totals['files_unmodified']} unmodified files\n" \
+           f"- {totals['dirs_new']} new directories\n" \
+           f"- {totals['dirs_changed']} changed directories\n" \
+           f"- {totals['dirs_unmodified']} unmodified directories\n" \
+           f"- {human_bytes(totals['data_added'])} data added\n" \
+           f"- {totals['total_files_processed']} files processed\n" \
+           f"- {human_bytes(totals['total_bytes_processed'])} processed\n" \
+           f"- Backup duration : {wall:.1f}s ({human_bytes(rate)}/s)\n" \
+           "Per source :\n" + "\n".join(lines)
+
+
+def human_bytes(size: float) -> str:
+    """
+    Format a bytes count with binary units, ex : 1536 -> "1.5 KiB"
+    """
+    for unit in ("B", "KiB", "MiB", "GiB", "TiB"):
+        if abs(size) < 1024 or unit == "TiB":
+            break
+        size /= 1024
+
+    return f"{size:.1f} {unit}"
+
+
+def capacity_record(delta: int) -> str:
+    """
+    Add a repository size change (backup data added, or prune freed
+    bytes if negative) to the capacity state, and export the forecast.
+    Returns a warning line if the repository filesystem is forecast
+    to be full within settings.CAPACITY_WARN_DAYS, an empty string otherwise.
+    """
+    import capacity
+
+    free = capacity.free_space(settings.RESTIC_REPOSITORY) \
+           if os.path.isdir(settings.RESTIC_REPOSITORY) else None
+
+    try:
+        state = capacity.update(CAPACITY_FILE, delta, free)
+    except OSError as e:
+        print(f"Failed to update the capacity state {CAPACITY_FILE} : {e}")
+        return ""
+
+    return capacity_report(state, free)[1]
+
+
+def capacity_report(state: dict,
+                    free: int) -> tuple:
+    """
+    Export the capacity metrics, and return the (report, warning) lines.
+    """
+    import capacity
+    import pruneplan
+
+    rate = capacity.growth_rate(state, settings.CAPACITY_WINDOW * 86400)
+    headroom = free - pruneplan.to_bytes(settings.CAPACITY_RESERVE) if free is not None else None
+    days = capacity.forecast(headroom, rate) if headroom is not None else None
+
+    metrics.write(settings.METRICS_DIR, "capacity", 0, 0,
+                  {'capacity_repository_bytes': state['repo_size'],
+                   'capacity_free_bytes': free,
+                   'capacity_growth_bytes_per_day': rate,
+                   'capacity_days_until_full': days if days is not None else -1},
+                  {'capacity_repository_bytes': "Estimated repository size (last full stats + changes since)",
+                   'capacity_free_bytes': "Free bytes on the repository filesystem",
+                   'capacity_growth_bytes_per_day': "Repository growth over the forecast window",
+                   'capacity_days_until_full': "Days until the repository filesystem is full (-1 : not growing)"})
+
+    size = human_bytes(state['repo_size']) if state['repo_size'] is not None else "unknown"
+    report = f"- Repository size : {size}" \
+             f"{' (reconciled ' + time.ctime(state['reconciled']) + ')' if state['reconciled'] else ''}\n" \
+             f"- Free space : {human_bytes(free) if free is not None else 'unknown (remote repository)'}\n" \
+             f"- Growth : {human_bytes(rate) + '/day' if rate is not None else 'not enough history'}\n" \
+             f"- Full in : {f'{days:.0f} days' if days is not None else '-'}"
+
+    warning = ""
+    if days is not None and days < settings.CAPACITY_WARN_DAYS:
+        warning = f"WARNING : repository filesystem full in {days:.0f} days " \
+                  f"at {human_bytes(rate)}/day ({human_bytes(free)} free)"
+        print(warning)
+
+    return report, warning
+
+
+def capacity_guard():
+    """
+    Stop a backup before it starts if the repository filesystem free space,
+    minus settings.CAPACITY_RESERVE, is smaller than what the next backup
+    is expected to add : the largest data added by the recent backups
+    (and command sources), times settings.CAPACITY_MARGIN.
+    """
+    import capacity
+    import history
+    import pruneplan
+
+    if not os.path.isdir(settings.RESTIC_REPOSITORY):
+        return
+
+    free = capacity.free_space(settings.RESTIC_REPOSITORY)
+    if free is None:
+        return
+
+    expected = 0
+    for job in ("backup", "stream"):
+        added = [run['data_added'] for run in history.runs(HISTORY_DB, job, settings.HISTORY_WINDOW)
+                 if run['returncode'] == 0 and run['data_added'] is not None]
+        expected += max(added, default=0)
+    expected = int(expected * settings.CAPACITY_MARGIN)
+
+    headroom = free - pruneplan.to_bytes(settings.CAPACITY_RESERVE)
+
+    if headroom < expected:
+        msg = f"Backup ERROR\nRepository filesystem almost full : {human_bytes(free)} free, " \
+              f"{human_bytes(max(headroom, 0))} usable above the {settings.CAPACITY_RESERVE} reserve, " \
+              f"the next backup is expected to add up to {human_bytes(expected)}. " \
+              "Free some space (resticbak.py forget / prune) first."
+        print(msg)
+        # Keep the last backup gauges (last snapshot time...) for the alerts
+        metrics.write(settings.METRICS_DIR, "backup", 1, 0,
+                      dict.fromkeys(BACKUP_METRICS_HELP), BACKUP_METRICS_HELP)
+        history.add(HISTORY_DB, "backup", 1, 0, {'capacity_guard': True})
+        if settings.NOTIFY:
+            notify(settings.SIGNAL_API_URL,
+                   settings.SIGNAL_RECEIVER,
+                   msg)
+        sys.exit(1)
+
+
+def capacity_reconcile():
+    """
+    Reset the estimated repository size with a full restic stats, only
+    every settings.CAPACITY_RECONCILE_INTERVAL days (it reads every
+    snapshot tree, so it's only run after checks).
+    """
+    import capacity
+    import json
+
+    state = capacity.load(CAPACITY_FILE)
+
+    if time.time() - state['reconciled'] < settings.CAPACITY_RECONCILE_INTERVAL * 86400:
+        return
+
+    res = runner.run(["restic", "stats", "--mode", "raw-data", "--json"],
+                     stdout_reader=json.load)
+
+    if res['returncode'] != 0 or not isinstance(res['parsed'], dict):
+        print("Capacity : restic stats failed, repository size not reconciled")
+        return
+
+    free = capacity.free_space(settings.RESTIC_REPOSITORY) \
+           if os.path.isdir(settings.RESTIC_REPOSITORY) else None
+    state = capacity.update(CAPACITY_FILE, free=free,
+                            repo_size=res['parsed']['total_size'])
+    print(f"Capacity : repository size reconciled, {human_bytes(state['repo_size'])} " \
+          f"({res['duration']:.0f}s)")
+    capacity_report(state, free)
+
+
+def show_capacity():
+    """
+    Show the repository size estimate, free space, growth and forecast,
+    without opening the repository.
+    """
+    import capacity
+
+    free = capacity.free_space(settings.RESTIC_REPOSITORY) \
+           if os.path.isdir(settings.RESTIC_REPOSITORY) else None
+    print(capacity_report(capacity.load(CAPACITY_FILE), free)[0])
+
+
+def verify_packs():
+    """
+    Detect bit rot in a local repository : each pack file is named after
+    the SHA-256 of its contents, so packs are hashed (settings.VERIFY_PACKS_CONCURRENCY
+    processes) and compared with their name, without restic. New and
+    unverified packs come first, then the least recently verified ones,
+    for at most settings.VERIFY_PACKS_BUDGET minutes : successive runs
+    rotate through the whole repository.
+    """
+    import history
+    import packverify
+
+    if not os.path.isdir(settings.RESTIC_REPOSITORY):
+        print("Error : verify-packs only reads local repositories")
+        sys.exit(1)
+
+    track = progress.start("verify-packs", human_bytes, settings.PROGRESS_INTERVAL)
+    done = {'bytes_done': 0, 'files_done': 0}
+
+    def on_result(name: str, size: int, ok: bool):
+        if not ok:
+            print(f"Corrupt pack : data/{name[:2]}/{name}", flush=True)
+        done['bytes_done'] += size
+        done['files_done'] += 1
+        progress.update(track, dict(done, message_type="status"))
+
+    try:
+        report = packverify.verify(PACKS_DB, settings.RESTIC_REPOSITORY,
+                                   budget=settings.VERIFY_PACKS_BUDGET * 60,
+                                   workers=settings.VERIFY_PACKS_CONCURRENCY,
+                                   on_result=on_result)
+    finally:
+        progress.stop(track)
+
+    failed = bool(report['corrupt'] or report['errors'])
+    rate = report['bytes'] / report['duration'] if report['duration'] else 0
+
+    lines = [f"- {report['checked']} of {report['packs']} packs hashed " \
+             f"({human_bytes(report['bytes'])}, {human_bytes(rate)}/s)",
+             f"- Duration : {report['duration']:.0f}s"]
+    if report['unverified']:
+        lines.append(f"- {report['unverified']} packs left to verify")
+    if report['oldest']:
+        lines.append(f"- Oldest verification : {(time.time() - report['oldest']) / 86400:.0f} days ago")
+    for name in report['corrupt']:
+        lines.append(f"- CORRUPT : data/{name[:2]}/{name}")
+    for name, error in report['errors'].items():
+        lines.append(f"- Read error : data/{name[:2]}/{name} : {error}")
+
+    print("\n".join(lines))
+
+    metrics.write(settings.METRICS_DIR, "verify_packs", 1 if failed else 0, report['duration'],
+                  {'verify_packs_checked': report['checked'],
+                   'verify_packs_corrupt': len(report['corrupt']),
+                   'verify_packs_unverified': report['unverified'],
+                   'verify_packs_oldest_timestamp_seconds': report['oldest']},
+                  VERIFY_METRICS_HELP)
+    history.add(HISTORY_DB, "verify-packs", 1 if failed else 0, report['duration'])
+
+    if settings.NOTIFY:
+        notify(settings.SIGNAL_API_URL,
+               settings.SIGNAL_RECEIVER,
+               f"Pack verification {'ERROR' if failed else 'successful'}\n" + "\n".join(lines))
+
+    if failed:
+        sys.exit(1)
+
+
+VERIFY_METRICS_HELP = {
+    'verify_packs_checked': "Packs hashed by the last pack verification",
+    'verify_packs_corrupt': "Packs whose hash didn't match their name",
+    'verify_packs_unverified': "Packs new, changed or corrupt, left to verify",
+    'verify_packs_oldest_timestamp_seconds': "Unix time of the oldest pack verification",
+}
+
+
+def job_resources(job: str,
+                  tuned_env: dict = None) -> tuple:
+    """
+    Return the (restic extra arguments, environment) matching the job
+    resource settings (settings.RESOURCES), the environment being None
+    if restic can inherit ours. A thread count from tuned_env is kept,
+    unless the CPU limits are lower.
+    """
+    import resources
+
+    config = settings.RESOURCES.get(job, {})
+
+    try:
+        resources.validate(config)
+        resource_env = resources.restic_env(config)
+    except ValueError as e:
+        print(f"Error : {job} resources, {e}. Check your settings.")
+        sys.exit(1)
+
+    env = dict(tuned_env or {})
+    for key, value in resource_env.items():
+        if key == 'GOMAXPROCS' and key in env:
+            value = str(min(int(value), int(env[key])))
+        env[key] = value
+
+    return resources.restic_args(config), dict(os.environ, **env) if env else None
+
+
+def restore_args(args: list):
+    """
+    Parse the restore command line arguments (after "restore").
+    """
+    import argparse
+
+    parser = argparse.ArgumentParser(prog="resticbak.py restore",
+                                     description="Restore files from a snapshot, subtrees in parallel")
+    parser.add_argument("snapshot",
+                        help='snapshot ID, or "latest" for the latest snapshot of each source')
+    parser.add_argument("paths", nargs="*",
+                        help="paths to restore (default : every backup source)")
+    parser.add_argument("--target", required=True, help="directory to restore to")
+    parser.add_argument("--verify", action="store_true",
+                        help="read the restored files back and check them")
+
+    opts = parser.parse_args(args)
+
+    sources = [src.rstrip("/") or "/" for src in settings.DATA_TO_BAK]
+    paths = sorted({path.rstrip("/") or "/" for path in opts.paths} or sources)
+
+    def source_of(path):
+        return next((src for src in sources
+                     if path == src or path.startswith(src.rstrip("/") + "/")), None)
+
+    # Independent subtrees : drop the paths inside another one,
+    # each with the backup source it belongs to
+    opts.subtrees = {path: source_of(path) for path in paths
+                     if not any(path != other and path.startswith(other.rstrip("/") + "/")
+                                for other in paths)}
+
+    # "latest" needs the source to find the snapshot, the latest one
+    # overall may be another source's or a command source's
+    outside = [path for path, src in opts.subtrees.items() if src is None]
+    if opts.snapshot == "latest" and outside:
+        print(f"Error : {', '.join(outside)} not in any backup source (DATA_TO_BAK), " \
+              "give a snapshot ID to restore it")
         sys.exit(1)
 
+    return opts
+
+
+def restore(opts):
+    """
+    Restore paths from a snapshot into opts.target (from restore_args) :
+    one restic restore per independent subtree, settings.RESTORE_CONCURRENCY
+    at the same time, with their JSON progress merged into one throughput
+    and ETA line.
+    With "latest", each path is restored from the latest snapshot of the
+    backup source it belongs to (backups can be one snapshot per source).
+    The restore is then reported, exported and recorded like a backup.
+    """
+    from concurrent.futures import ThreadPoolExecutor
+    import history
+    import threading
+
+    subtrees = list(opts.subtrees)
+
+    # Progress of each subtree, merged into one status for the logs,
+    # the unit status and the watchdog
+    status = {}
+    lock = threading.Lock()
+    start = time.monotonic()
+    track = progress.start("restore", human_bytes, settings.PROGRESS_INTERVAL)
+
+    def on_status(path, msg):
+        if msg['message_type'] != "status":
+            return
+
+        with lock:
+            status[path] = (msg.get('bytes_restored', 0),
+                            msg.get('files_restored', 0),
+                            msg.get('total_bytes', 0))
+            progress.update(track, {'message_type': "status",
+                                    'bytes_done': sum(r[0] for r in status.values()),
+                                    'files_done': sum(r[1] for r in status.values()),
+                                    'total_bytes': sum(r[2] for r in status.values())})
+
+    def run(path):
+        subp_args = ["restic", "restore", opts.snapshot,
+                     "--target", opts.target,
+                     "--include", path,
+                     "--json"]
+
+        # Latest snapshot holding the source of this path
+        if opts.snapshot == "latest":
+            subp_args += ["--path", opts.subtrees[path]]
+
+        if opts.verify:
+            subp_args.append("--verify")
+
+        res = runner.run(subp_args + resource_args, env=env,
+                         on_message=lambda msg: on_status(path, msg))
+        res['sources'] = [path]
+        return res
+
+    resource_args, env = job_resources("restore")
+
+    print(f"Restore of {len(subtrees)} paths from {opts.snapshot} to {opts.target}")
+
+    try:
+        with ThreadPoolExecutor(max_workers=settings.RESTORE_CONCURRENCY) as pool:
+            results = list(pool.map(run, subtrees))
+    finally:
+        progress.stop(track)
+
+    # No summary before restic 0.17 (restore has no JSON output)
+    failed = [res for res in results if res['returncode'] != 0]
+    duration = time.monotonic() - start
+    report = restore_report(results, duration)
+    print(report)
+
+    summaries = [res['summary'] for res in results if res['summary']]
+    restored = sum(sumj.get('bytes_restored', 0) for sumj in summaries)
+    metrics.write(settings.METRICS_DIR, "restore", 1 if failed else 0, duration,
+                  {'restore_bytes_restored': restored,
+                   'restore_throughput_bytes_per_second': restored / duration if duration else 0},
+                  {'restore_bytes_restored': "Bytes restored by the last restore",
+                   'restore_throughput_bytes_per_second': "Bytes restored per second by the last restore"})
+    history.add(HISTORY_DB, "restore", 1 if failed else 0, duration,
+                {'total_bytes_processed': restored,
+                 'total_files_processed': sum(sumj.get('files_restored', 0) for sumj in summaries),
+                 'data_added': 0,
+                 'snapshot': opts.snapshot,
+                 'paths': subtrees})
+
+    if settings.NOTIFY:
+        notify(settings.SIGNAL_API_URL,
+               settings.SIGNAL_RECEIVER,
+               f"Restore {'ERROR' if failed else 'successful'}\n{report}")
+
+    if failed:
+        sys.exit(1)
+
+
+def restore_report(results: list,
+                   duration: float) -> str:
+    """
+    Merge the summaries of several restores into one report, in the
+    backup_report() format : totals, then per path duration and throughput.
+    """
+    totals = dict.fromkeys(('total_files', 'files_restored', 'files_skipped',
+                            'total_bytes', 'bytes_restored', 'bytes_skipped'), 0)
+    lines = []
+
+    for res in results:
+        sources = ", ".join(res['sources'])
+        sumj = res['summary']
+
+        if res['returncode'] != 0:
+            err_str = res['stderr'][-1].strip() if res['stderr'] else ""
+            lines.append(f"- {sources} : ERROR (code {res['returncode']}) {err_str}")
+            if res['errors_count']:
+                lines.append(runner.errors_report(res))
+            continue
+
+        if sumj is None:
+            lines.append(f"- {sources} : {res['duration']:.1f}s, restored (no statistics before restic 0.17)")
+            continue
+
+        for k in totals:
+            totals[k] += sumj.get(k, 0)
+
+        rate = sumj.get('bytes_restored', 0) / res['duration'] if res['duration'] else 0
+        lines.append(f"- {sources} : {res['duration']:.1f}s, " \
+                     f"{human_bytes(rate)}/s, " \
+                     f"{human_bytes(sumj.get('bytes_restored', 0))} restored, " \
+                     f"{sumj.get('files_restored', 0)} files")
+        if res['errors_count']:
+            lines.append(runner.errors_report(res))
+
+    rate = totals['bytes_restored'] / duration if duration else 0
+
+    return f"- {totals['files_restored']} files restored\n" \
+           f"- {totals['files_skipped']} files skipped (already there)\n" \
+           f"- {totals['total_files']} files in total\n" \
+           f"- {human_bytes(totals['bytes_restored'])} restored\n" \
+           f"- {human_bytes(totals['bytes_skipped'])} skipped\n" \
+           f"- Restore duration : {duration:.1f}s ({human_bytes(rate)}/s)\n" \
+           "Per path :\n" + "\n".join(lines)
+
 
 def check():
     """
@@ -109,155 +1155,669 @@ def check():
     
     NB : Restic also support file size (in K/M/G/T), so for example it can be data="1G"
     to check 1 Gigabyte randomly picked from the backup data.
+
+    With settings.CHECK_MODE = "rotate", the data is instead read in
+    settings.CHECK_PARTS parts (restic "n/t" subset), one part per check,
+    so every pack is read once per cycle. With "budget", the parts count is
+    computed for each part to be read in settings.CHECK_TIME_BUDGET minutes,
+    from the read throughput measured by the previous checks.
     """
-    # restic check --read-data-subset=x%
-    ps = subprocess.Popen(["restic", "check",
-                          f"--read-data-subset={settings.CHECK_SUBSET}"],
-                          text=True,
-                          stdout=subprocess.PIPE,
-                          stderr=subprocess.PIPE)
-    
-    for line in ps.stdout:
-        print(line, end='')
+    import checkplan
+    import history
 
-    for err_line in ps.stderr:
-        print(err_line, end='')
+    subset = settings.CHECK_SUBSET
+    state_path = f'{STATE_DIR}/check.json'
+
+    if settings.CHECK_MODE in ("rotate", "budget"):
+        state = checkplan.load(state_path)
+        size = checkplan.data_size(settings.RESTIC_REPOSITORY)
+
+        if settings.CHECK_MODE == "rotate":
+            if not 1 <= settings.CHECK_PARTS <= checkplan.MAX_PARTS:
+                print(f"Error : CHECK_PARTS must be between 1 and {checkplan.MAX_PARTS}. Check your settings.")
+                sys.exit(1)
+            part, parts = checkplan.plan(state, parts=settings.CHECK_PARTS)
+        else:
+            part, parts = checkplan.plan(state,
+                                         budget=settings.CHECK_TIME_BUDGET * 60,
+                                         size=size)
+        subset = f"{part}/{parts}"
 
-    ps.wait()
+    # restic check --read-data-subset=x%
+    resource_args, env = job_resources("check")
+    res = runner.run(["restic", "check",
+                      f"--read-data-subset={subset}"] + resource_args,
+                     echo_stdout=True,
+                     env=env)
+
+    line = res['stdout'][-1] if res['stdout'] else ""
+
+    if res['returncode'] == 0 and settings.CHECK_MODE in ("rotate", "budget"):
+        checkplan.save(state_path,
+                       checkplan.advance(state, part, parts,
+                                         read_bytes=size // parts,
+                                         duration=res['duration']))
+        line = f"Data part {subset} read\n{line}"
+    metrics.write(settings.METRICS_DIR, "check",
+                  res['returncode'], res['duration'])
+    history.add(HISTORY_DB, "check", res['returncode'], res['duration'])
+
+    if res['returncode'] == 0:
+        capacity_reconcile()
 
-    if ps.returncode == 0:
         if settings.NOTIFY:
             notify(settings.SIGNAL_API_URL,
                    settings.SIGNAL_RECEIVER,
                    f"Check successful\n{line}")
     else:
         if settings.NOTIFY:
+            err_str = "".join(res['stderr'])
             notify(settings.SIGNAL_API_URL,
                    settings.SIGNAL_RECEIVER,
-                   f"Check ERROR\n{line}")
+                   f"Check ERROR\n{line}{err_str}")
         sys.exit(1)
 
 
 def forget():
-    # restic forget --prune --keep-last 5 --keep-daily 5 --keep-weekly 5 --keep-monthly 5 --keep-yearly 5 --json
-    ps = subprocess.Popen(["restic", "forget",
-                           "--prune",
-                           "--keep-last", str(settings.KEEP_LAST),
-                           "--keep-daily", str(settings.KEEP_DAILY),
-                           "--keep-weekly", str(settings.KEEP_WEEKLY),
-                           "--keep-monthly", str(settings.KEEP_MONTHLY),
-                           "--keep-yearly", str(settings.KEEP_YEARLY),
-                           # "--dry-run",
-                           "--json"],
-                           text=True,
-                           stdout=subprocess.PIPE,
-                           stderr=subprocess.PIPE)
-    
-    out_str = ""
-    err_str = ""
-
-    # Will iterate only once : as of Restic v0.17,
-    # output of forget command is one single json object
-    for line in ps.stdout:
-        print(line, end='')
-        out_str = line
+    """
+    Forget the snapshots out of the retention policy, then run the
+    budgeted prune() (if settings.PRUNE_AFTER_FORGET).
+    """
+    import forgetjson
+    import history
+
+    # restic forget --keep-last 5 --keep-daily 5 --keep-weekly 5 --keep-monthly 5 --keep-yearly 5 --json
+    resource_args, env = job_resources("forget")
+    res = runner.run(["restic", "forget",
+                      "--keep-last", str(settings.KEEP_LAST),
+                      "--keep-daily", str(settings.KEEP_DAILY),
+                      "--keep-weekly", str(settings.KEEP_WEEKLY),
+                      "--keep-monthly", str(settings.KEEP_MONTHLY),
+                      "--keep-yearly", str(settings.KEEP_YEARLY),
+                      # "--dry-run",
+                      "--json"] + resource_args,
+                     stdout_reader=forgetjson.parse,
+                     env=env)
+
+    # As of Restic v0.17, output of forget command is one single json
+    # array of snapshot groups, parsed group by group as it arrives.
+    out = res['parsed']
+    err_str = res['stderr'][-1] if res['stderr'] else ""
+
+    if res['returncode'] == 0 and out is None:
+        res['returncode'] = 1
+        err_str = "Unreadable restic forget output"
+
+    if res['returncode'] == 0:
+        total_keep = out['keep']
+        total_remove = out['remove']
+        breakdown = forget_breakdown(out['groups'])
+
+        print(breakdown)
+
+        metrics.write(settings.METRICS_DIR, "forget", 0, res['duration'],
+                      {'forget_snapshots_kept': total_keep,
+                       'forget_snapshots_removed': total_remove},
+                      {'forget_snapshots_kept': "Snapshots kept by the last forget",
+                       'forget_snapshots_removed': "Snapshots removed by the last forget"})
+        history.add(HISTORY_DB, "forget", 0, res['duration'],
+                    {'snapshots_kept': total_keep,
+                     'snapshots_removed': total_remove})
 
-    for err_line in ps.stderr:
-        print(err_line, end='')
-        err_str = err_line
+        if settings.NOTIFY:
+            summary = "Forget successful\n" \
+                    f"Snapshots kept : {str(total_keep)}\n" \
+                    f"Snapshots removed : {str(total_remove)}\n" \
+                    f"{forget_breakdown(out['groups'], limit=10)}"
 
-    ps.wait()
+            notify(settings.SIGNAL_API_URL,
+                   settings.SIGNAL_RECEIVER,
+                   summary)
+            
+    else:
+        metrics.write(settings.METRICS_DIR, "forget",
+                      res['returncode'], res['duration'])
+        history.add(HISTORY_DB, "forget", res['returncode'], res['duration'])
 
-    if ps.returncode == 0:
         if settings.NOTIFY:
+            notify(settings.SIGNAL_API_URL,
+                settings.SIGNAL_RECEIVER,
+                f"Forget ERROR\n{err_str}")
 
-            out_json = json.loads(out_str)
+        sys.exit(1)
 
-            total_keep = 0
-            total_remove = 0
+    # Drop the forgotten snapshots from the content index
+    if settings.INDEX and out['removed_ids']:
+        import snapindex
 
-            for v in out_json:
-                if v["keep"]:
-                    total_keep += len(v["keep"])
+        snapindex.remove(INDEX_DB, out['removed_ids'])
+        print(f"Index : {len(out['removed_ids'])} forgotten snapshots dropped")
 
-                if v["remove"]:
-                    total_remove += len(v["remove"])
+    if settings.PRUNE_AFTER_FORGET:
+        prune()
 
-            summary = "Forget successful\n" \
-                    f"Snapshots kept : {str(total_keep)}\n" \
-                    f"Snapshots removed : {str(total_remove)}\n"
 
+def prune():
+    """
+    Plan a prune with a dry run, within the settings budget (PRUNE_MAX_UNUSED,
+    PRUNE_MAX_REPACK_SIZE, and PRUNE_TIME_LIMIT minutes at the repack
+    throughput measured by the previous prunes), and run it only if it
+    frees at least PRUNE_MIN_FREE, or the last prune is older than
+    PRUNE_MAX_INTERVAL days.
+    """
+    import history
+    import pruneplan
+
+    state = pruneplan.load(PRUNE_FILE)
+    budget_args = ["--max-unused", settings.PRUNE_MAX_UNUSED]
+    max_repack = pruneplan.repack_budget(settings.PRUNE_MAX_REPACK_SIZE,
+                                         state['repack_rate'],
+                                         settings.PRUNE_TIME_LIMIT * 60)
+    if max_repack:
+        budget_args += ["--max-repack-size", max_repack]
+
+    # restic prune --dry-run --max-unused 5% --max-repack-size 10G
+    plan = runner.run(["restic", "prune", "--dry-run"] + budget_args)
+
+    if plan['returncode'] != 0:
+        res = plan
+    else:
+        stats = pruneplan.parse(plan['stdout'])
+        run, reason = pruneplan.decide(stats, state,
+                                       pruneplan.to_bytes(settings.PRUNE_MIN_FREE),
+                                       settings.PRUNE_MAX_INTERVAL * 86400)
+        report = f"{reason}\n" \
+                 f"- {human_bytes(stats['repack'])} to repack\n" \
+                 f"- {human_bytes(stats['prune'])} to free\n" \
+                 f"- {human_bytes(stats['remaining'])} remaining"
+        print(report)
+
+        if not run:
+            metrics.write(settings.METRICS_DIR, "prune", 0, plan['duration'],
+                          {'prune_postponed': 1}, PRUNE_METRICS_HELP)
+            history.add(HISTORY_DB, "prune", 0, plan['duration'],
+                        dict(stats, postponed=True))
+            if settings.NOTIFY and stats['prune']:
+                notify(settings.SIGNAL_API_URL,
+                       settings.SIGNAL_RECEIVER,
+                       report)
+            return
+
+        # Prune runs in the forget job (and unit)
+        resource_args, env = job_resources("forget")
+        res = runner.run(["restic", "prune"] + budget_args + resource_args,
+                         echo_stdout=True,
+                         env=env)
+
+    metrics.write(settings.METRICS_DIR, "prune", res['returncode'], res['duration'],
+                  {'prune_postponed': 0,
+                   'prune_freed_bytes': stats['prune'] if res['returncode'] == 0 else None},
+                  PRUNE_METRICS_HELP)
+
+    if res['returncode'] == 0:
+        pruneplan.save(PRUNE_FILE, pruneplan.advance(state, stats, res['duration']))
+        history.add(HISTORY_DB, "prune", 0, res['duration'], stats)
+        capacity_record(-stats['prune'])
+
+        if settings.NOTIFY:
             notify(settings.SIGNAL_API_URL,
                    settings.SIGNAL_RECEIVER,
-                   summary)
-            
+                   f"Prune successful\n" \
+                   f"- {human_bytes(stats['repack'])} repacked\n" \
+                   f"- {human_bytes(stats['prune'])} freed\n" \
+                   f"- Prune duration : {res['duration']:.0f}s")
     else:
+        history.add(HISTORY_DB, "prune", res['returncode'], res['duration'])
+        err_str = res['stderr'][-1] if res['stderr'] else ""
+
         if settings.NOTIFY:
             notify(settings.SIGNAL_API_URL,
-                settings.SIGNAL_RECEIVER,
-                f"Forget ERROR\n{err_str}")
+                   settings.SIGNAL_RECEIVER,
+                   f"Prune ERROR\n{err_str}")
+        sys.exit(1)
+
+
+PRUNE_METRICS_HELP = {
+    'prune_postponed': "1 if the last prune was postponed (not worth it)",
+    'prune_freed_bytes': "Bytes freed by the last prune",
+}
+
+
+def forget_breakdown(groups: list,
+                     limit: int = 0) -> str:
+    """
+    Format the kept/removed snapshots per group (host, paths, tags),
+    at most limit groups if given.
+    """
+    lines = []
+
+    for group in groups[:limit or None]:
+        tags = f" [{', '.join(group['tags'])}]" if group['tags'] else ""
+        lines.append(f"- {group['host']} {', '.join(group['paths'])}{tags} : " \
+                     f"{group['keep']} kept, {group['remove']} removed")
+
+    if limit and len(groups) > limit:
+        lines.append(f"... and {len(groups) - limit} more groups")
+
+    return "\n".join(lines)
+
+
+def show_excludes(preview: bool = False):
+    """
+    Check and list the exclude rules, and with preview, walk the backup
+    sources to report how many files and bytes each rule removes.
+    """
+    import excludes
+    import pruneplan
 
+    try:
+        rules = excludes.compile_rules(settings.DATA_TO_IGNORE,
+                                       settings.EXCLUDES,
+                                       settings.DATA_TO_BAK)
+    except ValueError as e:
+        print(f"Error : {e}. Check your settings.")
         sys.exit(1)
 
+    for rule in rules:
+        print(f"- {rule['name']}" \
+              f"{' (listed paths, restic has no regex)' if rule['restic'] is None else ''}")
+    if settings.EXCLUDE_LARGER_THAN:
+        print(f"- files larger than {settings.EXCLUDE_LARGER_THAN}")
+    if settings.EXCLUDE_CACHES:
+        print("- cache directories (CACHEDIR.TAG)")
+
+    if not preview:
+        return
+
+    larger_than = 0
+    if settings.EXCLUDE_LARGER_THAN:
+        larger_than = pruneplan.to_bytes(settings.EXCLUDE_LARGER_THAN)
+
+    counts = excludes.preview(rules, settings.DATA_TO_BAK,
+                              larger_than,
+                              settings.EXCLUDE_CACHES,
+                              settings.PRESCAN_WORKERS)
+    kept = counts.pop(None)
+
+    print(f"\n{'Rule':<50} {'Files':>10} {'Size':>11}")
+    for name, (files, size) in counts.items():
+        warning = "  <- matches nothing" if not files else ""
+        print(f"{name[:50]:<50} {files:>10} {human_bytes(size):>11}{warning}")
+    print(f"{'Backed up':<50} {kept[0]:>10} {human_bytes(kept[1]):>11}")
+
+
+def show_history():
+    """
+    List the last runs from the history database, with backup
+    throughputs, and flag the backups far outside the recent baseline
+    (settings HISTORY_WINDOW previous runs, HISTORY_THRESHOLD deviations).
+    """
+    import history
+    import statistics
+
+    runs = history.runs(HISTORY_DB)
+    flags = history.anomalies(HISTORY_DB,
+                              settings.HISTORY_WINDOW,
+                              settings.HISTORY_THRESHOLD)
+
+    print(f"{'Date':<20} {'Job':<7} {'Code':>4} {'Duration':>9} " \
+          f"{'Processed':>11} {'Added':>11} {'Throughput':>13} {'Files/s':>9}")
+
+    for run in runs:
+        line = f"{time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(run['started']))} " \
+               f"{run['job']:<7} {run['returncode']:>4} {run['duration']:>8.1f}s"
+        bytes_rate, files_rate = history.rates(run)
+
+        if bytes_rate is not None:
+            line += f" {human_bytes(run['bytes_processed']):>11}" \
+                    f" {human_bytes(run['data_added']):>11}" \
+                    f" {human_bytes(bytes_rate) + '/s':>13}" \
+                    f" {files_rate:>9.1f}"
+
+        if run['id'] in flags:
+            line += f"  <- {', '.join(flags[run['id']])}"
+
+        print(line)
+
+    # Rolling throughput over the last backups
+    recent = [history.rates(run)
+              for run in history.runs(HISTORY_DB, "backup", settings.HISTORY_WINDOW)]
+    recent = [r for r in recent if r[0] is not None]
+
+    if recent:
+        print(f"\nRolling throughput (last {len(recent)} backups) : " \
+              f"{human_bytes(statistics.median(r[0] for r in recent))}/s, " \
+              f"{statistics.median(r[1] for r in recent):.1f} files/s (median)")
+
+
+def index_snapshots(snapshot_ids: list = None) -> bool:
+    """
+    Add snapshots to the local content index (restic ls, only for the
+    snapshots not indexed yet). Without snapshot_ids, the index is synced
+    with the repository : every missing snapshot is added, and the
+    forgotten ones dropped. Returns False if any snapshot failed.
+    """
+    import json
+    import snapindex
+    import sqlite3
+
+    if snapshot_ids is None:
+        res = runner.run(["restic", "snapshots", "--json"], stdout_reader=json.load)
+        if res['returncode'] != 0 or res['parsed'] is None:
+            print("Index ERROR : failed to list the snapshots")
+            return False
+
+        snapshot_ids = [snap['id'] for snap in res['parsed']]
+        gone = snapindex.indexed(INDEX_DB) - set(snapshot_ids)
+        if gone:
+            snapindex.remove(INDEX_DB, list(gone))
+            print(f"Index : {len(gone)} forgotten snapshots dropped")
+
+    known = snapindex.indexed(INDEX_DB)
+    ok = True
+
+    for snapshot_id in snapshot_ids:
+        if snapshot_id in known:
+            continue
+
+        # One transaction per snapshot : a failed ls leaves nothing behind
+        con = snapindex.connect(INDEX_DB)
+        try:
+            res = runner.run(["restic", "ls", "--json", snapshot_id],
+                             stdout_reader=lambda stream: snapindex.load_ls(con, stream))
+        except sqlite3.Error as e:
+            res = {'returncode': 1, 'parsed': None, 'stderr': [f"{e}\n"]}
+
+        if res['returncode'] == 0 and res['parsed']:
+            con.commit()
+            print(f"Index : snapshot {snapshot_id[:8]} added " \
+                  f"({res['parsed']['entries']} entries, {res['duration']:.1f}s)")
+        else:
+            con.rollback()
+            err_str = res['stderr'][-1].strip() if res['stderr'] else ""
+            print(f"Index ERROR : snapshot {snapshot_id[:8]} not indexed {err_str}")
+            ok = False
+        con.close()
+
+    return ok
+
+
+def index():
+    """
+    Sync the local content index with the repository snapshots.
+    """
+    if not index_snapshots():
+        sys.exit(1)
+
+
+def search(args: list):
+    """
+    Search the files of every indexed snapshot, without opening the
+    repository. args are the command line arguments after "search", ex :
+    ["*.sql", "--min-size", "1M", "--newer", "2024-05-01"]
+    """
+    import argparse
+    import pruneplan
+    import snapindex
+    from datetime import datetime
+
+    parser = argparse.ArgumentParser(prog="resticbak.py search",
+                                     description="Search the local snapshot content index")
+    parser.add_argument("pattern", nargs="?",
+                        help="path substring, or glob if it holds *, ? or [")
+    parser.add_argument("--min-size", help="ex : 10M")
+    parser.add_argument("--max-size", help="ex : 1G")
+    parser.add_argument("--newer", help="modified since, ex : 2024-05-01")
+    parser.add_argument("--older", help="modified before, ex : 2024-06-01")
+    parser.add_argument("--snapshot", help="snapshot ID (prefix)")
+    parser.add_argument("--limit", type=int, default=50, help="max paths listed")
+    opts = parser.parse_args(args)
+
+    try:
+        results = snapindex.search(
+            INDEX_DB,
+            opts.pattern,
+            min_size=pruneplan.to_bytes(opts.min_size) if opts.min_size else None,
+            max_size=pruneplan.to_bytes(opts.max_size) if opts.max_size else None,
+            newer=datetime.fromisoformat(opts.newer).timestamp() if opts.newer else None,
+            older=datetime.fromisoformat(opts.older).timestamp() if opts.older else None,
+            snapshot=opts.snapshot,
+            limit=opts.limit)
+    except ValueError as e:
+        print(f"Error : {e}")
+        sys.exit(1)
+
+    if not results:
+        print("No match in the indexed snapshots (resticbak.py index to update it)")
+        return
+
+    def date(timestamp):
+        return time.strftime('%Y-%m-%d %H:%M', time.localtime(timestamp)) if timestamp else "-"
+
+    for res in results:
+        print(f"{res['path']}{'/' if res['type'] == 'dir' else ''}")
+        for version in res['versions']:
+            size = human_bytes(version['size']) if version['size'] is not None else "-"
+            print(f"  {date(version['mtime'])} {size:>11}  in {version['snapshots']} snapshots, " \
+                  f"last {version['last']['id'][:8]} ({date(version['last']['time'])}), " \
+                  f"first {version['first']['id'][:8]} ({date(version['first']['time'])})")
+
+    if len(results) == opts.limit:
+        print(f"(first {opts.limit} paths only, see --limit)")
+
+
+def tune():
+    """
+    Run timed trial backups of a sample of the backup sources into scratch
+    repositories on the backup drive (holding the repository lock alone,
+    so no other job skews the timings), with different restic read concurrency,
+    pack size, compression and GOMAXPROCS values, and save the fastest setup
+    for this host. backup() applies it when settings.TUNE_APPLY is True.
+    """
+    import tuner
+
+    # Next to the repository (same drive), not inside it
+    if settings.TUNE_SCRATCH_DIR:
+        scratch_parent = settings.TUNE_SCRATCH_DIR
+    elif os.path.isdir(settings.RESTIC_REPOSITORY):
+        scratch_parent = os.path.dirname(os.path.abspath(settings.RESTIC_REPOSITORY))
+    else:
+        print("Error : remote repository, set TUNE_SCRATCH_DIR to a local directory " \
+              "for the trial repositories. Check your settings.")
+        sys.exit(1)
+
+    config = tuner.tune(settings.DATA_TO_BAK,
+                        scratch_parent,
+                        settings.TUNE_SAMPLE_SIZE * 1024 * 1024)
+
+    if not config:
+        sys.exit(1)
+
+    tuner.save(TUNE_FILE, config)
+
+    args, env = tuner.args_for(config)
+    setup = " ".join(args + [f"{k}={v}" for k, v in env.items()])
+    print(f"Best setup : {setup or 'restic defaults'} " \
+          f"({human_bytes(config['rate'])}/s), saved in {TUNE_FILE}")
+
+
+def daemon():
+    """
+    Run the backup, check and forget jobs on their settings.CALENDAR_*
+    expressions, from one long running asyncio scheduler : only
+    lock-compatible jobs run at the same time, others are queued,
+    missed runs are caught up and failed jobs retried once after
+    settings.DAEMON_RETRY_DELAY minutes.
+    """
+    import asyncio
+    import scheduler
+
+    jobs = {'backup': {'calendar': settings.CALENDAR_BACKUP,
+                       'exclusive': False,
+                       'func': lambda: run_job("backup", backup)},
+            'check': {'calendar': settings.CALENDAR_CHECK,
+                      'exclusive': True,
+                      'func': lambda: run_job("check", check)},
+            'forget': {'calendar': settings.CALENDAR_FORGET,
+                       'exclusive': True,
+                       'func': lambda: run_job("forget", forget)}}
+
+    for name, job in jobs.items():
+        try:
+            scheduler.parse_calendar(job['calendar'])
+        except ValueError as e:
+            print(f"Error : {name} {e}. Check your settings.")
+            sys.exit(1)
+
+    print("Scheduler daemon started")
+
+    try:
+        asyncio.run(scheduler.run(jobs, DAEMON_FILE,
+                                  settings.DAEMON_RETRY_DELAY * 60))
+    except KeyboardInterrupt:
+        pass
+
+
+def run_locked(name: str, func):
+    """
+    Run a repository command holding the job lock : shared for backups,
+    exclusive for the others. Exits if the lock is still taken by
+    incompatible jobs after settings.JOB_LOCK_MAX_WAIT minutes.
+    """
+    if os.path.isdir(settings.JOB_LOCK_DIR) and os.access(settings.JOB_LOCK_DIR, os.W_OK):
+        lock_dir = settings.JOB_LOCK_DIR
+    else:
+        # Per user : jobs run by other users don't see this lock
+        lock_dir = STATE_DIR
+        os.makedirs(lock_dir, exist_ok=True)
+        print(f"Warning : JOB_LOCK_DIR {settings.JOB_LOCK_DIR} is not writable, using {lock_dir}. " \
+              f"Jobs run by other users won't wait for this one.", flush=True)
+
+    lock_path = joblock.lock_path(lock_dir, settings.RESTIC_REPOSITORY)
+    mode = "exclusive" if JOB_LOCKS[name] else "shared"
+
+    try:
+        with joblock.hold(lock_path, JOB_LOCKS[name], settings.JOB_LOCK_MAX_WAIT * 60) as waited:
+            print(f"Job lock ({mode}) acquired for {name}" \
+                  f"{f' after waiting {waited:.0f}s' if waited >= 1 else ''}", flush=True)
+            check_setup()
+            func()
+    except TimeoutError as e:
+        print(f"Error : {e}, another job is still running ({lock_path})")
+        if settings.NOTIFY:
+            notify(settings.SIGNAL_API_URL, settings.SIGNAL_RECEIVER,
+                   f"{name.capitalize()} not run : repository lock timeout")
+        sys.exit(1)
+
+
+def run_job(name: str, func) -> int:
+    """
+    Run a repository command (job lock and preflight included) in the
+    daemon, and return its exit code instead of exiting.
+    """
+    import traceback
+
+    try:
+        run_locked(name, func)
+    except SystemExit as e:
+        return e.code if isinstance(e.code, int) else 1
+    except Exception:
+        traceback.print_exc()
+        return 1
+
+    return 0
+
 
 def install():
     """
-    Install Systemd services and timers for each restic process
+    Install Systemd services and timers for each restic process,
+    or a single scheduler daemon service if settings.SCHEDULER is "daemon"
     """
-    print("Install Systemd services and timers")
+    import resources
+    import set_systemd
 
     python_path = sys.executable
     curr_script_path = os.path.abspath(sys.argv[0])
 
     systemd_descr = "Service for Restic Backup script"
-    
-    # Backup process
-    set_systemd.service(unit_filename="resticbackup-backup",
-                        description=systemd_descr,
-                        after="",
-                        type="oneshot",
-                        execstart=f"{python_path} {curr_script_path} backup",
-                        restart="on-failure",
-                        restartsec="2400",
-                        user="tda")
-    
-    set_systemd.timer(unit_filename="resticbackup-backup",
-                      description=systemd_descr,
-                      oncalendar=settings.CALENDAR_BACKUP)
-
-    # Check process
-    set_systemd.service(unit_filename="resticbackup-check",
-                        description=systemd_descr,
-                        after="",
-                        type="oneshot",
-                        execstart=f"{python_path} {curr_script_path} check",
-                        restart="on-failure",
-                        restartsec="60",
-                        user="tda")
-    
-    set_systemd.timer(unit_filename="resticbackup-check",
-                      description=systemd_descr,
-                      oncalendar=settings.CALENDAR_CHECK)
-
-    # Forget process
-    set_systemd.service(unit_filename="resticbackup-forget",
-                        description=systemd_descr,
-                        after="",
-                        type="oneshot",
-                        execstart=f"{python_path} {curr_script_path} forget",
-                        restart="on-failure",
-                        restartsec="600",
-                        user="tda")
-    
-    set_systemd.timer(unit_filename="resticbackup-forget",
-                      description=systemd_descr,
-                      oncalendar=settings.CALENDAR_FORGET)
+
+    # Jobs send their progress as the unit status (sd_notify)
+    options = {'NotifyAccess': "main"}
+    if settings.PROGRESS_WATCHDOG:
+        options['WatchdogSec'] = "60"
+
+    # Resource control directives of each job unit
+    units_options = {}
+    for job in ("backup", "check", "forget", "daemon"):
+        config = settings.RESOURCES.get(job, {})
+        try:
+            resources.validate(config)
+        except ValueError as e:
+            print(f"Error : {job} resources, {e}. Check your settings.")
+            sys.exit(1)
+        units_options[job] = dict(options, **resources.directives(config))
+
+    timer_units = ['resticbackup-backup.service',
+                   'resticbackup-backup.timer',
+                   'resticbackup-check.service',
+                   'resticbackup-check.timer',
+                   'resticbackup-forget.service',
+                   'resticbackup-forget.timer']
+
+    # Every unit is rendered first, then only the changed files are written,
+    # with a single daemon-reload : running install again is a no-op
+    if settings.SCHEDULER == "daemon":
+        print("Install Systemd scheduler daemon service")
+
+        units = {'resticbackup-daemon.service':
+                 set_systemd.render_service(description=systemd_descr,
+                                            after="",
+                                            type="simple",
+                                            execstart=f"{python_path} {curr_script_path} daemon",
+                                            restart="always",
+                                            restartsec="60",
+                                            user="tda",
+                                            options=units_options['daemon'])}
+
+        # Remove the timers, they would run the jobs a second time
+        changed = set_systemd.install_units(units,
+                                            start=['resticbackup-daemon.service'],
+                                            remove=timer_units)
+    else:
+        print("Install Systemd services and timers")
+
+        units = {}
+        for job, restartsec, oncalendar in (("backup", "2400", settings.CALENDAR_BACKUP),
+                                            ("check", "60", settings.CALENDAR_CHECK),
+                                            ("forget", "600", settings.CALENDAR_FORGET)):
+            units[f'resticbackup-{job}.service'] = \
+                set_systemd.render_service(description=systemd_descr,
+                                           after="",
+                                           type="oneshot",
+                                           execstart=f"{python_path} {curr_script_path} {job}",
+                                           restart="on-failure",
+                                           restartsec=restartsec,
+                                           user="tda",
+                                           options=units_options[job])
+            units[f'resticbackup-{job}.timer'] = \
+                set_systemd.render_timer(description=systemd_descr,
+                                         oncalendar=oncalendar)
+
+        changed = set_systemd.install_units(units,
+                                            enable=[unit for unit in units if unit.endswith('.service')],
+                                            start=[unit for unit in units if unit.endswith('.timer')],
+                                            remove=['resticbackup-daemon.service'])
+
+    if not changed:
+        print("Systemd units already up to date")
 
 
 def uninstall():
     """
     Remove Systemd services and timers for each restic process
     """
+    import set_systemd
+
     print("Remove Systemd services and timers")
 
     set_systemd.uninstall('resticbackup-backup.service',
@@ -265,21 +1825,40 @@ def uninstall():
                           'resticbackup-check.service',
                           'resticbackup-check.timer',
                           'resticbackup-forget.service',
-                          'resticbackup-forget.timer',)
+                          'resticbackup-forget.timer',
+                          'resticbackup-daemon.service')
 
 
-def check_setup():
-    # Test if restic is installed, check backup
-    # repository, and remove any stale locks
-    try:
-        p = subprocess.run(["restic", "unlock"],
-                           stdout=subprocess.DEVNULL,
-                           stderr=subprocess.PIPE)
-        
-    except FileNotFoundError:
+def check_setup(repo: bool = True):
+    import preflight
+
+    # Test if restic is installed (cached for settings.PREFLIGHT_TTL hours),
+    # check backup repository, and remove stale locks only
+    info = preflight.restic_info(PREFLIGHT_FILE, settings.PREFLIGHT_TTL * 3600)
+
+    if not info:
         print("Error : Restic not found. Install it first.")
         sys.exit(1)
 
+    if not repo:
+        return
+
+    # Local repository : check it exists, and only remove the locks
+    # not refreshed for a long time or held by a dead process of this host
+    if os.path.isdir(settings.RESTIC_REPOSITORY):
+        if not os.path.exists(f'{settings.RESTIC_REPOSITORY}/config'):
+            print(f"Error : no restic repository found in {settings.RESTIC_REPOSITORY}")
+            sys.exit(1)
+
+        preflight.remove_locks(settings.RESTIC_REPOSITORY,
+                               preflight.stale_locks(settings.RESTIC_REPOSITORY))
+        return
+
+    # Remote repository : restic unlock only removes stale locks
+    p = subprocess.run(["restic", "unlock"],
+                       stdout=subprocess.DEVNULL,
+                       stderr=subprocess.PIPE)
+
     # Others errors
     if p.returncode != 0:
         print(p.stderr.decode())
@@ -290,46 +1869,20 @@ def check_setup():
 
 def notify(url: str,
            receiver: str,
-           msg: str) -> int:
+           msg: str):
     """Execution report via Signal messenger API.
 
-    Returns the response HTTP status code.
+    The message is spooled in the outbox and sent by a background thread
+    (notifier.py) : the job waits at most settings.NOTIFY_EXIT_WAIT seconds
+    for it at exit, undelivered messages are sent on the next run.
 
     Example :
     notify("http://localhost:8008/api/v1/rpc",
            "+33612345678",
            "Restic script execution complete")
     """
-
-    payload = {
-        'jsonrpc': '2.0',
-        'method': 'send',
-        'params': {
-            'recipient': [receiver],
-            'message': f"Resticbak notifier\n{msg}"
-        },
-        'id': 1
-    }
-
-    headers = {
-        'Content-Type': 'application/json'
-    }
-
-    # Sending the request
-    try:
-        response = requests.post(url,
-                                 headers=headers,
-                                 data=json.dumps(payload))
-
-        if response.status_code == 200:
-            print("Notification sent")
-            # print('Response:', response.json())
-        else:
-            print(f"Failed to send notification (code {response.status_code})")
-            print('Response:', response.text)
-            
-    except requests.ConnectionError:
-        print("Connection error, check if Signal daemon is running.")
+    notifier.enqueue(OUTBOX_DIR, url, receiver, msg)
+    notifier.start(OUTBOX_DIR, settings.NOTIFY_EXIT_WAIT)
 
 
 """
@@ -338,27 +1891,61 @@ Program entry point
 if __name__ == "__main__":
     print("Restic backup wrapper script")
 
-    check_setup()
-
     if len(sys.argv) == 1:
         print("Usage : resticback up.py <argument>\n" \
             "Arguments :\n" \
             "\tbackup : run a Restic backup\n" \
             "\tcheck : full check the Restic backup repository\n" \
             "\tforget : remove (Restic forget + prune) older snapshots applying the user settings (settings.py) policy\n" \
-            "\tinstall : install Systemd units (service and timer)\n" \
+            "\tprune : remove unused data, if worth it and within the settings budget\n" \
+            "\tverify-packs : hash the local repository pack files to detect bit rot, within the settings budget\n" \
+            "\trestore <snapshot|latest> [paths] --target <dir> [--verify] : restore files, subtrees in parallel\n" \
+            "\texcludes [--preview] : check the exclude rules, and preview the files and bytes each one removes\n" \
+            "\thistory : list the last runs, with backup throughput trends and anomalies\n" \
+            "\tcapacity : show the repository size, free space, growth and days until full\n" \
+            "\tindex : sync the local snapshot content index with the repository\n" \
+            "\tsearch <pattern> [--min-size, --max-size, --newer, --older, --snapshot, --limit] : search the indexed snapshots files\n" \
+            "\ttune : find the fastest restic setup for this host with trial backups\n" \
+            "\tdaemon : run the backup, check and forget jobs from one scheduler daemon\n" \
+            "\tinstall : install Systemd units (service and timer, or daemon service)\n" \
             "\tuninstall : remove Systemd units")
         sys.exit(0)
 
-    elif len(sys.argv) > 2:
+    elif len(sys.argv) > 2 and sys.argv[1:] != ["excludes", "--preview"] \
+    and sys.argv[1] not in ("search", "restore"):
         print("This scripts takes only one argument")
         sys.exit(1)
 
     arg = sys.argv[1]
 
+    if arg not in COMMANDS:
+        print(f"Unknown argument : {arg}. Run without argument for the usage.")
+        sys.exit(1)
+
+    # Send the notifications left undelivered by previous runs
+    if settings.NOTIFY and os.path.isdir(OUTBOX_DIR) \
+    and any(name.endswith(".json") for name in os.listdir(OUTBOX_DIR)):
+        notifier.start(OUTBOX_DIR, settings.NOTIFY_EXIT_WAIT)
+
+    # Let systemd stop a job making no progress (units with WatchdogSec)
+    if settings.PROGRESS_WATCHDOG and (arg in JOB_LOCKS or arg == "daemon"):
+        progress.watchdog(settings.PROGRESS_WATCHDOG * 60)
+
     match arg:
-        case "backup": backup()  
-        case "check": check()
-        case "forget": forget()
+        case "backup": run_locked("backup", backup)
+        case "check": run_locked("check", check)
+        case "forget": run_locked("forget", forget)
+        case "prune": run_locked("prune", prune)
+        case "verify-packs": run_locked("verify-packs", verify_packs)
+        case "restore":
+            opts = restore_args(sys.argv[2:])
+            run_locked("restore", lambda: restore(opts))
+        case "excludes": show_excludes(preview="--preview" in sys.argv)
+        case "history": show_history()
+        case "capacity": show_capacity()
+        case "index": run_locked("index", index)
+        case "search": search(sys.argv[2:])
+        case "tune": run_locked("tune", tune)
+        case "daemon": daemon()
         case "install": install()
         case "uninstall": uninstall()
\ No newline at end of file
@@ -0,0 +1,191 @@
+# Restic subprocess runner
+#
+# Reads restic stdout and stderr at the same time (stderr in a thread),
+# so a process writing lots of warnings can't fill a pipe and hang,
+# and keeps only bounded tails of both outputs in memory.
+
+import json
+import subprocess
+import threading
+import time
+from collections import deque
+
+TAIL_LINES = 50     # Lines of stdout/stderr kept for the final report
+MAX_ERRORS = 1000   # Per-path "error" messages kept for the final report
+
+
+def run(args: list,
+        echo_stdout: bool = False,
+        echo_stderr: bool = True,
+        on_message=None,
+        env: dict = None,
+        stdout_reader=None,
+        timeout: float = None,
+        stdin=None) -> dict:
+    """
+    Run a restic command and pump its stdout and stderr concurrently.
+
+    Stdout lines are decoded as JSON when possible (restic --json) and
+    classified by their "message_type" as they arrive : the last
+    "summary" object is kept, "error" items are collected per path,
+    and every decoded message is passed to on_message(msg) if given.
+    Other lines are kept as plain text.
+
+    If stdout_reader is given, it's called with the stdout stream instead
+    (ex : forgetjson.parse) and its return value is stored in 'parsed'.
+
+    If timeout (seconds) is given, restic is terminated when it runs
+    longer, and 'timed_out' is set.
+
+    stdin is passed to restic as is, ex : the stdout pipe of a dump
+    command for restic backup --stdin.
+
+    Returns a dict :
+    {'returncode': 0,
+     'summary': {...} or None,
+     'errors': [{'item': '/path', 'during': 'archival', 'message': '...'}],
+     'errors_count': 1,
+     'messages': {'status': 1520, 'summary': 1, 'error': 1},
+     'stdout': deque([... last stdout lines ...]),
+     'stderr': deque([... last stderr lines ...]),
+     'duration': 12.3,
+     'parsed': None,
+     'timed_out': False}
+
+    Example :
+    run(["restic", "backup", "/data", "--json"])
+    """
+    start = time.monotonic()
+    ps = subprocess.Popen(args,
+                          text=True,
+                          stdout=subprocess.PIPE,
+                          stderr=subprocess.PIPE,
+                          stdin=stdin,
+                          env=env)
+
+    res = {'returncode': None,
+           'summary': None,
+           'errors': [],
+           'errors_count': 0,
+           'messages': {},
+           'stdout': deque(maxlen=TAIL_LINES),
+           'stderr': deque(maxlen=TAIL_LINES),
+           'duration': 0,
+           'parsed': None,
+           'timed_out': False}
+
+    def kill():
+        res['timed_out'] = True
+        ps.terminate()
+
+    timer = None
+    if timeout:
+        timer = threading.Timer(timeout, kill)
+        timer.daemon = True
+        timer.start()
+
+    def pump_stderr():
+        for err_line in ps.stderr:
+            if echo_stderr:
+                print(err_line, end='')
+            res['stderr'].append(err_line)
+
+    err_thread = threading.Thread(target=pump_stderr, daemon=True)
+    err_thread.start()
+
+    if stdout_reader:
+        try:
+            res['parsed'] = stdout_reader(ps.stdout)
+        except ValueError as e:
+            print(f"Failed to parse restic output : {e}")
+
+        # Drain what the reader left, restic must not block on a full pipe
+        for line in ps.stdout:
+            res['stdout'].append(line)
+
+    for line in ps.stdout:
+        if echo_stdout:
+            print(line, end='')
+
+        msg = None
+        if line.startswith('{'):
+            try:
+                msg = json.loads(line)
+            except ValueError:
+                pass
+
+        if not isinstance(msg, dict) or 'message_type' not in msg:
+            res['stdout'].append(line)
+            continue
+
+        msg_type = msg['message_type']
+        res['messages'][msg_type] = res['messages'].get(msg_type, 0) + 1
+
+        if msg_type == "summary":
+            res['summary'] = msg
+        elif msg_type == "error":
+            res['errors_count'] += 1
+            if len(res['errors']) < MAX_ERRORS:
+                res['errors'].append(parse_error(msg))
+
+        if on_message:
+            on_message(msg)
+
+    err_thread.join()
+    ps.wait()
+
+    if timer:
+        timer.cancel()
+
+    res['returncode'] = ps.returncode
+    res['duration'] = time.monotonic() - start
+
+    return res
+
+
+def parse_time(stamp: str) -> float:
+    """
+    Parse a restic time (RFC 3339 with nanoseconds, in snapshots, nodes
+    and locks) to a timestamp, ex : "2024-09-06T10:00:00.123456789+02:00"
+    """
+    import re
+    from datetime import datetime
+
+    # Python only parses up to microseconds
+    stamp = re.sub(r'(\.\d{6})\d+', r'\1', stamp)
+    stamp = stamp.replace('Z', '+00:00')
+    return datetime.fromisoformat(stamp).timestamp()
+
+
+def parse_error(msg: dict) -> dict:
+    """
+    Normalize a restic "error" message. Depending on the restic version,
+    "error" is either a string or an object with a "message" key.
+    """
+    err = msg.get('error')
+
+    if isinstance(err, dict):
+        err = err.get('message', '')
+
+    return {'item': msg.get('item', ''),
+            'during': msg.get('during', ''),
+            'message': err or ''}
+
+
+def errors_report(res: dict, limit: int = 10) -> str:
+    """
+    Format the per-path errors of a run() result, ex :
+    "- 2 errors\\n  /data/a : permission denied\\n  /data/b : ..."
+    """
+    if not res['errors_count']:
+        return ""
+
+    lines = [f"- {res['errors_count']} errors"]
+
+    for err in res['errors'][:limit]:
+        lines.append(f"  {err['item']} : {err['message']}")
+
+    if res['errors_count'] > limit:
+        lines.append(f"  ... and {res['errors_count'] - limit} more")
+
+    return "\n".join(lines)
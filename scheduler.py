@@ -0,0 +1,228 @@
+# Job scheduler daemon
+#
+# One long running asyncio loop replacing the backup/check/forget systemd
+# timers : jobs are queued on their OnCalendar expression, only
+# lock-compatible jobs run at the same time (restic backups share the
+# repository, check and forget/prune need it alone), runs missed while
+# the daemon was down are caught up, and a failed job is retried once.
+
+import asyncio
+import statefile
+import time
+from datetime import datetime, timedelta
+
+WEEKDAYS = ["mon", "tue", "wed", "thu", "fri", "sat", "sun"]
+
+SHORTCUTS = {'minutely': "*-*-* *:*:00",
+             'hourly': "*-*-* *:00:00",
+             'daily': "*-*-* 00:00:00",
+             'weekly': "Mon *-*-* 00:00:00",
+             'monthly': "*-*-01 00:00:00",
+             'yearly': "*-01-01 00:00:00",
+             'annually': "*-01-01 00:00:00",
+             'quarterly': "*-01,04,07,10-01 00:00:00",
+             'semiannually': "*-01,07-01 00:00:00"}
+
+
+def parse_field(field: str,
+                low: int,
+                high: int) -> set:
+    """
+    Expand a calendar field : "*", "5", "1,15", "1..5", "*/15", "0/6".
+    """
+    values = set()
+
+    for part in field.split(","):
+        step = 1
+        if "/" in part:
+            part, step = part.split("/")
+            step = int(step)
+
+        if part == "*":
+            start, end = low, high
+        elif ".." in part:
+            start, end = (int(v) for v in part.split(".."))
+        else:
+            start = int(part)
+            end = high if step > 1 else start
+
+        values.update(range(start, end + 1, step))
+
+    return {v for v in values if low <= v <= high}
+
+
+def parse_weekdays(field: str) -> set:
+    """
+    Expand a weekday field, ex : "Mon..Fri", "Sat,Sun" -> {0, 1, 2, 3, 4}
+    """
+    days = set()
+
+    for part in field.lower().split(","):
+        if ".." in part:
+            start, end = (WEEKDAYS.index(d[:3]) for d in part.split(".."))
+            days.update(range(start, end + 1))
+        else:
+            days.add(WEEKDAYS.index(part[:3]))
+
+    return days
+
+
+def parse_calendar(expr: str) -> dict:
+    """
+    Parse a systemd OnCalendar expression (shortcuts, and
+    "[weekdays] [year-month-day] [hour:minute[:second]]" with "*",
+    lists, ".." ranges and "/" repetitions). Raises ValueError otherwise.
+    """
+    expr = SHORTCUTS.get(expr.strip().lower(), expr.strip())
+    parts = expr.split()
+    spec = {'weekdays': set(range(7))}
+
+    try:
+        if parts and parts[0][0].isalpha():
+            spec['weekdays'] = parse_weekdays(parts.pop(0))
+
+        date = parts.pop(0) if parts and "-" in parts[0] else "*-*-*"
+        clock = parts.pop(0) if parts else "00:00:00"
+
+        if parts:
+            raise ValueError
+
+        year, month, day = date.split("-")
+        clock = clock.split(":")
+        if len(clock) == 2:
+            clock.append("00")
+        hour, minute, second = clock
+
+        spec.update({'years': None if year == "*" else parse_field(year, 1970, 9999),
+                     'months': parse_field(month, 1, 12),
+                     'days': parse_field(day, 1, 31),
+                     'hours': parse_field(hour, 0, 23),
+                     'minutes': parse_field(minute, 0, 59),
+                     'seconds': parse_field(second.split(".")[0], 0, 59)})
+    except (ValueError, IndexError):
+        raise ValueError(f"Unsupported calendar expression : {expr}")
+
+    return spec
+
+
+def next_elapse(expr: str,
+                after: float) -> float:
+    """
+    Return the first time matching the calendar expression strictly
+    after the given timestamp (local time).
+
+    Example :
+    next_elapse("*-*-* 04:00:00", time.time())
+    """
+    spec = parse_calendar(expr)
+    base = datetime.fromtimestamp(after)
+    day = base.replace(hour=0, minute=0, second=0, microsecond=0)
+
+    # Calendar expressions repeat at least every 4 years (Feb 29th)
+    for _ in range(366 * 4 + 1):
+        if day.month in spec['months'] \
+        and day.day in spec['days'] \
+        and day.weekday() in spec['weekdays'] \
+        and (spec['years'] is None or day.year in spec['years']):
+            for h in sorted(spec['hours']):
+                for m in sorted(spec['minutes']):
+                    for s in sorted(spec['seconds']):
+                        elapse = day.replace(hour=h, minute=m, second=s)
+                        if elapse > base:
+                            return elapse.timestamp()
+        day += timedelta(days=1)
+
+    raise ValueError(f"Calendar expression never elapses : {expr}")
+
+
+def load(state_path: str) -> dict:
+    """
+    Load the last start time of each job, ex : {'backup': 1725600000.0}
+    """
+    return statefile.load(state_path, {})
+
+
+def save(state_path: str,
+         state: dict):
+    statefile.save(state_path, state)
+
+
+async def run(jobs: dict,
+              state_path: str,
+              retry_delay: float):
+    """
+    Run the jobs forever. jobs is a dict :
+    {'backup': {'calendar': "daily", 'exclusive': False, 'func': callable}, ...}
+    where func runs the job synchronously and returns its exit code.
+    It's run in a thread, so a shared job may run next to another one.
+    """
+    state = load(state_path)
+    queue = []
+    running = {}
+    retries = {}
+    tasks = set()   # Keep references, asyncio only holds weak ones
+    wakeup = asyncio.Event()
+
+    def spawn(coro):
+        task = asyncio.create_task(coro)
+        tasks.add(task)
+        task.add_done_callback(tasks.discard)
+        return task
+
+    def enqueue(name, reason):
+        if name in queue or name in running:
+            return
+        print(f"[{time.strftime('%Y-%m-%d %H:%M:%S')}] {name} queued ({reason})", flush=True)
+        queue.append(name)
+        wakeup.set()
+
+    async def timer(name):
+        # Catch up a run missed while the daemon was down
+        last = state.get(name)
+        if last and next_elapse(jobs[name]['calendar'], last) <= time.time():
+            enqueue(name, "missed run")
+
+        while True:
+            delay = next_elapse(jobs[name]['calendar'], time.time()) - time.time()
+            await asyncio.sleep(max(delay, 0))
+            enqueue(name, "calendar")
+            await asyncio.sleep(1)
+
+    async def retry(name):
+        await asyncio.sleep(retry_delay)
+        enqueue(name, "retry")
+
+    async def execute(name, attempt):
+        start = time.monotonic()
+        code = await asyncio.to_thread(jobs[name]['func'])
+        del running[name]
+        print(f"[{time.strftime('%Y-%m-%d %H:%M:%S')}] {name} finished " \
+              f"(code {code}, {time.monotonic() - start:.0f}s)", flush=True)
+
+        if code != 0 and attempt == 0 and retry_delay:
+            retries[name] = 1
+            spawn(retry(name))
+        else:
+            retries.pop(name, None)
+        wakeup.set()
+
+    def compatible(name):
+        # Exclusive jobs run alone, shared jobs run together
+        if jobs[name]['exclusive']:
+            return not running
+        return not any(jobs[other]['exclusive'] for other in running)
+
+    for name in jobs:
+        spawn(timer(name))
+
+    while True:
+        await wakeup.wait()
+        wakeup.clear()
+
+        # First in first out : a waiting exclusive job isn't overtaken
+        while queue and compatible(queue[0]):
+            name = queue.pop(0)
+            running[name] = spawn(execute(name, retries.get(name, 0)))
+
+            state[name] = time.time()
+            save(state_path, state)
@@ -1,30 +1,52 @@
 from configparser import ConfigParser
+import io
 import os
 import subprocess
 import sys
+import tempfile
 
-def service(unit_filename: str,
-            description: str,
-            after: str,
-            type: str,
-            execstart: str,
-            restart: str,
-            restartsec: str,
-            user: str,
-            startnow: bool = False):
+SYSTEMD_DIR = "/etc/systemd/system"
+
+# Optional [Service] directives, only set for the units needing them
+EXTRA_OPTIONS = ('NotifyAccess', 'WatchdogSec',
+                 'Nice', 'IOSchedulingClass', 'CPUQuota', 'IOWeight', 'MemoryHigh', 'CPUAffinity')
+
+def template(name: str) -> ConfigParser:
     """
-    Auto configure and install Systemd units (service and timer)
-    for the given process (backup, check, or forget)
+    Load a unit template (template.service or template.timer),
+    the template files themselves are never modified
     """
-    
     working_dir = os.path.dirname(os.path.abspath(sys.argv[0]))
 
-    # Auto configure service unit file (resticbackup.service)
-    template_path = f'{working_dir}/systemd-units/template.service'
+    config = ConfigParser()
+    config.optionxform = str # preserve case
+    config.read(f'{working_dir}/systemd-units/{name}')
+
+    return config
+
+
+def render(config: ConfigParser) -> str:
+    output = io.StringIO()
+    config.write(output,
+                 space_around_delimiters=False)
+
+    return output.getvalue()
 
-    service_config = ConfigParser()
-    service_config.optionxform = str # preserve case
-    service_config.read(template_path)
+
+def render_service(description: str,
+                   after: str,
+                   type: str,
+                   execstart: str,
+                   restart: str,
+                   restartsec: str,
+                   user: str,
+                   options: dict = None) -> str:
+    """
+    Render a service unit from the template, in memory
+
+    options are extra [Service] directives, ex : {'WatchdogSec': "60"}
+    """
+    service_config = template('template.service')
 
     # Fill settings
     service_config.set('Unit', 'Description', description)
@@ -35,66 +57,185 @@ def service(unit_filename: str,
     service_config.set('Service', 'RestartSec', restartsec)
     service_config.set('Service', 'User', user)
 
-    # Write changes to template file
-    with open(template_path, 'w') as file:
-        service_config.write(file,
-                             space_around_delimiters=False)
+    for key in EXTRA_OPTIONS:
+        service_config.remove_option('Service', key)
+    for key, value in (options or {}).items():
+        service_config.set('Service', key, value)
 
-    # Copy units to /etc/systemd/system/ and run timer
-    subprocess.run(['sudo', 'cp',
-                    f'{working_dir}/systemd-units/template.service',
-                    f'/etc/systemd/system/{unit_filename}.service'])
+    return render(service_config)
 
-    subprocess.run(['sudo', 'systemctl',
-                    'daemon-reload'])
-    
-    subprocess.run(['sudo','systemctl',
-                    'enable', f'{unit_filename}.service'])
 
-    if startnow == True:
-        subprocess.run(['sudo', 'systemctl',
-                        'start', f'{unit_filename}.service'])
+def render_timer(description: str,
+                 oncalendar: str) -> str:
+    """
+    Render a timer unit from the template, in memory
+    """
+    timer_config = template('template.timer')
 
+    # Fill settings
+    timer_config.set('Unit', 'Description', description)
+    timer_config.set('Timer', 'OnCalendar', oncalendar)
 
-def timer(unit_filename: str,
-          description: str,
-          oncalendar: str):
+    return render(timer_config)
+
+
+def privileged(args: list) -> subprocess.CompletedProcess:
     """
-    Auto configure and install Systemd timer unit
-    for the given process (backup, check, or forget)
+    Run a command as root (through sudo if we're not)
     """
-    
-    working_dir = os.path.dirname(os.path.abspath(sys.argv[0]))
+    if os.geteuid() != 0:
+        args = ['sudo'] + args
 
-    # Get timer template file and change its settings
-    timer_template_path = f'{working_dir}/systemd-units/template.timer'
+    return subprocess.run(args)
 
-    timer_config = ConfigParser()
-    timer_config.optionxform = str # preserve case
-    timer_config.read(timer_template_path)
 
-    # Fill settings
-    timer_config.set('Unit', 'Description', description)
-    timer_config.set('Timer', 'OnCalendar', oncalendar)
+def unit_states(units: list) -> dict:
+    """
+    Return the enabled and active states of each unit, from the Id= of
+    each systemctl show block (a missing unit has a block too, with
+    empty states), ex :
+    {'resticbackup-backup.timer': {'UnitFileState': "enabled", 'ActiveState': "active"}}
+    """
+    if not units:
+        return {}
 
-    # Write changes to file
-    with open(timer_template_path, 'w') as file:
-        timer_config.write(file,
-                        space_around_delimiters=False)
+    p = subprocess.run(['systemctl', 'show', '-p', 'Id,UnitFileState,ActiveState'] + units,
+                       stdout=subprocess.PIPE,
+                       stderr=subprocess.DEVNULL,
+                       text=True)
 
-    # Copy file in the systemd file structure and run it
-    subprocess.run(['sudo', 'cp',
-                    f'{working_dir}/systemd-units/template.timer',
-                    f'/etc/systemd/system/{unit_filename}.timer'])
+    states = {}
+    for block in p.stdout.split('\n\n'):
+        properties = dict(line.split('=', 1) for line in block.splitlines() if '=' in line)
+        if properties.get('Id'):
+            states[properties.pop('Id')] = properties
 
-    subprocess.run(['sudo', 'systemctl',
-                    'daemon-reload'])
-    
-    subprocess.run(['sudo','systemctl',
-                    'enable', f'{unit_filename}.timer'])
+    return states
 
-    subprocess.run(['sudo', 'systemctl',
-                    'start', f'{unit_filename}.timer'])
+
+def write_unit(unit: str,
+               content: str):
+    """
+    Write a unit file atomically (temp file + rename in the same directory)
+    """
+    path = f'{SYSTEMD_DIR}/{unit}'
+    tmp_path = f'{SYSTEMD_DIR}/.{unit}.tmp'
+
+    if os.geteuid() == 0:
+        with open(tmp_path, 'w') as file:
+            file.write(content)
+        os.chmod(tmp_path, 0o644)
+        os.replace(tmp_path, path)
+        return
+
+    with tempfile.NamedTemporaryFile('w', suffix=f'.{unit}') as file:
+        file.write(content)
+        file.flush()
+        privileged(['install', '-m', '644', file.name, tmp_path])
+        privileged(['mv', '-f', tmp_path, path])
+
+
+def install_units(units: dict,
+                  enable: list = (),
+                  start: list = (),
+                  remove: list = ()) -> bool:
+    """
+    Install units rendered in memory ({unit file name: content}) : only
+    the files differing from /etc/systemd/system are written, then one
+    daemon-reload, and the units not enabled yet are enabled in one call
+    (enable, and for start, enable --now). Changed running units of start
+    are restarted. remove are units to stop, disable and delete first.
+    Running it again without changes is a no-op.
+    Returns True if anything changed.
+
+    Example :
+
+    install_units({'resticbackup-check.service': render_service(...),
+                   'resticbackup-check.timer': render_timer(...)},
+                  enable=['resticbackup-check.service'],
+                  start=['resticbackup-check.timer'])
+    """
+    remove = [unit for unit in remove if os.path.exists(f'{SYSTEMD_DIR}/{unit}')]
+    if remove:
+        privileged(['systemctl', 'disable', '--now'] + remove)
+        privileged(['rm', '-f'] + [f'{SYSTEMD_DIR}/{unit}' for unit in remove])
+
+    changed = []
+    for unit, content in units.items():
+        try:
+            with open(f'{SYSTEMD_DIR}/{unit}') as file:
+                if file.read() == content:
+                    continue
+        except FileNotFoundError:
+            pass
+
+        write_unit(unit, content)
+        changed.append(unit)
+
+    if changed or remove:
+        privileged(['systemctl', 'daemon-reload'])
+
+    # New settings of running units only apply once they're restarted
+    restart = [unit for unit in start if unit in changed]
+    if restart:
+        privileged(['systemctl', 'try-restart'] + restart)
+
+    states = unit_states(list(enable) + list(start))
+
+    def state(unit, key):
+        return states.get(unit, {}).get(key)
+
+    to_enable = [unit for unit in enable if state(unit, 'UnitFileState') != "enabled"]
+    to_start = [unit for unit in start
+                if state(unit, 'UnitFileState') != "enabled" or state(unit, 'ActiveState') != "active"]
+
+    if to_enable:
+        privileged(['systemctl', 'enable'] + to_enable)
+    if to_start:
+        privileged(['systemctl', 'enable', '--now'] + to_start)
+
+    for unit in changed:
+        print(f"- {unit} written")
+    for unit in remove:
+        print(f"- {unit} removed")
+
+    return bool(changed or remove or to_enable or to_start)
+
+
+def service(unit_filename: str,
+            description: str,
+            after: str,
+            type: str,
+            execstart: str,
+            restart: str,
+            restartsec: str,
+            user: str,
+            startnow: bool = False,
+            options: dict = None):
+    """
+    Auto configure and install a Systemd service unit
+    for the given process
+    """
+    unit = f'{unit_filename}.service'
+    content = render_service(description, after, type, execstart,
+                             restart, restartsec, user, options)
+
+    install_units({unit: content},
+                  enable=[] if startnow else [unit],
+                  start=[unit] if startnow else [])
+
+
+def timer(unit_filename: str,
+          description: str,
+          oncalendar: str):
+    """
+    Auto configure and install a Systemd timer unit
+    for the given process (backup, check, or forget)
+    """
+    unit = f'{unit_filename}.timer'
+
+    install_units({unit: render_timer(description, oncalendar)},
+                  start=[unit])
 
 
 def uninstall(*args):
@@ -105,17 +246,8 @@ def uninstall(*args):
 
     set_systemd.uninstall("resticbackup-check.timer",
                           "signal-daemon.service")
-    
+
     Will stop and disable these units, and remove
     these files from /etc/systemd/system/
     """
-    
-    for unit in args:
-        subprocess.run(['sudo', 'systemctl',
-                        'stop', unit])
-        
-        subprocess.run(['sudo', 'systemctl',
-                        'disable', unit])
-        
-        subprocess.run(['sudo', 'rm',
-                        f'/etc/systemd/system/{unit}'])
\ No newline at end of file
+    install_units({}, remove=list(args))
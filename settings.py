@@ -4,16 +4,70 @@
 RESTIC_REPOSITORY = "/media/usbdrive/"
 REPO_PASSWORD = "password"
 
+# Secondary repositories the new snapshots are copied to after each backup
+SECONDARY_REPOSITORIES = [# {'repository': "/media/usbdrive2/", 'password': "password"},
+                         ]
+REPLICATION_CONCURRENCY = 2 # Secondary repositories copied to at the same time
+REPLICATION_TIMEOUT = 240   # Max minutes per secondary repository (0 : no limit)
+
+# Script state files directory (indexes, caches...)
+# Empty : /var/lib/resticbak if run by root, ~/.local/state/resticbak otherwise
+STATE_DIR = ""
+
+PREFLIGHT_TTL = 24     # Hours the restic binary path/version check is cached
+
 # Backup settings
 DATA_TO_BAK = ["/media/usbdrive/work/",
                "/media/usbdrive/personal/",
                "/media/usbdrive/catmemes/",]
 DATA_TO_IGNORE = ["/media/usbdrive/confidential/",
                   "/media/usbdrive/catmemes/cats_with_sombreros/",]
+# Exclude rules : restic glob 'pattern' or python 'regex' (searched in the full
+# path), optionally relative to / only applied to one backup 'source'
+EXCLUDES = [# {'pattern': "*.tmp"},
+            # {'pattern': "node_modules/", 'source': "/media/usbdrive/work/"},
+            # {'regex': r"/\.cache/"},
+           ]
+EXCLUDE_LARGER_THAN = ""    # Exclude files larger than this, ex : "2G"
+EXCLUDE_CACHES = False      # Exclude directories holding a CACHEDIR.TAG file
+# Command sources : their output is piped to restic backup --stdin (no temporary
+# dump file), one snapshot per command, while the files are backed up
+STDIN_SOURCES = [# {'name': "postgres", 'command': ["pg_dumpall"], 'filename': "pg_dumpall.sql"},
+                ]
+STDIN_CONCURRENCY = 2       # Command sources backed up at the same time
 SNAPSHOT_TAG = "Run by resticbackup.py script"
+BACKUP_PARALLEL = False # Run one restic process per source (or group of sources)
+BACKUP_CONCURRENCY = 2  # Max restic backup processes running at the same time
+BACKUP_GROUPS = []      # Optional groups of sources, ex : [["/a/", "/b/"], ["/c/"]]
+                        # (the sources left out each get their own group)
+PRESCAN = False         # Skip restic when no file changed since the last snapshot
+PRESCAN_WORKERS = 4     # Parallel directory scans
+PRESCAN_MAX_INTERVAL = 168 # Max hours between two real snapshots, even without changes
+
+# Repository capacity settings (resticbak.py capacity)
+CAPACITY_RESERVE = "1G"         # Free space always left on the repository filesystem
+CAPACITY_MARGIN = 1.5           # A backup doesn't start unless the free space above the reserve
+                                # holds this times the largest data added by the recent backups
+CAPACITY_WINDOW = 30            # Days of growth the "days until full" forecast is based on
+CAPACITY_WARN_DAYS = 30         # Warn in the backup report when full in less days
+CAPACITY_RECONCILE_INTERVAL = 30    # Days between two full (slow) restic stats, run after a check
+
+# Performance tuning settings (resticbak.py tune)
+TUNE_APPLY = True       # Apply the setup found by "tune" to backups
+TUNE_SAMPLE_SIZE = 512  # MiB of the backup sources used for the trial backups
+TUNE_SCRATCH_DIR = ""   # Scratch repositories parent dir (empty : RESTIC_REPOSITORY parent dir)
 
 # Check settings
 CHECK_SUBSET = "10%" # Subset of random data to read/check, in % or M/G/T
+CHECK_MODE = "random"   # "random" : CHECK_SUBSET, "rotate" : read 1/CHECK_PARTS
+                        # of the data per check, in turn, "budget" : rotate with
+                        # parts sized to be read in CHECK_TIME_BUDGET
+CHECK_PARTS = 30        # "rotate" mode : whole data read once every 30 checks (1 to 256)
+CHECK_TIME_BUDGET = 90  # "budget" mode : max minutes to read one part
+
+# Pack verification settings (resticbak.py verify-packs, local repositories only)
+VERIFY_PACKS_BUDGET = 60        # Max minutes of hashing per run (0 : no limit)
+VERIFY_PACKS_CONCURRENCY = 0    # Packs hashed at the same time (0 : one per CPU)
 
 # Forget settings / backup snapshots an datas retention
 KEEP_LAST = 5 # Will keep the 5 last snaphots
@@ -22,13 +76,63 @@ KEEP_WEEKLY = 5 # " 5 last weeks
 KEEP_MONTHLY = 5 # "
 KEEP_YEARLY = 5 # "
 
+# Prune settings (after forget, or resticbak.py prune)
+PRUNE_AFTER_FORGET = True
+PRUNE_MAX_UNUSED = "5%"     # Unused space allowed to stay in the repository
+PRUNE_MAX_REPACK_SIZE = ""  # Max data repacked per prune, ex : "10G" (empty : no limit)
+PRUNE_TIME_LIMIT = 120      # Max minutes of repack, from the previous prunes throughput (0 : no limit)
+                            # (10 MiB/s assumed until a prune measured it)
+PRUNE_MIN_FREE = "1G"       # Postpone the prune if it frees less than this...
+PRUNE_MAX_INTERVAL = 90     # ...unless the last prune is older than this (days)
+
+# Restore settings (resticbak.py restore)
+RESTORE_CONCURRENCY = 2     # Subtrees restored at the same time
+
+# Jobs resource control : systemd directives of their units (Nice, IOSchedulingClass,
+# CPUQuota, IOWeight, MemoryHigh, CPUAffinity, resticbak.py install again to apply),
+# restic being sized to match (GOMAXPROCS, GOMEMLIMIT), and restic bandwidth limits
+# in KiB/s (limit_upload, limit_download). "daemon" is the scheduler daemon unit,
+# "forget" also covers prune, "restore" only the restic flags and sizing.
+RESOURCES = {'backup': {'Nice': 10, 'IOSchedulingClass': "best-effort", 'IOWeight': 20},
+                        # 'CPUQuota': "200%", 'MemoryHigh': "2G", 'CPUAffinity': "2-3"
+             'check': {'Nice': 15, 'IOSchedulingClass': "idle", 'IOWeight': 10},
+             'forget': {'Nice': 10, 'IOSchedulingClass': "best-effort", 'IOWeight': 20},
+             'daemon': {'Nice': 10, 'IOSchedulingClass': "best-effort", 'IOWeight': 20},
+            }
+
 # Systemd timer settings for executions periodicity
 # Informations about timer OnCalendar syntax : https://silentlad.com/systemd-timers-oncalendar-(cron)-format-explained
 CALENDAR_BACKUP = "daily"           # Every day except sunday, at midnight
 CALENDAR_CHECK = "*-*-* 04:00:00"   # Every day at 4:00am
 CALENDAR_FORGET = "monthly"         # Every month (the first of each month)
 
+# "timers" : one systemd service + timer per job, "daemon" : one scheduler
+# daemon service running all the jobs, without lock collisions
+SCHEDULER = "timers"
+DAEMON_RETRY_DELAY = 40     # Minutes before a failed job is retried (daemon)
+
+# Job lock : backups share the repository, check/forget/prune wait for it alone
+JOB_LOCK_DIR = "/run/lock"  # Lock files directory, shared by every user running jobs
+JOB_LOCK_MAX_WAIT = 360     # Max minutes a job waits for the repository lock
+
+# Progress of the restic jobs (also shown by systemctl status)
+PROGRESS_INTERVAL = 30  # Seconds between two progress lines in the logs
+PROGRESS_WATCHDOG = 0   # Minutes without progress after which systemd stops the job
+                        # (units watchdog, resticbak.py install again to apply) (0 : disabled)
+
+# Prometheus node_exporter textfile collector directory (empty : disabled)
+METRICS_DIR = ""    # ex : "/var/lib/node_exporter/textfile_collector"
+
+# Local snapshot content index (resticbak.py index / search)
+INDEX = False   # Add the new snapshots to the index after each backup, drop the forgotten ones
+
+# Run history settings (resticbak.py history)
+HISTORY_WINDOW = 14     # Previous backups used as throughput/data added baseline
+HISTORY_THRESHOLD = 4   # Deviations from the baseline median to flag a backup
+
 # Notify settings
 NOTIFY = False
 SIGNAL_API_URL = "http://localhost:8008/api/v1/rpc"
-SIGNAL_RECEIVER = "+33612345678"
\ No newline at end of file
+SIGNAL_RECEIVER = "+33612345678"
+NOTIFY_EXIT_WAIT = 10   # Max seconds a job waits at exit for its notifications,
+                        # undelivered ones are sent on the next run
\ No newline at end of file
@@ -0,0 +1,231 @@
+# Local snapshot content index
+#
+# The restic ls --json output of every snapshot is stored in a SQLite
+# database (paths stored once, full text indexed with trigrams), so
+# "which snapshots hold this file, and which versions of it" is answered
+# in milliseconds without opening the repository. Snapshots are added
+# one at a time after each backup, and dropped once forgotten.
+
+import json
+import os
+import re
+import runner
+import sqlite3
+
+BATCH_SIZE = 10000
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS snapshots (
+    key INTEGER PRIMARY KEY,
+    id TEXT NOT NULL UNIQUE,
+    time REAL NOT NULL,
+    hostname TEXT,
+    paths TEXT,
+    tags TEXT
+);
+CREATE TABLE IF NOT EXISTS paths (
+    id INTEGER PRIMARY KEY,
+    path TEXT NOT NULL UNIQUE
+);
+CREATE TABLE IF NOT EXISTS entries (
+    snapshot INTEGER NOT NULL,
+    path INTEGER NOT NULL,
+    type TEXT,
+    size INTEGER,
+    mtime REAL,
+    PRIMARY KEY (snapshot, path)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS entries_path ON entries (path);
+CREATE VIRTUAL TABLE IF NOT EXISTS paths_fts
+    USING fts5(path, content='paths', content_rowid='id', tokenize='trigram');
+CREATE TRIGGER IF NOT EXISTS paths_insert AFTER INSERT ON paths BEGIN
+    INSERT INTO paths_fts (rowid, path) VALUES (new.id, new.path);
+END;
+CREATE TRIGGER IF NOT EXISTS paths_delete AFTER DELETE ON paths BEGIN
+    INSERT INTO paths_fts (paths_fts, rowid, path) VALUES ('delete', old.id, old.path);
+END;
+"""
+
+
+def connect(db_path: str) -> sqlite3.Connection:
+    os.makedirs(os.path.dirname(db_path), exist_ok=True)
+    con = sqlite3.connect(db_path, timeout=30)
+    con.row_factory = sqlite3.Row
+    con.executescript(SCHEMA)
+    return con
+
+
+def indexed(db_path: str) -> set:
+    """
+    Return the IDs of the indexed snapshots.
+    """
+    con = connect(db_path)
+    ids = {row['id'] for row in con.execute("SELECT id FROM snapshots")}
+    con.close()
+
+    return ids
+
+
+def load_ls(con: sqlite3.Connection,
+            stream) -> dict:
+    """
+    Index a restic ls --json output read from a text stream : the
+    snapshot object first, then one node per line. Nodes are inserted
+    in batches through a temporary table, so memory stays bounded.
+    Returns the snapshot ID and its entries count, ex :
+    {'id': '4f5e...', 'entries': 120345}
+    """
+    con.execute("CREATE TEMP TABLE IF NOT EXISTS ls "
+                "(path TEXT, type TEXT, size INTEGER, mtime REAL)")
+    snapshot = None
+    count = 0
+    batch = []
+
+    def flush():
+        con.executemany("INSERT INTO ls VALUES (?, ?, ?, ?)", batch)
+        con.execute("INSERT OR IGNORE INTO paths (path) SELECT path FROM ls")
+        con.execute("INSERT OR REPLACE INTO entries "
+                    "SELECT ?, paths.id, ls.type, ls.size, ls.mtime "
+                    "FROM ls JOIN paths ON paths.path = ls.path", (snapshot,))
+        con.execute("DELETE FROM ls")
+        batch.clear()
+
+    for line in stream:
+        try:
+            msg = json.loads(line)
+        except ValueError:
+            continue
+
+        kind = msg.get('message_type') or msg.get('struct_type')
+
+        if kind == "snapshot":
+            con.execute("DELETE FROM snapshots WHERE id = ?", (msg['id'],))
+            snapshot = con.execute("INSERT INTO snapshots (id, time, hostname, paths, tags) "
+                                   "VALUES (?, ?, ?, ?, ?)",
+                                   (msg['id'], runner.parse_time(msg['time']),
+                                    msg.get('hostname'),
+                                    json.dumps(msg.get('paths') or []),
+                                    json.dumps(msg.get('tags') or []))).lastrowid
+
+        elif kind == "node" and snapshot is not None:
+            batch.append((msg['path'], msg.get('type'), msg.get('size'),
+                          runner.parse_time(msg['mtime']) if msg.get('mtime') else None))
+            count += 1
+            if len(batch) >= BATCH_SIZE:
+                flush()
+
+    if snapshot is None:
+        raise ValueError("no snapshot in restic ls output")
+
+    if batch:
+        flush()
+
+    return {'id': con.execute("SELECT id FROM snapshots WHERE key = ?",
+                              (snapshot,)).fetchone()['id'],
+            'entries': count}
+
+
+def remove(db_path: str,
+           snapshot_ids: list):
+    """
+    Drop snapshots from the index, and the paths no snapshot holds anymore.
+    """
+    con = connect(db_path)
+
+    with con:
+        for snapshot_id in snapshot_ids:
+            row = con.execute("SELECT key FROM snapshots WHERE id = ?",
+                              (snapshot_id,)).fetchone()
+            if row:
+                con.execute("DELETE FROM entries WHERE snapshot = ?", (row['key'],))
+                con.execute("DELETE FROM snapshots WHERE key = ?", (row['key'],))
+
+        con.execute("DELETE FROM paths WHERE NOT EXISTS "
+                    "(SELECT 1 FROM entries WHERE entries.path = paths.id)")
+    con.close()
+
+
+def search(db_path: str,
+           pattern: str = None,
+           min_size: int = None,
+           max_size: int = None,
+           newer: float = None,
+           older: float = None,
+           snapshot: str = None,
+           limit: int = 50) -> list:
+    """
+    Search the indexed snapshots. pattern is a substring of the path
+    (case insensitive), or a glob if it holds *, ? or [ ("*" also matches
+    "/"). Sizes are in bytes, newer/older are file mtime timestamps,
+    snapshot an ID prefix.
+
+    Returns at most limit paths, each with its distinct versions, newest
+    first :
+    [{'path': '/data/db.sql', 'type': 'file',
+      'versions': [{'size': 1024, 'mtime': 1725600000.0, 'snapshots': 3,
+                    'first': {'id': ..., 'time': ...}, 'last': {'id': ..., 'time': ...}}]}]
+
+    Example :
+    search("/var/lib/resticbak/index.db", "*.sql", min_size=1024 ** 2)
+    """
+    where = []
+    params = []
+
+    if pattern and re.search(r'[*?\[]', pattern):
+        where.append("paths.path GLOB ?")
+        params.append(pattern if pattern.startswith(("/", "*")) else f"*{pattern}")
+    elif pattern and len(pattern) >= 3:
+        # Trigram full text index, the pattern quoted as one string
+        where.append("paths.id IN (SELECT rowid FROM paths_fts WHERE paths_fts MATCH ?)")
+        params.append('"' + pattern.replace('"', '""') + '"')
+    elif pattern:
+        where.append("paths.path LIKE ?")
+        params.append(f"%{pattern}%")
+
+    for clause, value in (("entries.size >= ?", min_size),
+                          ("entries.size <= ?", max_size),
+                          ("entries.mtime >= ?", newer),
+                          ("entries.mtime <= ?", older)):
+        if value is not None:
+            where.append(clause)
+            params.append(value)
+
+    if snapshot:
+        where.append("snapshots.id LIKE ?")
+        params.append(f"{snapshot}%")
+
+    condition = " AND ".join(where) or "1"
+    joins = "FROM entries " \
+            "JOIN paths ON paths.id = entries.path " \
+            "JOIN snapshots ON snapshots.key = entries.snapshot "
+
+    # The limit applies to the paths, each one listed with all its versions
+    con = connect(db_path)
+    rows = con.execute("SELECT paths.path, entries.type, entries.size, entries.mtime, "
+                       f"snapshots.id, snapshots.time {joins}"
+                       f"WHERE paths.id IN (SELECT paths.id {joins}WHERE {condition} "
+                       "GROUP BY paths.id ORDER BY paths.path LIMIT ?) "
+                       f"AND {condition} "
+                       "ORDER BY paths.path, snapshots.time",
+                       params + [limit] + params).fetchall()
+    con.close()
+
+    results = {}
+    for row in rows:
+        res = results.setdefault(row['path'], {'path': row['path'],
+                                               'type': row['type'],
+                                               'versions': {}})
+        snap = {'id': row['id'], 'time': row['time']}
+        version = res['versions'].setdefault((row['size'], row['mtime']),
+                                             {'size': row['size'],
+                                              'mtime': row['mtime'],
+                                              'snapshots': 0,
+                                              'first': snap})
+        version['snapshots'] += 1
+        version['last'] = snap
+
+    for res in results.values():
+        res['versions'] = sorted(res['versions'].values(),
+                                 key=lambda v: v['last']['time'], reverse=True)
+
+    return list(results.values())
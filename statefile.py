@@ -0,0 +1,52 @@
+# JSON state files
+#
+# The state kept between runs (plans, caches, fingerprints, forecasts...)
+# is stored as small JSON files in STATE_DIR, written atomically : a
+# unique temp file in the same directory, synced, then renamed over the
+# old one, so a crash or a concurrent writer never leaves a partial file.
+
+import json
+import os
+import tempfile
+
+
+def load(path: str,
+         default=None):
+    """
+    Load a JSON state file, default if it's missing or unreadable.
+
+    Example :
+    load("/var/lib/resticbak/check.json", {'part': 1, 'parts': 0})
+    """
+    try:
+        with open(path, encoding='utf-8') as file:
+            return json.load(file)
+    except (FileNotFoundError, ValueError):
+        return default
+
+
+def save(path: str,
+         data,
+         indent: int = None):
+    """
+    Atomically write a JSON state file.
+    """
+    directory = os.path.dirname(path)
+    os.makedirs(directory, exist_ok=True)
+
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=f".{os.path.basename(path)}.", suffix=".tmp")
+
+    try:
+        os.fchmod(fd, 0o644)
+        with open(fd, 'w', encoding='utf-8') as file:
+            json.dump(data, file, indent=indent)
+            file.flush()
+            os.fsync(file.fileno())
+
+        os.replace(tmp_path, path)
+    except BaseException:
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+        raise
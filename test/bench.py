@@ -0,0 +1,130 @@
+#!/usr/bin/env python
+
+# Wrapper overhead benchmarks
+#
+# Puts a synthetic restic (fake_restic.py) on PATH and times backup(),
+# check() and forget() end to end with huge output streams, each in its
+# own interpreter so the peak RSS of every scenario can be measured.
+#
+# Usage : python3 test/bench.py [--scale 0.1] [--only backup-status] [--out bench_output.txt]
+
+import argparse
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+TEST_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(TEST_DIR)
+
+# Scenario name : (resticbak function, fake restic environment)
+SCENARIOS = {
+    'backup-status': ("backup", {'FAKE_RESTIC_STATUS_LINES': 1_000_000}),
+    'backup-errors': ("backup", {'FAKE_RESTIC_STATUS_LINES': 100_000,
+                                 'FAKE_RESTIC_ERRORS': 100_000}),
+    'backup-stderr': ("backup", {'FAKE_RESTIC_STATUS_LINES': 100_000,
+                                 'FAKE_RESTIC_STDERR_LINES': 500_000}),
+    'check': ("check", {'FAKE_RESTIC_CHECK_LINES': 100_000,
+                        'FAKE_RESTIC_STDERR_LINES': 100_000}),
+    'forget': ("forget", {'FAKE_RESTIC_FORGET_GROUPS': 5_000,
+                          'FAKE_RESTIC_FORGET_SNAPSHOTS': 20}),
+}
+
+
+def run_scenario(func_name: str,
+                 workdir: str,
+                 out_path: str):
+    """
+    Child process : run one resticbak function against the fake
+    restic and write its timing and peak RSS to out_path.
+    """
+    sys.path.insert(0, REPO_DIR)
+
+    import settings
+    settings.RESTIC_REPOSITORY = workdir
+    settings.DATA_TO_BAK = [workdir]
+    settings.DATA_TO_IGNORE = []
+    settings.STATE_DIR = f"{workdir}/state"
+    settings.METRICS_DIR = ""
+    settings.NOTIFY = False
+
+    import resticbak
+
+    start = time.perf_counter()
+    code = 0
+    try:
+        getattr(resticbak, func_name)()
+    except SystemExit as e:
+        code = e.code
+    elapsed = time.perf_counter() - start
+
+    with open(out_path, 'w') as file:
+        json.dump({'seconds': elapsed,
+                   'exit': code,
+                   'maxrss_kib': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss},
+                  file)
+
+
+def bench(name: str,
+          scale: float,
+          workdir: str) -> dict:
+    func_name, fake_env = SCENARIOS[name]
+
+    env = dict(os.environ)
+    env['PATH'] = f"{workdir}/bin{os.pathsep}{env['PATH']}"
+    env.update({k: str(max(1, int(v * scale))) for k, v in fake_env.items()})
+
+    out_path = f"{workdir}/{name}.json"
+    subprocess.run([sys.executable, __file__, "--run", func_name,
+                    "--workdir", workdir, "--result", out_path],
+                   env=env,
+                   stdout=subprocess.DEVNULL,
+                   stderr=subprocess.DEVNULL,
+                   check=True)
+
+    with open(out_path) as file:
+        return json.load(file)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="resticbak wrapper benchmarks")
+    parser.add_argument("--scale", type=float, default=1.0,
+                        help="multiply every scenario output size")
+    parser.add_argument("--only", action="append", choices=SCENARIOS,
+                        help="scenario(s) to run (default : all)")
+    parser.add_argument("--out", help="also write the results to this file")
+    parser.add_argument("--run", help=argparse.SUPPRESS)
+    parser.add_argument("--workdir", help=argparse.SUPPRESS)
+    parser.add_argument("--result", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run:
+        run_scenario(args.run, args.workdir, args.result)
+        return
+
+    with tempfile.TemporaryDirectory(prefix="resticbak-bench-") as workdir:
+        # Fake restic executable on PATH
+        os.makedirs(f"{workdir}/bin")
+        with open(f"{workdir}/bin/restic", 'w') as file:
+            file.write(f'#!/bin/sh\nexec "{sys.executable}" "{TEST_DIR}/fake_restic.py" "$@"\n')
+        os.chmod(f"{workdir}/bin/restic", 0o755)
+
+        lines = [f"{'Scenario':<15} {'Time (s)':>9} {'Peak RSS (MiB)':>15} {'Exit':>5}"]
+        print(lines[0])
+
+        for name in args.only or SCENARIOS:
+            res = bench(name, args.scale, workdir)
+            lines.append(f"{name:<15} {res['seconds']:>9.2f} " \
+                         f"{res['maxrss_kib'] / 1024:>15.1f} {res['exit']:>5}")
+            print(lines[-1])
+
+    if args.out:
+        with open(args.out, 'w') as file:
+            file.write("\n".join(lines) + "\n")
+
+
+if __name__ == "__main__":
+    main()
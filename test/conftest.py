@@ -0,0 +1,8 @@
+# The tested modules live at the repository root
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# Manual script, needs a running signal-cli daemon
+collect_ignore = ["test_signal_send.py"]
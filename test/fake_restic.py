@@ -0,0 +1,118 @@
+#!/usr/bin/env python
+
+# Synthetic restic stand-in for the benchmarks (see bench.py)
+#
+# Emits restic-like output streams sized by environment variables :
+#   FAKE_RESTIC_STATUS_LINES : backup "status" JSON lines (default 1000)
+#   FAKE_RESTIC_ERRORS : backup per-path "error" JSON lines (default 0)
+#   FAKE_RESTIC_STDERR_LINES : warning lines written to stderr (default 0)
+#   FAKE_RESTIC_CHECK_LINES : check text lines (default 10)
+#   FAKE_RESTIC_FORGET_GROUPS : forget snapshot groups (default 10)
+#   FAKE_RESTIC_FORGET_SNAPSHOTS : snapshots per group (default 10)
+#   FAKE_RESTIC_EXIT : exit code (default 0)
+
+import json
+import os
+import sys
+
+
+def env(name: str, default: int) -> int:
+    return int(os.environ.get(name, default))
+
+
+def write_stderr():
+    line = "error: open /data/unreadable/file: permission denied\n"
+    count = env('FAKE_RESTIC_STDERR_LINES', 0)
+
+    for _ in range(count // 1000):
+        sys.stderr.write(line * 1000)
+    sys.stderr.write(line * (count % 1000))
+
+
+def backup():
+    total = env('FAKE_RESTIC_STATUS_LINES', 1000)
+    errors = env('FAKE_RESTIC_ERRORS', 0)
+    out = sys.stdout
+
+    for i in range(total):
+        out.write(json.dumps({"message_type": "status",
+                              "seconds_elapsed": i // 10,
+                              "percent_done": i / total,
+                              "total_files": total,
+                              "files_done": i,
+                              "total_bytes": total * 4096,
+                              "bytes_done": i * 4096,
+                              "current_files": [f"/data/dir{i % 97}/file{i}"]}) + "\n")
+
+    for i in range(errors):
+        out.write(json.dumps({"message_type": "error",
+                              "error": {"message": "permission denied"},
+                              "during": "archival",
+                              "item": f"/data/unreadable/file{i}"}) + "\n")
+
+    write_stderr()
+
+    out.write(json.dumps({"message_type": "summary",
+                          "files_new": total // 100,
+                          "files_changed": total // 50,
+                          "files_unmodified": total,
+                          "dirs_new": 1,
+                          "dirs_changed": 2,
+                          "dirs_unmodified": 97,
+                          "data_blobs": total // 10,
+                          "tree_blobs": 98,
+                          "data_added": total * 40,
+                          "total_files_processed": total,
+                          "total_bytes_processed": total * 4096,
+                          "total_duration": 1.5,
+                          "snapshot_id": "0123456789abcdef" * 4}) + "\n")
+
+
+def check():
+    for i in range(env('FAKE_RESTIC_CHECK_LINES', 10)):
+        print(f"[0:{i // 60:02}] {i}.00%  {i} / 100 packs")
+
+    write_stderr()
+    print("no errors were found")
+
+
+def forget():
+    groups = env('FAKE_RESTIC_FORGET_GROUPS', 10)
+    per_group = env('FAKE_RESTIC_FORGET_SNAPSHOTS', 10)
+
+    def snapshot(g, i):
+        return {"time": "2024-09-06T00:00:00.000000000+02:00",
+                "tree": f"{g:032x}{i:032x}",
+                "paths": [f"/data/group{g}/path{p}" for p in range(5)],
+                "hostname": "host",
+                "username": "user",
+                "tags": ["Run by resticbackup.py script"],
+                "id": f"{i:032x}{g:032x}",
+                "short_id": f"{i:08x}"}
+
+    result = []
+    for g in range(groups):
+        snaps = [snapshot(g, i) for i in range(per_group)]
+        keep = per_group // 2
+        result.append({"tags": ["Run by resticbackup.py script"],
+                       "host": "host",
+                       "paths": [f"/data/group{g}/path{p}" for p in range(5)],
+                       "keep": snaps[:keep],
+                       "remove": snaps[keep:],
+                       "reasons": [{"snapshot": s, "matches": ["last snapshot"]}
+                                   for s in snaps[:keep]]})
+
+    print(json.dumps(result))
+    write_stderr()
+
+
+if __name__ == "__main__":
+    cmd = sys.argv[1] if len(sys.argv) > 1 else ""
+
+    match cmd:
+        case "backup": backup()
+        case "check": check()
+        case "forget": forget()
+        case "version": print("restic 0.17.0 compiled with go1.22.5 on linux/amd64")
+
+    sys.exit(env('FAKE_RESTIC_EXIT', 0))
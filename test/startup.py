@@ -0,0 +1,104 @@
+#!/usr/bin/env python
+
+# Startup time profile and budget
+#
+# Times cold starts of resticbak.py (usage text : no command, no repository
+# work), each in a fresh interpreter, minus the bare interpreter startup,
+# and lists the slowest modules imported by resticbak (python -X importtime).
+# The script itself is run as __main__, so it's compiled on every start
+# (no cached bytecode) : the import of the cached module is timed apart.
+# Exits with code 1 if the median overhead is over the budget.
+#
+# Usage : python3 test/startup.py [--runs 20] [--budget 60] [--top 15]
+
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+TEST_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(TEST_DIR)
+
+
+def wall_time(args: list) -> float:
+    """
+    Milliseconds taken by a fresh interpreter running args.
+    """
+    start = time.perf_counter()
+    subprocess.run([sys.executable] + args,
+                   cwd=REPO_DIR,
+                   stdout=subprocess.DEVNULL,
+                   stderr=subprocess.DEVNULL,
+                   check=True)
+    return (time.perf_counter() - start) * 1000
+
+
+def import_profile() -> list:
+    """
+    Import resticbak with -X importtime and return the modules it
+    pulls in, as (cumulative ms, self ms, name) tuples, slowest first.
+    """
+    p = subprocess.run([sys.executable, "-X", "importtime", "-c", "import resticbak"],
+                       cwd=REPO_DIR,
+                       stdout=subprocess.DEVNULL,
+                       stderr=subprocess.PIPE,
+                       text=True,
+                       check=True)
+
+    # "import time: self [us] | cumulative | imported package", children
+    # listed before their parent : keep the lines up to resticbak's own
+    entries = []
+    for line in p.stderr.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        self_us, cumul_us, name = line[len("import time:"):].split("|")
+        entries.append((int(cumul_us) / 1000, int(self_us) / 1000, name.rstrip()))
+        if name.strip() == "resticbak":
+            break
+
+    # Drop the interpreter startup (site...) : top-level entries before resticbak's imports
+    start = 0
+    for i, (_, _, name) in enumerate(entries):
+        if name.strip() == "site":
+            start = i + 1
+
+    return sorted(entries[start:], reverse=True)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--runs", type=int, default=20)
+    parser.add_argument("--budget", type=float, default=60,
+                        help="max median startup overhead, in milliseconds")
+    parser.add_argument("--top", type=int, default=15)
+    args = parser.parse_args()
+
+    # Write the imported modules bytecode cache first, as a deployed script has it
+    wall_time(["resticbak.py"])
+
+    bare = [wall_time(["-c", "pass"]) for _ in range(args.runs)]
+    usage = [wall_time(["resticbak.py"]) for _ in range(args.runs)]
+    module = [wall_time(["-c", "import resticbak"]) for _ in range(args.runs)]
+    overhead = statistics.median(usage) - statistics.median(bare)
+
+    print(f"Interpreter startup : {statistics.median(bare):.1f} ms (median of {args.runs})")
+    print(f"resticbak.py startup : {statistics.median(usage):.1f} ms")
+    print(f"resticbak module import (cached bytecode) : " \
+          f"{statistics.median(module) - statistics.median(bare):.1f} ms")
+    print(f"Overhead : {overhead:.1f} ms (budget {args.budget:.0f} ms)\n")
+
+    print(f"{'cumulative':>10}  {'self':>8}  module")
+    for cumul, own, name in import_profile()[:args.top]:
+        print(f"{cumul:8.1f}ms  {own:6.1f}ms  {name}")
+
+    if overhead > args.budget:
+        print(f"\nFAILED : startup overhead over the {args.budget:.0f} ms budget")
+        sys.exit(1)
+
+    print("\nOK")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,43 @@
+import time
+
+import capacity
+
+DAY = 86400
+
+
+def test_update(tmp_path):
+    path = str(tmp_path / "capacity.json")
+
+    capacity.update(path, repo_size=1000)
+    state = capacity.update(path, delta=500, free=10 ** 6)
+    state = capacity.update(path, delta=-200)
+
+    assert state['repo_size'] == 1300
+    assert state['growth'] == 300
+    assert [s[1:] for s in state['samples']] == [[0, None], [500, 10 ** 6], [300, None]]
+    assert capacity.load(path) == state
+
+
+def test_growth_rate():
+    now = time.time()
+    state = {'samples': [[now - 10 * DAY, 0, None],
+                         [now - 5 * DAY, 2500, None],
+                         [now, 5000, None]]}
+
+    assert round(capacity.growth_rate(state, 30 * DAY)) == 500
+    # Samples older than the window are left out
+    assert capacity.growth_rate(state, 6 * DAY) == 500
+
+
+def test_growth_rate_short():
+    now = time.time()
+    state = {'samples': [[now - 3600, 0, None], [now, 5000, None]]}
+
+    assert capacity.growth_rate(state, 30 * DAY) is None
+
+
+def test_forecast():
+    assert capacity.forecast(5000, 500) == 10
+    assert capacity.forecast(-100, 500) == 0
+    assert capacity.forecast(5000, 0) is None
+    assert capacity.forecast(5000, None) is None
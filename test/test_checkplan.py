@@ -0,0 +1,48 @@
+import checkplan
+
+STATE = {'part': 1, 'parts': 0, 'read_rate': 0}
+
+
+def test_rotate():
+    state = dict(STATE)
+    seen = []
+
+    for _ in range(5):
+        part, parts = checkplan.plan(state, parts=4)
+        seen.append(part)
+        state = checkplan.advance(state, part, parts)
+
+    assert seen == [1, 2, 3, 4, 1]
+
+
+def test_rescale():
+    state = {'part': 3, 'parts': 4, 'read_rate': 0}
+
+    # Half way through the cycle stays half way through
+    assert checkplan.plan(state, parts=8) == (5, 8)
+
+
+def test_budget():
+    state = {'part': 1, 'parts': 10, 'read_rate': 100}
+
+    assert checkplan.plan(state, budget=10, size=10000) == (1, 10)
+    assert checkplan.plan(state, budget=10, size=10001) == (1, 11)
+
+
+def test_budget_unmeasured():
+    assert checkplan.plan(STATE, budget=60, size=10 ** 12) == (1, 100)
+
+
+def test_max_parts():
+    state = {'part': 1, 'parts': 0, 'read_rate': 1}
+
+    assert checkplan.plan(state, budget=1, size=10 ** 9) == (1, checkplan.MAX_PARTS)
+    assert checkplan.plan(state, parts=1000) == (1, checkplan.MAX_PARTS)
+
+
+def test_read_rate():
+    state = checkplan.advance(STATE, 1, 4, read_bytes=1000, duration=10)
+    assert state['read_rate'] == 100
+
+    state = checkplan.advance(state, 2, 4, read_bytes=3000, duration=10)
+    assert state['read_rate'] == 200
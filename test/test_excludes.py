@@ -0,0 +1,59 @@
+import re
+
+import pytest
+
+import excludes
+
+
+@pytest.mark.parametrize("pattern, path, matched", [
+    ("*.tmp", "/data/a.tmp", True),
+    ("*.tmp", "/a.tmp", True),
+    ("*.tmp", "/data/a.tmp/b", False),
+    ("/data/*.tmp", "/data/a.tmp", True),
+    ("/data/*.tmp", "/data/sub/a.tmp", False),
+    ("/data/**/*.tmp", "/data/sub/deep/a.tmp", True),
+    ("/data/**/*.tmp", "/data/a.tmp", True),
+    ("file?.log", "/var/file1.log", True),
+    ("file?.log", "/var/file10.log", False),
+    ("[!a]*.log", "/var/b.log", True),
+    ("[!a]*.log", "/var/a.log", False),
+    ("a.b", "/axb", False),
+])
+def test_glob_to_regex(pattern, path, matched):
+    assert bool(re.match(excludes.glob_to_regex(pattern), path)) == matched
+
+
+def test_glob_to_regex_unclosed():
+    with pytest.raises(ValueError):
+        excludes.glob_to_regex("[abc")
+
+
+def test_match():
+    rules = excludes.compile_rules(["/data/skip"],
+                                   [{'pattern': "*.tmp"},
+                                    {'pattern': "cache", 'source': "/data"},
+                                    {'regex': r"\.bak$", 'source': "/home"}],
+                                   ["/data", "/home"])
+
+    assert excludes.match(rules, "/data/skip")
+    assert excludes.match(rules, "/home/a.tmp")
+    assert excludes.match(rules, "/data/cache")
+    assert excludes.match(rules, "/home/cache") is None
+    assert excludes.match(rules, "/home/x.bak")
+    assert excludes.match(rules, "/data/x.bak") is None
+    assert excludes.match(rules, "/data/keep.txt") is None
+
+
+def test_match_root_source():
+    rules = excludes.compile_rules([],
+                                   [{'pattern': "*.tmp", 'source': "/"},
+                                    {'regex': r"/cache$", 'source': "/"}],
+                                   ["/"])
+
+    assert excludes.match(rules, "/a.tmp")
+    assert excludes.match(rules, "/var/cache")
+
+
+def test_compile_rules_unknown_source():
+    with pytest.raises(ValueError):
+        excludes.compile_rules([], [{'pattern': "*.tmp", 'source': "/other"}], ["/data"])
@@ -0,0 +1,51 @@
+import io
+import json
+
+import forgetjson
+
+
+def output(groups: list,
+           text: str = "") -> str:
+    return json.dumps(groups) + "\n" + text
+
+
+def group(host: str,
+          keep: int,
+          remove: int) -> dict:
+    return {'host': host, 'paths': ["/data"], 'tags': None,
+            'keep': [{'id': f"k{i}"} for i in range(keep)],
+            'remove': [{'id': f"{host}-r{i}"} for i in range(remove)] or None}
+
+
+def test_parse():
+    res = forgetjson.parse(io.StringIO(output([group("a", 3, 2), group("b", 1, 0)])))
+
+    assert res['keep'] == 4
+    assert res['remove'] == 2
+    assert res['removed_ids'] == ["a-r0", "a-r1"]
+    assert res['groups'] == [{'host': "a", 'paths': ["/data"], 'tags': [], 'keep': 3, 'remove': 2},
+                             {'host': "b", 'paths': ["/data"], 'tags': [], 'keep': 1, 'remove': 0}]
+
+
+def test_parse_small_chunks():
+    groups = [group(f"host{i}", 5, 3) for i in range(20)]
+    res = forgetjson.parse(io.StringIO(output(groups)), chunk_size=7)
+
+    assert res['keep'] == 100
+    assert res['remove'] == 60
+    assert len(res['groups']) == 20
+
+
+def test_parse_trailing_text():
+    text = "1 snapshots have been removed, running prune\nloading indexes...\n\ndone\n"
+    res = forgetjson.parse(io.StringIO(output([group("a", 1, 1)], text)), chunk_size=16)
+
+    assert list(res['text']) == ["1 snapshots have been removed, running prune",
+                                 "loading indexes...", "done"]
+
+
+def test_parse_empty():
+    res = forgetjson.parse(io.StringIO("[]\n"))
+
+    assert res['keep'] == 0
+    assert res['groups'] == []
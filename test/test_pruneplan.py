@@ -0,0 +1,58 @@
+import time
+
+import pytest
+
+import pruneplan
+
+DRY_RUN = """\
+to repack:            10 blobs / 1.078 MiB
+this removes:         5 blobs / 1.072 MiB
+to delete:            2 blobs / 1.5 MiB
+total prune:          7 blobs / 2.572 MiB
+remaining:            100 blobs / 1.2 GiB
+unused size after prune: 12.5 MiB (1.02% of remaining size)
+"""
+
+
+def test_to_bytes():
+    assert pruneplan.to_bytes("512") == 512
+    assert pruneplan.to_bytes("1.5 KiB") == 1536
+    assert pruneplan.to_bytes("10G") == 10 * 1024 ** 3
+
+    with pytest.raises(ValueError):
+        pruneplan.to_bytes("lots")
+
+
+def test_parse():
+    stats = pruneplan.parse(DRY_RUN.splitlines())
+
+    assert stats['repack'] == int(1.078 * 1024 ** 2)
+    assert stats['prune'] == int(2.572 * 1024 ** 2)
+    assert stats['remaining'] == int(1.2 * 1024 ** 3)
+    assert stats['unused_after'] == int(12.5 * 1024 ** 2)
+
+
+def test_decide():
+    stats = {'prune': 100, 'repack': 50}
+    recent = {'last_prune': time.time()}
+
+    assert pruneplan.decide({'prune': 0, 'repack': 0}, recent, 10, 3600)[0] is False
+    assert pruneplan.decide(stats, recent, 10, 3600)[0] is True
+    assert pruneplan.decide(stats, recent, 1000, 3600)[0] is False
+    assert pruneplan.decide(stats, {'last_prune': time.time() - 7200}, 1000, 3600)[0] is True
+
+
+def test_repack_budget():
+    assert pruneplan.repack_budget("", 0, 0) == ""
+    assert pruneplan.repack_budget("2G", 0, 0) == "2048M"
+    assert pruneplan.repack_budget("2G", 1024 ** 2, 60) == "60M"
+    assert pruneplan.repack_budget("", 0, 60) == f"{pruneplan.DEFAULT_REPACK_RATE * 60 // 1024 ** 2}M"
+
+
+def test_advance():
+    state = pruneplan.advance({'repack_rate': 0, 'last_prune': 0}, {'repack': 1000}, 10)
+    assert state['repack_rate'] == 100
+    assert state['last_prune'] > 0
+
+    state = pruneplan.advance(state, {'repack': 3000}, 10)
+    assert state['repack_rate'] == 200
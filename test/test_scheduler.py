@@ -0,0 +1,63 @@
+import time
+from datetime import datetime
+
+import pytest
+
+import scheduler
+
+
+def ts(*args) -> float:
+    return datetime(*args).timestamp()
+
+
+def test_parse_field():
+    assert scheduler.parse_field("*", 0, 3) == {0, 1, 2, 3}
+    assert scheduler.parse_field("1,15", 1, 31) == {1, 15}
+    assert scheduler.parse_field("1..5", 1, 31) == {1, 2, 3, 4, 5}
+    assert scheduler.parse_field("*/15", 0, 59) == {0, 15, 30, 45}
+    assert scheduler.parse_field("0/6", 0, 23) == {0, 6, 12, 18}
+
+
+def test_parse_weekdays():
+    assert scheduler.parse_weekdays("Mon..Fri") == {0, 1, 2, 3, 4}
+    assert scheduler.parse_weekdays("Sat,Sun") == {5, 6}
+
+
+def test_parse_calendar_shortcut():
+    assert scheduler.parse_calendar("daily") == scheduler.parse_calendar("*-*-* 00:00:00")
+
+
+def test_parse_calendar_default_seconds():
+    spec = scheduler.parse_calendar("*-*-* 04:30")
+    assert spec['hours'] == {4}
+    assert spec['minutes'] == {30}
+    assert spec['seconds'] == {0}
+    assert spec['years'] is None
+
+
+@pytest.mark.parametrize("expr", ["Someday", "*-*-* 04:xx:00", "*-*-* 04:00:00 extra"])
+def test_parse_calendar_invalid(expr):
+    with pytest.raises(ValueError):
+        scheduler.parse_calendar(expr)
+
+
+def test_next_elapse_same_day():
+    assert scheduler.next_elapse("*-*-* 04:00:00", ts(2024, 9, 6, 3, 0)) == ts(2024, 9, 6, 4, 0)
+
+
+def test_next_elapse_strictly_after():
+    assert scheduler.next_elapse("*-*-* 04:00:00", ts(2024, 9, 6, 4, 0)) == ts(2024, 9, 7, 4, 0)
+
+
+def test_next_elapse_weekday():
+    # 2024-09-06 is a Friday
+    assert scheduler.next_elapse("Mon *-*-* 02:00", ts(2024, 9, 6, 12, 0)) == ts(2024, 9, 9, 2, 0)
+
+
+def test_next_elapse_leap_day():
+    assert scheduler.next_elapse("*-02-29 00:00:00", ts(2025, 1, 1)) == ts(2028, 2, 29)
+
+
+def test_next_elapse_never():
+    with pytest.raises(ValueError):
+        scheduler.next_elapse("*-02-30 00:00:00", time.time())
@@ -0,0 +1,174 @@
+# Restic performance auto-tuner
+#
+# Runs timed trial backups of a data sample into scratch local repositories
+# on the backup drive, trying read concurrency, pack size, compression and
+# GOMAXPROCS values, and saves the fastest setup for this host so backup()
+# can apply it.
+
+import os
+import shutil
+import socket
+import subprocess
+import tempfile
+
+import runner
+import statefile
+
+# Values tried for each parameter. None is the restic default.
+CANDIDATES = {
+    'read_concurrency': [None, 1, 4, 8],
+    'pack_size': [None, 32, 64, 128],
+    'compression': [None, "off", "max"],
+    'gomaxprocs': [None] + sorted({1, max(1, (os.cpu_count() or 2) // 2)}),
+}
+
+
+def sample_files(sources: list,
+                 max_bytes: int) -> list:
+    """
+    Pick files from the sources, in walk order, up to max_bytes.
+    """
+    files = []
+    total = 0
+
+    for src in sources:
+        for root, dirs, names in os.walk(src):
+            dirs.sort()
+            for name in sorted(names):
+                path = os.path.join(root, name)
+                try:
+                    size = os.lstat(path).st_size
+                except OSError:
+                    continue
+
+                files.append(path)
+                total += size
+                if total >= max_bytes:
+                    return files
+
+    return files
+
+
+def args_for(config: dict) -> tuple:
+    """
+    Return the (restic backup extra arguments, environment) for a config,
+    ex : {'read_concurrency': 4, 'pack_size': 64, 'compression': None,
+    'gomaxprocs': 2} -> (["--read-concurrency", "4", "--pack-size", "64"],
+    {'GOMAXPROCS': "2"})
+    """
+    args = []
+    env = {}
+
+    if config.get('read_concurrency'):
+        args += ["--read-concurrency", str(config['read_concurrency'])]
+    if config.get('pack_size'):
+        args += ["--pack-size", str(config['pack_size'])]
+    if config.get('compression'):
+        args += ["--compression", config['compression']]
+    if config.get('gomaxprocs'):
+        env['GOMAXPROCS'] = str(config['gomaxprocs'])
+
+    return args, env
+
+
+def trial(scratch_dir: str,
+          files_from: str,
+          config: dict) -> float:
+    """
+    Back up the sample into a new scratch repository with the given
+    config. Returns the wall clock duration, None if restic failed.
+    """
+    repo = tempfile.mkdtemp(prefix="repo-", dir=scratch_dir)
+    env = dict(os.environ, RESTIC_REPOSITORY=repo)
+
+    try:
+        p = subprocess.run(["restic", "init"],
+                           env=env,
+                           stdout=subprocess.DEVNULL,
+                           stderr=subprocess.PIPE)
+        if p.returncode != 0:
+            print(p.stderr.decode())
+            return None
+
+        args, extra_env = args_for(config)
+        env.update(extra_env)
+        res = runner.run(["restic", "backup", "--no-cache", "--json",
+                          "--files-from-verbatim", files_from] + args,
+                         echo_stderr=False,
+                         env=env)
+
+        return res['duration'] if res['returncode'] == 0 else None
+
+    finally:
+        shutil.rmtree(repo, ignore_errors=True)
+
+
+def tune(sources: list,
+         scratch_parent: str,
+         sample_bytes: int) -> dict:
+    """
+    Tune one parameter at a time (coordinate descent), keeping the best
+    value found for the previous ones. A first discarded trial warms the
+    page cache up so all trials read the sample under the same conditions.
+
+    Returns the best config, with its measured 'rate' in bytes/s.
+    """
+    files = sample_files(sources, sample_bytes)
+    size = sum(os.lstat(f).st_size for f in files)
+
+    if not files:
+        print("Nothing to sample in the backup sources")
+        return None
+
+    print(f"Sample : {len(files)} files, {size} bytes")
+
+    scratch_dir = tempfile.mkdtemp(prefix=".resticbak-tune-", dir=scratch_parent)
+    files_from = f"{scratch_dir}/files"
+
+    try:
+        with open(files_from, 'w', encoding='utf-8', errors='surrogateescape') as file:
+            file.write("\n".join(files) + "\n")
+
+        best = {param: None for param in CANDIDATES}
+        best_time = trial(scratch_dir, files_from, best)     # warm up
+        best_time = trial(scratch_dir, files_from, best)
+
+        if best_time is None:
+            print("Trial backup with restic defaults failed")
+            return None
+
+        print(f"restic defaults : {best_time:.2f}s")
+
+        for param, values in CANDIDATES.items():
+            for value in values:
+                if value is None or value == best[param]:
+                    continue
+
+                config = dict(best, **{param: value})
+                duration = trial(scratch_dir, files_from, config)
+                print(f"{param}={value} : " \
+                      f"{'failed' if duration is None else f'{duration:.2f}s'}")
+
+                if duration is not None and duration < best_time:
+                    best, best_time = config, duration
+
+    finally:
+        shutil.rmtree(scratch_dir, ignore_errors=True)
+
+    best['rate'] = size / best_time
+    return best
+
+
+def load(state_path: str) -> dict:
+    """
+    Return the tuned config saved for this host, None if none.
+    """
+    return statefile.load(state_path, {}).get(socket.gethostname())
+
+
+def save(state_path: str,
+         config: dict):
+    hosts = statefile.load(state_path, {})
+    hosts[socket.gethostname()] = config
+
+    statefile.save(state_path, hosts, indent=2)